@@ -0,0 +1,374 @@
+#!/usr/bin/env python3
+"""Microbenchmarks for trappedbot's hot paths
+
+Drives the message callback, command processing, response parsing,
+the builtin help task, and sending text to a room,
+against the in-memory fake client in trappedbot.fakeclient,
+with synthetic rooms and messages.
+Each benchmark is run at several scales:
+numbers of responses and commands, numbers of rooms, and message sizes.
+The single-flight benchmark also checks that identical invocations
+that are in flight at the same time share one execution, and fails if they do not.
+
+Results are written as JSON, so that they can be saved and compared between releases:
+
+    python support/benchmark.py --output bench-0.9.0.json
+    python support/benchmark.py --compare bench-0.9.0.json
+
+Run with --quick for a fast smoke test with fewer iterations and smaller scales.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import platform
+import statistics
+import sys
+import time
+import typing
+
+from trappedbot import appconfig
+from trappedbot.applogger import LOGGER
+from trappedbot.callbacks import Callbacks
+from trappedbot.chat_functions import send_text_to_room
+from trappedbot.commands.builtin import BUILTIN_COMMANDS
+from trappedbot.commands.command import Command, process_command
+from trappedbot.commands.command_list import yamlobj2cmddict
+from trappedbot.configuration import Configuration
+from trappedbot.fakeclient import FakeAsyncClient, fake_message, fake_room
+from trappedbot.mxutil import MessageFormat
+from trappedbot.responses.response_list import yamlobj2rsplist
+from trappedbot.tasks.builtin import builtin_task_help
+from trappedbot.tasks.task import Task, TaskMessageContext, TaskResult
+from trappedbot.version import version_raw
+
+
+SENDER = "@user:example.com"
+PREFIX = "!t"
+SINGLEFLIGHT_DELAY = 0.001
+"""Seconds the single-flight benchmark's command takes, so invocations overlap"""
+
+
+def synthetic_responses(count: int) -> typing.List[typing.Dict]:
+    """Response definitions like the ones in the example config"""
+    return [
+        {
+            "regex": f"^(hello|hi) +responder{idx}( +[a-z]+)?[\\.\\!\\?]*$",
+            "ignorecase": bool(idx % 2),
+            "response": f"Response number {idx}",
+        }
+        for idx in range(count)
+    ]
+
+
+def synthetic_commands(count: int) -> typing.Dict[str, typing.Dict]:
+    return {
+        f"command{idx}": {
+            "builtin": "echo",
+            "help": f"Synthetic command number {idx}",
+            "allow_untrusted": bool(idx % 2),
+            "allow_users": [SENDER],
+        }
+        for idx in range(count)
+    }
+
+
+def synthetic_text(size: int) -> str:
+    """Text about size bytes long, with paragraphs and a little markdown"""
+    line = "The quick brown fox **jumps** over the `lazy` dog, again and again.\n"
+    paragraph = line * 8 + "\n"
+    return (paragraph * (size // len(paragraph) + 1))[:size]
+
+
+def configure(
+    responses: int = 0,
+    commands: int = 0,
+    extra: typing.Optional[typing.Dict[str, Command]] = None,
+):
+    commanddict = yamlobj2cmddict(synthetic_commands(commands))
+    commanddict.update(extra or {})
+    commanddict.update(BUILTIN_COMMANDS)
+    appconfig.set(
+        Configuration(
+            command_prefix=PREFIX,
+            commands=commanddict,
+            responses=yamlobj2rsplist(synthetic_responses(responses)),
+        )
+    )
+
+
+class Result(typing.NamedTuple):
+    name: str
+    params: typing.Dict[str, typing.Any]
+    iterations: int
+    mean_us: float
+    median_us: float
+    p95_us: float
+    min_us: float
+    ops_per_sec: float
+
+
+def summarize(name: str, params: typing.Dict, timings: typing.List[float]) -> Result:
+    timings = sorted(timings)
+    mean = statistics.mean(timings)
+    return Result(
+        name=name,
+        params=params,
+        iterations=len(timings),
+        mean_us=round(mean * 1e6, 3),
+        median_us=round(statistics.median(timings) * 1e6, 3),
+        p95_us=round(timings[int(len(timings) * 0.95) - 1] * 1e6, 3),
+        min_us=round(timings[0] * 1e6, 3),
+        ops_per_sec=round(1 / mean, 1) if mean else 0.0,
+    )
+
+
+def bench_sync(
+    func: typing.Callable[[], typing.Any], iterations: int
+) -> typing.List[float]:
+    timings = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def bench_async(
+    func: typing.Callable[[int], typing.Awaitable], iterations: int
+) -> typing.List[float]:
+    async def _run():
+        timings = []
+        for idx in range(iterations):
+            start = time.perf_counter()
+            await func(idx)
+            timings.append(time.perf_counter() - start)
+        return timings
+
+    return asyncio.run(_run())
+
+
+Benchmark = typing.Tuple[str, typing.Dict, typing.Callable[[], typing.List[float]]]
+
+
+def benchmarks(
+    scales: typing.Dict[str, typing.List[int]], iterations: int
+) -> typing.Iterator[Benchmark]:
+    """Yield (name, params, run) for every benchmark at every scale"""
+
+    for count in scales["responses"]:
+
+        def _parse(count=count):
+            yamlobj = synthetic_responses(count)
+            return bench_sync(lambda: yamlobj2rsplist(yamlobj), iterations)
+
+        yield "yamlobj2rsplist", {"responses": count}, _parse
+
+    for count in scales["responses"]:
+        for size in scales["sizes"]:
+
+            def _respond(count=count, size=size):
+                # Messages that match no response, so that every regex is tried
+                configure(responses=count)
+                client = FakeAsyncClient(keep=False)
+                callbacks = Callbacks(client, None)
+                room = fake_room("!bench:example.com", client.user, [SENDER])
+                events = [fake_message(SENDER, synthetic_text(size)) for _ in range(8)]
+                return bench_async(
+                    lambda i: callbacks.handle(room, events[i % len(events)]),
+                    iterations,
+                )
+
+            params = {"responses": count, "size": size}
+            yield "Callbacks.message/response", params, _respond
+
+    for count in scales["commands"]:
+        for rooms in scales["rooms"]:
+
+            def _command(count=count, rooms=rooms):
+                configure(commands=count)
+                client = FakeAsyncClient(keep=False)
+                callbacks = Callbacks(client, None)
+                roomlist = [
+                    fake_room(f"!bench{r}:example.com", client.user, [SENDER])
+                    for r in range(rooms)
+                ]
+                event = fake_message(SENDER, f"{PREFIX} command{count - 1} hello there")
+                return bench_async(
+                    lambda i: callbacks.handle(roomlist[i % rooms], event), iterations
+                )
+
+            params = {"commands": count, "rooms": rooms}
+            yield "Callbacks.message/command", params, _command
+
+    for count in scales["invocations"]:
+
+        def _singleflight(count=count):
+            executions = []
+
+            async def _slow(arguments, _context):
+                executions.append(arguments)
+                await asyncio.sleep(SINGLEFLIGHT_DELAY)
+                return TaskResult("done", MessageFormat.NATURAL)
+
+            task = Task("slow", taskfunc=_slow, singleflight=True)
+            configure(extra={"slow": Command("slow", task, allow_untrusted=True)})
+            client = FakeAsyncClient(keep=False)
+            callbacks = Callbacks(client, None)
+            room = fake_room("!bench:example.com", client.user, [SENDER])
+
+            async def _batch(i):
+                # Different arguments in each iteration, identical within one
+                event = fake_message(SENDER, f"{PREFIX} slow {i}")
+                await asyncio.gather(
+                    *(callbacks.handle(room, event) for _ in range(count))
+                )
+
+            timings = bench_async(_batch, iterations)
+            if len(executions) != len(timings):
+                average = len(executions) / len(timings)
+                raise RuntimeError(
+                    f"{count} identical single-flight invocations in flight together "
+                    f"ran {average:.1f} times on average, not once"
+                )
+            return timings
+
+        yield "Callbacks.message/singleflight", {"invocations": count}, _singleflight
+
+    for count in scales["commands"]:
+
+        def _process(count=count):
+            configure(commands=count)
+            client = FakeAsyncClient(keep=False)
+            room = fake_room("!bench:example.com", client.user, [SENDER])
+            event = fake_message(SENDER, f"{PREFIX} version")
+            return bench_async(
+                lambda i: process_command(client, "version", room, event), iterations
+            )
+
+        yield "process_command", {"commands": count}, _process
+
+    for count in scales["commands"]:
+
+        def _help(count=count):
+            configure(responses=count, commands=count)
+            context = TaskMessageContext(SENDER, "!bench:example.com")
+            return bench_sync(
+                lambda: builtin_task_help(["commands"], context), iterations
+            )
+
+        yield "builtin_task_help", {"commands": count, "responses": count}, _help
+
+    for size in scales["sizes"]:
+        for format in (
+            MessageFormat.NATURAL,
+            MessageFormat.MARKDOWN,
+            MessageFormat.CODE,
+        ):
+
+            def _send(size=size, format=format):
+                configure()
+                client = FakeAsyncClient(keep=False)
+                message = synthetic_text(size)
+                return bench_async(
+                    lambda i: send_text_to_room(
+                        client, "!bench:example.com", message, format=format
+                    ),
+                    iterations,
+                )
+
+            yield "send_text_to_room", {"size": size, "format": format.name}, _send
+
+
+FULL_SCALES = {
+    "responses": [1, 10, 100, 1000],
+    "commands": [1, 10, 100, 1000],
+    "rooms": [1, 100, 10000],
+    "sizes": [100, 4000, 40000, 200000],
+    "invocations": [1, 10, 100],
+}
+QUICK_SCALES = {
+    "responses": [1, 100],
+    "commands": [1, 100],
+    "rooms": [1, 100],
+    "sizes": [100, 4000],
+    "invocations": [1, 10],
+}
+
+
+def compare(results: typing.List[Result], baseline: typing.Dict) -> None:
+    """Print the change in median time from a previous run"""
+
+    def _key(name, params):
+        return (name, json.dumps(params, sort_keys=True))
+
+    previous = {_key(r["name"], r["params"]): r for r in baseline["results"]}
+    for result in results:
+        prev = previous.get(_key(result.name, result.params))
+        if not prev or not prev["median_us"]:
+            continue
+        change = (result.median_us - prev["median_us"]) / prev["median_us"] * 100
+        print(
+            f"{result.name} {json.dumps(result.params)}: "
+            f"{prev['median_us']}us -> {result.median_us}us ({change:+.1f}%)",
+            file=sys.stderr,
+        )
+
+
+def main(arguments: typing.List[str] = sys.argv[1:]):
+    parser = argparse.ArgumentParser(description="Benchmark trappedbot's hot paths")
+    parser.add_argument(
+        "--quick", action="store_true", help="Fewer iterations and smaller scales"
+    )
+    parser.add_argument(
+        "--iterations",
+        type=int,
+        help="Iterations per benchmark (default 200, or 20 with --quick)",
+    )
+    parser.add_argument(
+        "--filter", default="", help="Only run benchmarks whose name contains this"
+    )
+    parser.add_argument("--output", help="Write results to this file instead of stdout")
+    parser.add_argument(
+        "--compare", help="A previous results file to compare median times against"
+    )
+    parsed = parser.parse_args(arguments)
+
+    # Benchmark the code, not the log handler
+    LOGGER.setLevel(logging.WARNING)
+
+    scales = QUICK_SCALES if parsed.quick else FULL_SCALES
+    iterations = parsed.iterations or (20 if parsed.quick else 200)
+
+    results = []
+    for name, params, run in benchmarks(scales, iterations):
+        if parsed.filter not in name:
+            continue
+        result = summarize(name, params, run())
+        print(
+            f"{name} {json.dumps(params)}: median {result.median_us}us",
+            file=sys.stderr,
+        )
+        results.append(result)
+
+    report = {
+        "trappedbot": version_raw(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "iterations": iterations,
+        "results": [r._asdict() for r in results],
+    }
+    if parsed.compare:
+        with open(parsed.compare) as fp:
+            compare(results, json.load(fp))
+    if parsed.output:
+        with open(parsed.output, "w") as fp:
+            json.dump(report, fp, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+
+
+if __name__ == "__main__":
+    main()
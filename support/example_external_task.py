@@ -17,6 +17,12 @@ function called 'trappedbot_task' which takes two arguments:
 The function then must return a TaskResult containing the output to the channel
 and formatting information.
 
+If your task produces a lot of output, or produces it slowly, the function can
+instead be a generator (or an async generator) that yields TaskResult chunks.
+Each chunk is sent to the channel as soon as it is yielded.
+If the command is configured with 'stream: yes', the chunks are instead
+collected into a single message that is edited as they arrive.
+
 One final note: an external Python task can be a Python package (a directory
 with an __init__.py file) instead of simple Python modules (a script ending in
 .py).
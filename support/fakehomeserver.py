@@ -0,0 +1,405 @@
+#!/usr/bin/env python3
+"""A small local stand-in for a Matrix homeserver, for load testing
+
+Implements just enough of the client-server API for `nio.AsyncClient`
+to log in, long-poll /sync, join rooms, send messages and upload files,
+so that the real `trappedbot bot` can run against it
+without touching a production homeserver.
+
+Nothing is persisted and there is no federation, authentication,
+or access control: any password and any access token are accepted.
+Rooms are unencrypted.
+Filters can be uploaded and fetched, and /sync accepts them, but does not apply them.
+If the bot has end-to-end encryption support installed,
+the key management endpoints it calls at startup answer with empty results.
+
+Messages can be injected into room timelines,
+either from Python with `FakeHomeserver.inject()`,
+or over HTTP with
+
+    POST /_fake/rooms/{room_id}/inject
+    {"sender": "@user:homeserver.test", "body": "!t echo hi"}
+
+and the bot receives them the next time it syncs.
+Everything the bot sends can be observed with `FakeHomeserver.listeners`,
+or fetched with
+
+    GET /_fake/sent?since=N
+
+Run this file directly to start a server by itself;
+see loadtest.py in this directory for a load driver that uses it.
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import time
+import typing
+
+from aiohttp import web
+
+
+SERVER_NAME = "homeserver.test"
+
+
+def _now_ms() -> int:
+    return int(time.time() * 1000)
+
+
+class SentMessage(typing.NamedTuple):
+    """A message a client sent to the fake homeserver
+
+    received:   When the server received it, in time.perf_counter() seconds
+    """
+
+    room_id: str
+    sender: str
+    event_type: str
+    content: typing.Dict[str, typing.Any]
+    received: float
+
+
+class FakeRoom(object):
+    def __init__(self, room_id: str, creator: str, created: int):
+        self.room_id = room_id
+        self.creator = creator
+        # The stream position when the room was created or its membership changed
+        self.changed = created
+        self.members: typing.Set[str] = set()
+        # Timeline events, as (stream position, event) pairs
+        self.timeline: typing.List[typing.Tuple[int, typing.Dict]] = []
+
+    def state(self) -> typing.List[typing.Dict]:
+        """The room's current state events"""
+        events = [
+            {
+                "type": "m.room.create",
+                "state_key": "",
+                "sender": self.creator,
+                "event_id": f"$create-{self.room_id}",
+                "origin_server_ts": 0,
+                "content": {"creator": self.creator},
+            }
+        ]
+        for member in sorted(self.members):
+            events.append(
+                {
+                    "type": "m.room.member",
+                    "state_key": member,
+                    "sender": member,
+                    "event_id": f"$member-{member}-{self.room_id}",
+                    "origin_server_ts": 0,
+                    "content": {
+                        "membership": "join",
+                        "displayname": member[1:].split(":")[0],
+                    },
+                }
+            )
+        return events
+
+
+class FakeHomeserver(object):
+    """An in-memory homeserver
+
+    Each injected or sent event gets the next position in a single stream,
+    and /sync tokens are just stream positions.
+
+    Create this inside a running event loop.
+    """
+
+    bot_user = f"@trappedbot:{SERVER_NAME}"
+
+    def __init__(self, sync_timeout_cap: float = 30.0):
+        self.rooms: typing.Dict[str, FakeRoom] = {}
+        # Start at 1, since clients send since=0 as no token at all
+        self.position = 1
+        self.sync_timeout_cap = sync_timeout_cap
+        self.syncs = 0
+        self.sent: typing.List[SentMessage] = []
+        self.listeners: typing.List[typing.Callable[[SentMessage], None]] = []
+        self.uploads: typing.Dict[str, bytes] = {}
+        self.filters: typing.Dict[str, typing.Dict] = {}
+        self.tokens: typing.Dict[str, str] = {}
+        self._changed = asyncio.Condition()
+        self._ids = itertools.count(1)
+
+    # Python API
+
+    def create_room(self, room_id: str, members: typing.Iterable[str]) -> FakeRoom:
+        members = list(members)
+        creator = members[0] if members else f"@admin:{SERVER_NAME}"
+        self.position += 1
+        room = FakeRoom(room_id, creator, self.position)
+        room.members.update(members)
+        self.rooms[room_id] = room
+        return room
+
+    async def _append(self, room_id: str, event: typing.Dict) -> int:
+        self.position += 1
+        self.rooms[room_id].timeline.append((self.position, event))
+        async with self._changed:
+            self._changed.notify_all()
+        return self.position
+
+    async def inject(
+        self, room_id: str, sender: str, body: str, msgtype: str = "m.text"
+    ) -> str:
+        """Add a message to a room's timeline, as if sender had sent it"""
+        event_id = f"${next(self._ids)}:{SERVER_NAME}"
+        room = self.rooms[room_id]
+        if sender not in room.members:
+            room.members.add(sender)
+            room.changed = self.position + 1
+        await self._append(
+            room_id,
+            {
+                "type": "m.room.message",
+                "sender": sender,
+                "event_id": event_id,
+                "origin_server_ts": _now_ms(),
+                "content": {"msgtype": msgtype, "body": body},
+            },
+        )
+        return event_id
+
+    def sync_response(self, since: int, full_state: bool) -> typing.Dict:
+        joined = {}
+        for room in self.rooms.values():
+            timeline = [event for pos, event in room.timeline if pos > since]
+            # Only send state the client has not seen
+            send_state = full_state or not since or room.changed > since
+            if not timeline and not send_state:
+                continue
+            joined[room.room_id] = {
+                "state": {"events": room.state() if send_state else []},
+                "timeline": {
+                    "events": timeline if since else [],
+                    "limited": False,
+                    "prev_batch": str(since),
+                },
+                "ephemeral": {"events": []},
+                "account_data": {"events": []},
+                "summary": {"m.joined_member_count": len(room.members)},
+                "unread_notifications": {},
+            }
+        return {
+            "next_batch": str(self.position),
+            "rooms": {"join": joined, "invite": {}, "leave": {}},
+            "to_device": {"events": []},
+            "presence": {"events": []},
+            "account_data": {"events": []},
+            "device_lists": {"changed": [], "left": []},
+            "device_one_time_keys_count": {"signed_curve25519": 50},
+        }
+
+    # HTTP API
+
+    async def login(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        user = body.get("identifier", {}).get("user") or body.get("user", "bot")
+        if not user.startswith("@"):
+            user = f"@{user}:{SERVER_NAME}"
+        device_id = body.get("device_id") or "FAKEDEVICE"
+        token = f"fake-token-{next(self._ids)}"
+        self.tokens[token] = user
+        return web.json_response(
+            {
+                "user_id": user,
+                "access_token": token,
+                "device_id": device_id,
+                "home_server": SERVER_NAME,
+            }
+        )
+
+    async def sync(self, request: web.Request) -> web.Response:
+        self.syncs += 1
+        since = int(request.query.get("since", 0) or 0)
+        full_state = request.query.get("full_state") == "true"
+        timeout = min(
+            int(request.query.get("timeout", 0)) / 1000, self.sync_timeout_cap
+        )
+        # The initial sync returns immediately, with room state but no history
+        if since and since >= self.position and timeout > 0:
+            try:
+                async with self._changed:
+                    await asyncio.wait_for(
+                        self._changed.wait_for(lambda: self.position > since), timeout
+                    )
+            except asyncio.TimeoutError:
+                pass
+        return web.json_response(self.sync_response(since, full_state))
+
+    async def send(self, request: web.Request) -> web.Response:
+        room_id = request.match_info["room_id"]
+        event_type = request.match_info["event_type"]
+        if room_id not in self.rooms:
+            return web.json_response(
+                {"errcode": "M_FORBIDDEN", "error": "Unknown room"}, status=403
+            )
+        content = await request.json()
+        sender = request["user"]
+        message = SentMessage(room_id, sender, event_type, content, time.perf_counter())
+        self.sent.append(message)
+        for listener in self.listeners:
+            listener(message)
+        event_id = f"${next(self._ids)}:{SERVER_NAME}"
+        await self._append(
+            room_id,
+            {
+                "type": event_type,
+                "sender": sender,
+                "event_id": event_id,
+                "origin_server_ts": _now_ms(),
+                "content": content,
+            },
+        )
+        return web.json_response({"event_id": event_id})
+
+    async def join(self, request: web.Request) -> web.Response:
+        room_id = request.match_info["room_id"]
+        room = self.rooms.get(room_id) or self.create_room(room_id, [])
+        room.members.add(request["user"])
+        self.position += 1
+        room.changed = self.position
+        async with self._changed:
+            self._changed.notify_all()
+        return web.json_response({"room_id": room_id})
+
+    async def joined_members(self, request: web.Request) -> web.Response:
+        room = self.rooms[request.match_info["room_id"]]
+        return web.json_response(
+            {
+                "joined": {
+                    m: {"display_name": m[1:].split(":")[0], "avatar_url": None}
+                    for m in room.members
+                }
+            }
+        )
+
+    async def upload(self, request: web.Request) -> web.Response:
+        uri = f"mxc://{SERVER_NAME}/{next(self._ids)}"
+        self.uploads[uri] = await request.read()
+        return web.json_response({"content_uri": uri})
+
+    async def upload_filter(self, request: web.Request) -> web.Response:
+        filter_id = str(next(self._ids))
+        self.filters[filter_id] = await request.json()
+        return web.json_response({"filter_id": filter_id})
+
+    async def get_filter(self, request: web.Request) -> web.Response:
+        definition = self.filters.get(request.match_info["filter_id"])
+        if definition is None:
+            return web.json_response(
+                {"errcode": "M_NOT_FOUND", "error": "Unknown filter"}, status=404
+            )
+        return web.json_response(definition)
+
+    async def keys_upload(self, request: web.Request) -> web.Response:
+        return web.json_response({"one_time_key_counts": {"signed_curve25519": 50}})
+
+    async def keys_query(self, request: web.Request) -> web.Response:
+        return web.json_response({"device_keys": {}, "failures": {}})
+
+    async def keys_claim(self, request: web.Request) -> web.Response:
+        return web.json_response({"one_time_keys": {}, "failures": {}})
+
+    async def empty(self, request: web.Request) -> web.Response:
+        return web.json_response({})
+
+    async def fake_inject(self, request: web.Request) -> web.Response:
+        room_id = request.match_info["room_id"]
+        body = await request.json()
+        if room_id not in self.rooms:
+            self.create_room(room_id, [body["sender"]])
+        event_id = await self.inject(room_id, body["sender"], body["body"])
+        return web.json_response({"event_id": event_id})
+
+    async def fake_sent(self, request: web.Request) -> web.Response:
+        since = int(request.query.get("since", 0))
+        return web.json_response(
+            {
+                "next": len(self.sent),
+                "sent": [
+                    {"room_id": m.room_id, "type": m.event_type, "content": m.content}
+                    for m in self.sent[since:]
+                ],
+            }
+        )
+
+    @web.middleware
+    async def _auth(self, request: web.Request, handler):
+        # Any token is accepted. Tokens we handed out at login map to the user
+        # who logged in; any other token is assumed to belong to the bot.
+        token = request.headers.get("Authorization", "")[len("Bearer ") :]
+        token = token or request.query.get("access_token", "")
+        request["user"] = self.tokens.get(token, self.bot_user)
+        return await handler(request)
+
+    def app(self) -> web.Application:
+        app = web.Application(middlewares=[self._auth], client_max_size=100 * 1024**2)
+        client = "/_matrix/client/{version}"
+        app.router.add_post(client + "/login", self.login)
+        app.router.add_get(client + "/sync", self.sync)
+        app.router.add_put(
+            client + "/rooms/{room_id}/send/{event_type}/{txn_id}", self.send
+        )
+        app.router.add_post(client + "/join/{room_id}", self.join)
+        app.router.add_post(client + "/rooms/{room_id}/join", self.join)
+        app.router.add_get(
+            client + "/rooms/{room_id}/joined_members", self.joined_members
+        )
+        app.router.add_post(client + "/user/{user_id}/filter", self.upload_filter)
+        app.router.add_get(
+            client + "/user/{user_id}/filter/{filter_id}", self.get_filter
+        )
+        app.router.add_post(client + "/keys/upload", self.keys_upload)
+        app.router.add_post(client + "/keys/query", self.keys_query)
+        app.router.add_post(client + "/keys/claim", self.keys_claim)
+        app.router.add_put(client + "/sendToDevice/{event_type}/{txn_id}", self.empty)
+        app.router.add_put(client + "/devices/{device_id}", self.empty)
+        app.router.add_post(client + "/logout", self.empty)
+        app.router.add_post("/_matrix/media/{version}/upload", self.upload)
+        app.router.add_post("/_matrix/client/v1/media/upload", self.upload)
+        app.router.add_post("/_fake/rooms/{room_id}/inject", self.fake_inject)
+        app.router.add_get("/_fake/sent", self.fake_sent)
+        return app
+
+    async def start(self, host: str = "127.0.0.1", port: int = 8008) -> web.AppRunner:
+        """Start serving; call cleanup() on the result to stop"""
+        runner = web.AppRunner(self.app(), access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        return runner
+
+
+async def _serve(host: str, port: int, rooms: int):
+    server = FakeHomeserver()
+    for idx in range(rooms):
+        server.create_room(f"!room{idx}:{SERVER_NAME}", [server.bot_user])
+    await server.start(host, port)
+    print(
+        json.dumps(
+            {"homeserver_url": f"http://{host}:{port}", "user_id": server.bot_user}
+        )
+    )
+    while True:
+        await asyncio.sleep(3600)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a fake Matrix homeserver")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8008)
+    parser.add_argument(
+        "--rooms", type=int, default=1, help="Rooms to create with the bot in them"
+    )
+    parsed = parser.parse_args()
+    try:
+        asyncio.run(_serve(parsed.host, parsed.port, parsed.rooms))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
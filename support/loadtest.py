@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+"""End-to-end load test for trappedbot, against a local fake homeserver
+
+Starts the fake homeserver from fakehomeserver.py, writes a config file for it,
+and starts the real bot (`trappedbot bot`) in a separate process.
+Then it injects `echo` commands at a fixed rate, spread across several rooms,
+and matches each reply the bot sends to the command that caused it,
+to measure end-to-end reply latency and throughput.
+
+    python support/loadtest.py --rate 50 --rooms 10 --duration 30
+
+Pass --external to only start the homeserver and write the config,
+and run the bot yourself (e.g. under a profiler) with the printed command.
+Results are printed as JSON.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+import typing
+
+import yaml
+
+from fakehomeserver import SERVER_NAME, FakeHomeserver, SentMessage
+
+
+DRIVER_USER = f"@loaddriver:{SERVER_NAME}"
+
+
+def write_config(directory: str, homeserver_url: str, bot_user: str) -> str:
+    config = {
+        "matrix": {
+            "user_id": bot_user,
+            "user_password": "loadtest",
+            "homeserver_url": homeserver_url,
+            "device_id": "LOADTEST",
+            "device_name": "trappedbot load test",
+            "trust_own_devices": False,
+            "change_device_name": False,
+        },
+        "bot": {"command_prefix": "!t", "trusted_users": [DRIVER_USER]},
+        "storage": {
+            "database_filepath": os.path.join(directory, "bot.db"),
+            "store_filepath": os.path.join(directory, "store"),
+        },
+        "logging": {"level": "WARNING"},
+        "commands": {"echo": {"builtin": "echo", "help": "Echo"}},
+    }
+    path = os.path.join(directory, "trappedbot.config.yml")
+    with open(path, "w") as fp:
+        yaml.safe_dump(config, fp)
+    return path
+
+
+def percentile(values: typing.List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+async def loadtest(
+    rate: float,
+    rooms: int,
+    duration: float,
+    drain: float,
+    port: int,
+    external: bool,
+) -> typing.Dict[str, typing.Any]:
+    server = FakeHomeserver()
+    roomids = [f"!load{idx}:{SERVER_NAME}" for idx in range(rooms)]
+    for roomid in roomids:
+        server.create_room(roomid, [server.bot_user, DRIVER_USER])
+
+    injected: typing.Dict[str, float] = {}
+    latencies: typing.List[float] = []
+
+    def _on_send(message: SentMessage):
+        token = message.content.get("body", "").strip()
+        if (start := injected.pop(token, None)) is not None:
+            latencies.append(message.received - start)
+
+    server.listeners.append(_on_send)
+    runner = await server.start("127.0.0.1", port)
+    homeserver_url = f"http://127.0.0.1:{port}"
+
+    workdir = tempfile.mkdtemp(prefix="trappedbot-loadtest-")
+    configpath = write_config(workdir, homeserver_url, server.bot_user)
+    botcmd = [
+        sys.executable,
+        "-c",
+        "from trappedbot.cmd import main; main()",
+        "bot",
+        configpath,
+    ]
+    bot = None
+    if external:
+        print(f"Start the bot with: {' '.join(botcmd)}", file=sys.stderr)
+    else:
+        bot = await asyncio.create_subprocess_exec(*botcmd)
+
+    try:
+        # Wait for the bot to finish its initial sync and start long polling
+        while server.syncs < 2:
+            if bot and bot.returncode is not None:
+                raise RuntimeError(f"The bot exited with code {bot.returncode}")
+            await asyncio.sleep(0.1)
+
+        sent = 0
+        interval = 1 / rate
+        started = time.perf_counter()
+        while (now := time.perf_counter()) - started < duration:
+            # Catch up if we fell behind, so the offered load stays at rate
+            due = int((now - started) / interval) + 1
+            while sent < due:
+                token = f"load-{sent}"
+                injected[token] = time.perf_counter()
+                roomid = roomids[sent % rooms]
+                await server.inject(roomid, DRIVER_USER, f"!t echo {token}")
+                sent += 1
+            await asyncio.sleep(max(0, started + sent * interval - time.perf_counter()))
+        finished_sending = time.perf_counter()
+
+        deadline = finished_sending + drain
+        while injected and time.perf_counter() < deadline:
+            await asyncio.sleep(0.05)
+        elapsed = time.perf_counter() - started
+    finally:
+        if bot and bot.returncode is None:
+            bot.terminate()
+            await bot.wait()
+        await runner.cleanup()
+
+    return {
+        "rate": rate,
+        "rooms": rooms,
+        "duration": duration,
+        "sent": sent,
+        "replied": len(latencies),
+        "lost": len(injected),
+        "throughput": round(len(latencies) / elapsed, 2),
+        "syncs": server.syncs,
+        "latency_ms": {
+            "mean": round(statistics.mean(latencies) * 1000, 2) if latencies else 0,
+            "p50": round(percentile(latencies, 0.50) * 1000, 2),
+            "p90": round(percentile(latencies, 0.90) * 1000, 2),
+            "p99": round(percentile(latencies, 0.99) * 1000, 2),
+            "max": round(max(latencies, default=0) * 1000, 2),
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Load test trappedbot against a local fake homeserver"
+    )
+    parser.add_argument(
+        "--rate", type=float, default=10, help="Commands to send per second"
+    )
+    parser.add_argument(
+        "--rooms", type=int, default=1, help="Rooms to spread commands across"
+    )
+    parser.add_argument(
+        "--duration", type=float, default=10, help="Seconds to send commands for"
+    )
+    parser.add_argument(
+        "--drain",
+        type=float,
+        default=10,
+        help="Seconds to wait for outstanding replies after sending stops",
+    )
+    parser.add_argument("--port", type=int, default=8008)
+    parser.add_argument(
+        "--external",
+        action="store_true",
+        help="Do not start the bot; wait for one to be started separately",
+    )
+    parsed = parser.parse_args()
+
+    result = asyncio.run(
+        loadtest(
+            parsed.rate,
+            parsed.rooms,
+            parsed.duration,
+            parsed.drain,
+            parsed.port,
+            parsed.external,
+        )
+    )
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
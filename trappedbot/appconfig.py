@@ -3,8 +3,13 @@
 The global application configuration is safe to retrieve with `get()` at any time,
 even immediately after the application starts;
 if the config file has not been read in, it will just return empty/dummy values.
+
+When one process runs several bots, each bot's tasks see that bot's configuration.
+`set_current()` sets the configuration for the running asyncio task
+and any tasks it starts, overriding the global one.
 """
 
+import contextvars
 import typing
 
 from trappedbot.configuration import Configuration
@@ -14,14 +19,25 @@ from trappedbot.configuration import Configuration
 # as it may be None depending on when it is referenced.
 _APPCONFIG: typing.Optional[Configuration] = None
 
+_CURRENT: "contextvars.ContextVar[typing.Optional[Configuration]]" = (
+    contextvars.ContextVar("trappedbot_appconfig", default=None)
+)
+
 
 def get() -> Configuration:
-    """Retrieve the global application configuration"""
-    global _APPCONFIG
-    return _APPCONFIG or Configuration()
+    """Retrieve the application configuration for the current bot"""
+    return _CURRENT.get() or _APPCONFIG or Configuration()
 
 
 def set(conf: Configuration) -> None:
     """Set the global application configuration"""
     global _APPCONFIG
     _APPCONFIG = conf
+
+
+def set_current(conf: Configuration) -> None:
+    """Set the application configuration for the current asyncio task
+
+    Tasks started afterwards from the current task inherit it.
+    """
+    _CURRENT.set(conf)
@@ -1,15 +1,67 @@
 """Global application logger.
 
-Initially the logger has no handlers, and log messages go nowhere.
-It will be replaced by a real logger during application initialization.
+Log records are put on a queue by the logger,
+and written out by a `logging.handlers.QueueListener` on a background thread,
+so that logging never blocks the event loop on a slow stdout.
+
+Log calls on hot paths should use lazy %-style formatting,
+like `LOGGER.debug("Sending %s to %s", message, room_id)`,
+rather than f-strings, so that a disabled level costs almost nothing.
+Anything expensive to compute just for a log line
+should be guarded with `LOGGER.isEnabledFor()`.
 """
 
+import atexit
+import copy
+import datetime
+import json
 import logging
+import logging.handlers
+import queue
 import sys
 
 
 _LOGGER_NAME = "trappedbot"
 
+TEXT_FORMATTER = logging.Formatter(
+    "%(asctime)s | %(name)s [%(levelname)s] %(message)s"
+)
+"""The default log formatter, for people"""
+
+
+class JsonFormatter(logging.Formatter):
+    """Format log records as JSON objects, one per line, for log collectors"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        obj = {
+            "time": datetime.datetime.fromtimestamp(
+                record.created, datetime.timezone.utc
+            ).isoformat(),
+            "logger": record.name,
+            "level": record.levelname,
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            obj["exception"] = self.formatException(record.exc_info)
+        return json.dumps(obj)
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """A QueueHandler that leaves most of the formatting to the listener thread
+
+    The standard QueueHandler formats each record completely before queueing it,
+    so that it can be pickled for a multiprocessing queue.
+    Our queue is in-process, so we only merge the arguments into the message,
+    while they still have the values they were logged with,
+    and leave timestamps, tracebacks and the output format to the listener thread.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
 
 def _init_logger() -> logging.Logger:
     """Initialize the application logger
@@ -18,14 +70,25 @@ def _init_logger() -> logging.Logger:
     After startup, just configure this module's LOGGER directly.
     """
     logger = logging.getLogger(_LOGGER_NAME)
-    formatter = logging.Formatter("%(asctime)s | %(name)s [%(levelname)s] %(message)s")
     logger.setLevel(logging.WARNING)
-    handler = logging.StreamHandler(sys.stdout)
-    handler.setFormatter(formatter)
-    logger.addHandler(handler)
+    logqueue: queue.SimpleQueue = queue.SimpleQueue()
+    logger.addHandler(_QueueHandler(logqueue))
+    listener = logging.handlers.QueueListener(logqueue, _STREAM_HANDLER)
+    listener.start()
+    # Write out anything still queued when the program exits
+    atexit.register(listener.stop)
     return logger
 
 
+_STREAM_HANDLER = logging.StreamHandler(sys.stdout)
+_STREAM_HANDLER.setFormatter(TEXT_FORMATTER)
+
+
+def set_json_format(enabled: bool = True):
+    """Log JSON objects instead of text"""
+    _STREAM_HANDLER.setFormatter(JsonFormatter() if enabled else TEXT_FORMATTER)
+
+
 LOGGER: logging.Logger = _init_logger()
 """The global application logger
 
@@ -1,7 +1,9 @@
 """The bot client.
 """
 
-from time import sleep
+import asyncio
+import time
+import typing
 
 from nio import (
     AsyncClient,
@@ -13,16 +15,114 @@ from nio import (
     LocalProtocolError,
     UpdateDeviceError,
     KeyVerificationEvent,
+    SyncError,
+    SyncResponse,
+    UploadFilterResponse,
+)
+from nio.api import EventFormat
+from aiohttp import (
+    ClientConnectionError,
+    ClientSession,
+    ClientTimeout,
+    ServerDisconnectedError,
 )
-from aiohttp import ServerDisconnectedError, ClientConnectionError
 
 from trappedbot import appconfig
 from trappedbot.applogger import LOGGER
 from trappedbot.callbacks import Callbacks
+from trappedbot.configuration import Configuration
+from trappedbot.feeds import FeedPoller
+from trappedbot.health import ConnectionMonitor
+from trappedbot.keysharing import KEYSHARING_ACTIVE_TTL, KeySharer
+from trappedbot.lowmemory import MemberEvictor
+from trappedbot.metrics import LAST_SYNC_DURATION, SYNC_DURATION, start_metrics_server
+from trappedbot.recording import Recorder
+from trappedbot.scheduler import Scheduler
+from trappedbot.shutdown import DRAIN
 from trappedbot.storage import Storage
+from trappedbot.util import BackgroundTasks, keep_running
+from trappedbot.workers import WorkerPool
+
+
+SYNC_TIMELINE_TYPES = [
+    "m.room.message",
+    "m.room.encrypted",
+    "m.room.member",
+    "m.room.encryption",
+    "m.room.name",
+    "m.room.canonical_alias",
+]
+"""The room timeline events to sync when the sync filter is enabled
+
+Messages, which may be encrypted, are what our callbacks handle.
+Membership and the encryption, name and alias state are needed to keep track of rooms,
+and to share encryption keys with the right devices.
+"""
+
 
+def build_sync_filter(
+    config: Configuration,
+) -> typing.Optional[typing.Dict[str, typing.Any]]:
+    """Return the sync filter for a bot, or None to sync everything
 
-async def botloop():
+    The default filter drops presence, typing notifications, receipts and account data,
+    which the bot never looks at,
+    limits room timelines to SYNC_TIMELINE_TYPES,
+    and lazily loads room members,
+    so that the homeserver only sends the members who sent the events in the sync.
+    (nio loads a room's full member list before sending to it, if it is encrypted.)
+    """
+    if isinstance(config.sync_filter, dict):
+        return config.sync_filter
+    if not config.sync_filter:
+        return None
+    nothing = {"not_types": ["*"]}
+    return {
+        "presence": nothing,
+        "account_data": nothing,
+        "room": {
+            "state": {"lazy_load_members": True},
+            "timeline": {"types": SYNC_TIMELINE_TYPES, "lazy_load_members": True},
+            "ephemeral": nothing,
+            "account_data": nothing,
+        },
+    }
+
+
+async def run_bots(
+    configs: typing.List[Configuration], record: typing.Optional[str] = None
+):
+    """Run one or more bots concurrently on the current event loop
+
+    Each bot has its own client, store and commands, and sees its own configuration
+    from `appconfig.get()`.
+    They share everything else in the process, including running tasks and caches,
+    and when there is more than one bot, a single HTTP session.
+    """
+    if configs[0].metrics_listen:
+        host, port = configs[0].metrics_listen.rsplit(":", 1)
+        await start_metrics_server(host, int(port))
+
+    if len(configs) == 1:
+        await botloop(record, configs[0])
+        return
+
+    if record:
+        raise ValueError("Recording is only supported with a single bot")
+    session = ClientSession(
+        timeout=ClientTimeout(total=AsyncClientConfig().request_timeout)
+    )
+    try:
+        await asyncio.gather(*(botloop(None, c, session) for c in configs))
+    finally:
+        await session.close()
+
+
+async def botloop(
+    record: typing.Optional[str] = None,
+    config: typing.Optional[Configuration] = None,
+    session: typing.Optional[ClientSession] = None,
+):
     """The bot client itself.
 
     Execute an infinite loop, read the app configuration, and listen for Matrix events.
@@ -36,9 +136,19 @@ async def botloop():
     If the application has not been configured before this function runs,
     the bot will not have credentials to connect to the Matrix homeserver,
     and will exit.
+
+    If record is set, every room message the bot receives is also recorded
+    to that file, for `trappedbot replay`.
+
+    If config is set, run the bot with it instead of the global configuration;
+    see `run_bots`.
+    If session is set, the client makes its requests with it, and leaves it open.
     """
 
-    config = appconfig.get()
+    if config:
+        appconfig.set_current(config)
+    else:
+        config = appconfig.get()
     store = Storage(config.database_filepath)
 
     client_config = AsyncClientConfig(
@@ -55,98 +165,215 @@ async def botloop():
         store_path=config.store_filepath,
         config=client_config,
     )
+    if session:
+        client.client_session = session
 
     callbacks = Callbacks(client, store)
-    client.add_event_callback(callbacks.message, (RoomMessage, RoomMessageText,))
+    pool = None
+    keysharing_ttl = KEYSHARING_ACTIVE_TTL
+    if config.low_memory:
+        # Registered first, so that it reloads senders before other callbacks run
+        evictor = MemberEvictor(client, config.low_memory_idle)
+        client.add_event_callback(evictor.message, (RoomMessage,))
+        client.add_response_callback(evictor.synced, SyncResponse)
+        # Do not load the members of rooms back in right after evicting them
+        keysharing_ttl = min(keysharing_ttl, config.low_memory_idle)
+    if config.workers:
+        pool = WorkerPool(client, config, config.workers, callbacks)
+        pool.start()
+        client.add_event_callback(pool.message, (RoomMessage, RoomMessageText,))
+    else:
+        client.add_event_callback(callbacks.message, (RoomMessage, RoomMessageText,))
     client.add_event_callback(callbacks.invite, (InviteMemberEvent,))
     client.add_to_device_callback(callbacks.to_device_cb, (KeyVerificationEvent,))
 
-    while True:
-        try:
+    sync_filter = build_sync_filter(config)
+    sync_filter_id: typing.Optional[str] = None
+
+    recorder = None
+    if record:
+        recorder = Recorder(record, config.user_id)
+        client.add_event_callback(recorder.record, (RoomMessage,))
+
+    # Time the sync requests themselves, including sync_forever's,
+    # which go through the same method
+    untimed_sync = client.sync
+
+    async def _timed_sync(*args, **kwargs):
+        started = time.monotonic()
+        response = await untimed_sync(*args, **kwargs)
+        if isinstance(response, SyncResponse):
+            duration = time.monotonic() - started
+            SYNC_DURATION.observe(duration)
+            LAST_SYNC_DURATION.set(duration)
+        return response
+
+    client.sync = _timed_sync  # type: ignore
+
+    keysharer = KeySharer(client, keysharing_ttl)
+    client.add_event_callback(keysharer.message, (RoomMessage,))
+    client.add_response_callback(keysharer.synced, SyncResponse)
+
+    background = BackgroundTasks("after the first sync")
+
+    async def _after_first_sync():
+        await client.synced.wait()
+        await callbacks.recover_jobs(pool.dispatch if pool else None)
+        # Start them over with a fresh scheduler or poller if they fail,
+        # rather than stop running schedules or polling feeds for good
+        if config.schedules:
+            background.start(
+                keep_running(
+                    "Scheduler",
+                    lambda: Scheduler(config.schedules, store).run(client),
+                )
+            )
+        if config.feeds:
+            background.start(
+                keep_running(
+                    "Feed poller",
+                    lambda: FeedPoller(
+                        config.feeds, store, config.feed_concurrency
+                    ).run(client),
+                )
+            )
+
+    # Only once, since jobs that are running when we reconnect are not interrupted,
+    # and the scheduler keeps running while we reconnect
+    background.start(_after_first_sync())
+
+    monitor = ConnectionMonitor(client)
+    client.add_response_callback(monitor.synced, (SyncResponse, SyncError))
+    started = False
+    # sync_forever finishes handling the events it has already received,
+    # and then returns, instead of syncing again
+    DRAIN.on_drain(client.stop_sync_forever)
+
+    try:
+        while not DRAIN.draining:
             try:
-                if config.user_access_token:
-                    LOGGER.debug("Using access token from config file to log in.")
-                    client.restore_login(
-                        user_id=config.user_id,
-                        device_id=config.device_id,
-                        access_token=config.user_access_token,
-                    )
+                try:
+                    if client.logged_in:
+                        LOGGER.debug("Still logged in, reconnecting.")
+                    elif config.user_access_token:
+                        LOGGER.debug("Using access token from config file to log in.")
+                        client.restore_login(
+                            user_id=config.user_id,
+                            device_id=config.device_id,
+                            access_token=config.user_access_token,
+                        )
 
-                else:
-                    LOGGER.debug("Using password from config file to log in.")
-                    login_response = await client.login(
-                        password=config.user_password,
-                        device_name=config.device_name,
-                    )
+                    else:
+                        LOGGER.debug("Using password from config file to log in.")
+                        login_response = await client.login(
+                            password=config.user_password,
+                            device_name=config.device_name,
+                        )
 
-                    # Check if login failed
-                    if type(login_response) == LoginError:
-                        LOGGER.error("Failed to login: " f"{login_response.message}")
-                        return False
-                    LOGGER.debug(
-                        f'access_token of device {config.device_name} is: "{login_response.access_token}"'
+                        # Check if login failed
+                        if type(login_response) == LoginError:
+                            LOGGER.error("Failed to login: " f"{login_response.message}")
+                            return False
+                        LOGGER.debug(
+                            f'access_token of device {config.device_name} is: "{login_response.access_token}"'
+                        )
+                        LOGGER.debug(f"Full login_response: {login_response}")
+
+                except LocalProtocolError as exc:
+                    # There's an edge case here where the user hasn't installed
+                    # the correct C dependencies. In that case, a
+                    # LocalProtocolError is raised on login.
+                    LOGGER.critical(
+                        "Failed to login. "
+                        "Have you installed the correct dependencies? "
+                        "https://github.com/poljar/matrix-nio#installation "
+                        f"Error: {exc}",
                     )
-                    LOGGER.debug(f"Full login_response: {login_response}")
-
-            except LocalProtocolError as exc:
-                # There's an edge case here where the user hasn't installed
-                # the correct C dependencies. In that case, a
-                # LocalProtocolError is raised on login.
-                LOGGER.critical(
-                    "Failed to login. "
-                    "Have you installed the correct dependencies? "
-                    "https://github.com/poljar/matrix-nio#installation "
-                    f"Error: {exc}",
+                    return False
+
+                LOGGER.debug(
+                    f"Logged in successfully as user {config.user_id} "
+                    f"with device {config.device_id}."
                 )
-                return False
 
-            LOGGER.debug(
-                f"Logged in successfully as user {config.user_id} "
-                f"with device {config.device_id}."
-            )
+                # Sync encryption keys with the server
+                # Required for participating in encrypted rooms
+                if client.should_upload_keys:
+                    await client.keys_upload()
 
-            # Sync encryption keys with the server
-            # Required for participating in encrypted rooms
-            if client.should_upload_keys:
-                await client.keys_upload()
-
-            if config.change_device_name:
-                content = {"display_name": config.device_name}
-                resp = await client.update_device(config.device_id, content)
-                if isinstance(resp, UpdateDeviceError):
-                    LOGGER.critical(f"update_device failed with {resp}")
-                else:
-                    LOGGER.debug(f"update_device successful with {resp}")
-
-            if config.trust_own_devices:
-                await client.sync(timeout=30000, full_state=True)
-                # Trust your own devices automatically.
-                # Log it so it can be manually checked
-                for device_id, olm_device in client.device_store[
-                    config.user_id
-                ].items():
-                    LOGGER.info(
-                        f"My other devices are: device_id={device_id}, olm_device={olm_device}."
-                    )
-                    LOGGER.info(
-                        f"Setting up trust for my own device {device_id} and session key {olm_device.keys['ed25519']}."
-                    )
-                    client.verify_device(olm_device)
+                if config.change_device_name:
+                    content = {"display_name": config.device_name}
+                    resp = await client.update_device(config.device_id, content)
+                    if isinstance(resp, UpdateDeviceError):
+                        LOGGER.critical(f"update_device failed with {resp}")
+                    else:
+                        LOGGER.debug(f"update_device successful with {resp}")
 
-            LOGGER.info("Running actions for 'botstartup' event, if any...")
-            botstartup = config.events.get('botstartup', None)
-            if botstartup:
-                await botstartup(client)
+                if sync_filter and not sync_filter_id:
+                    # The config only allows keys that upload_filter takes
+                    filter_kwargs = dict(sync_filter)
+                    if "event_format" in filter_kwargs:
+                        filter_kwargs["event_format"] = EventFormat(
+                            filter_kwargs["event_format"]
+                        )
+                    resp = await client.upload_filter(**filter_kwargs)
+                    if isinstance(resp, UploadFilterResponse):
+                        sync_filter_id = resp.filter_id
+                        LOGGER.debug(f"Uploaded sync filter {sync_filter_id}")
+                    else:
+                        # Homeservers also accept the filter inline, in each sync
+                        LOGGER.warning(
+                            f"Unable to upload sync filter, sending it inline: {resp}"
+                        )
+                filter_param = sync_filter_id or sync_filter
+
+                if config.trust_own_devices:
+                    await client.sync(
+                        timeout=30000, sync_filter=filter_param, full_state=True
+                    )
+                    # Trust your own devices automatically.
+                    # Log it so it can be manually checked
+                    for device_id, olm_device in client.device_store[
+                        config.user_id
+                    ].items():
+                        LOGGER.info(
+                            f"My other devices are: device_id={device_id}, olm_device={olm_device}."
+                        )
+                        LOGGER.info(
+                            f"Setting up trust for my own device {device_id} and session key {olm_device.keys['ed25519']}."
+                        )
+                        client.verify_device(olm_device)
 
-            LOGGER.info("Running nio AsyncClient.sync_forever()...")
-            # await client.sync_forever(timeout=30000, full_state=True)
-            await client.sync_forever(timeout=30000)
+                if not started:
+                    started = True
+                    LOGGER.info("Running actions for 'botstartup' event, if any...")
+                    botstartup = config.events.get('botstartup', None)
+                    if botstartup:
+                        await botstartup(client)
 
-        except (ClientConnectionError, ServerDisconnectedError):
-            LOGGER.warning("Unable to connect to homeserver, retrying in 15s...")
+                LOGGER.info("Running nio AsyncClient.sync_forever()...")
+                # await client.sync_forever(timeout=30000, full_state=True)
+                await client.sync_forever(timeout=30000, sync_filter=filter_param)
 
-            # Sleep so we don't bombard the server with login requests
-            sleep(15)
-        finally:
-            # Make sure to close the client connection on disconnect
+            except (
+                ClientConnectionError,
+                ServerDisconnectedError,
+                asyncio.TimeoutError,
+            ):
+                # Keep the client, its session and its connection pool,
+                # and wait without blocking the event loop
+                await monitor.wait_to_reconnect()
+        # Scheduled commands may still be running, and need the client to reply
+        await DRAIN.wait_idle(config.shutdown_timeout)
+    finally:
+        # Make sure to close the client connection when the bot stops,
+        # unless it is shared with other bots
+        if not session:
             await client.close()
+        if callbacks.jobs:
+            callbacks.jobs.flush()
+        if recorder:
+            recorder.close()
+        if pool:
+            pool.stop()
+        store.close()
@@ -5,7 +5,10 @@
 `nio.AsyncClient` object it uses.
 """
 
+import asyncio
+import logging
 import traceback
+import typing
 
 from nio import (
     JoinError,
@@ -17,14 +20,20 @@ from nio import (
     LocalProtocolError,
 )
 from nio.client.async_client import AsyncClient
-from nio.events.room_events import RoomMessageText
+from nio.events.room_events import Event, RoomMessageText
 from nio.rooms import MatrixRoom
 
 from trappedbot import appconfig
 from trappedbot.applogger import LOGGER
 from trappedbot.chat_functions import send_text_to_room
 from trappedbot.commands.command import process_command
+from trappedbot.jobs import JobQueue
+from trappedbot.metrics import EVENTS_RECEIVED
+from trappedbot.ratelimit import RateLimitDecision
+from trappedbot.replyorder import ReplyOrder, Turn, taking
+from trappedbot.shutdown import DRAIN
 from trappedbot.storage import Storage
+from trappedbot.tracing import trace_event
 from trappedbot.tasks.builtin import BUILTIN_TASKS
 
 
@@ -36,8 +45,14 @@ def msglog(logline: str, room: MatrixRoom, event: RoomMessageText):
     TODO: Consider NOT logging message contents unless passing a special flag?
         Logging messages by default might not be what people expect.
     """
+    if not LOGGER.isEnabledFor(logging.DEBUG):
+        return
     LOGGER.debug(
-        f"{logline} % {room.display_name} | {room.user_name(event.sender)}: {event.body}"
+        "%s %% %s | %s: %s",
+        logline,
+        room.display_name,
+        room.user_name(event.sender),
+        event.body,
     )
 
 
@@ -73,23 +88,79 @@ class Callbacks(object):
         """
         self.client = client
         self.store = store
+        self.jobs = JobQueue(store) if store else None
+        self.replies = ReplyOrder()
+        # Keep references to messages being handled, so they are not garbage collected
+        self._handling: typing.Set[asyncio.Future] = set()
 
     async def message(self, room: MatrixRoom, event: RoomMessageText):
         """Handle an incoming message event.
 
         room:   The room the event came from
         event:  The event defining the message
+
+        nio waits for each callback before it runs the next one,
+        so this only starts handling the message, and returns.
+        """
+        EVENTS_RECEIVED.inc(type(event).__name__)
+        self.handle(room, event)
+
+    def handle(
+        self,
+        room: MatrixRoom,
+        event: RoomMessageText,
+        ratelimit: typing.Optional[RateLimitDecision] = None,
+    ) -> asyncio.Future:
+        """Handle a message in the background, and return its task
+
+        Messages are handled concurrently, but replies to each room are sent
+        in the order the messages were received, unless an earlier command
+        is taking a long time; see `trappedbot.replyorder`.
+        If ratelimit is set, it is passed on to `process_command`.
         """
+        DRAIN.begin()
+        future = asyncio.ensure_future(
+            self._handle(room, event, self.replies.take(room.room_id), ratelimit)
+        )
+        self._handling.add(future)
+        future.add_done_callback(self._handled)
+        return future
+
+    def _handled(self, future: asyncio.Future):
+        self._handling.discard(future)
+        DRAIN.end()
+        if not future.cancelled() and (exc := future.exception()) is not None:
+            LOGGER.error(
+                "Error handling message", exc_info=(type(exc), exc, exc.__traceback__)
+            )
+
+    async def _handle(
+        self,
+        room: MatrixRoom,
+        event: RoomMessageText,
+        turn: Turn,
+        ratelimit: typing.Optional[RateLimitDecision],
+    ):
+        with taking(turn):
+            with trace_event(event.event_id, room.room_id, event.server_timestamp):
+                await self._message(room, event, ratelimit)
+
+    async def _message(
+        self,
+        room: MatrixRoom,
+        event: RoomMessageText,
+        ratelimit: typing.Optional[RateLimitDecision],
+    ):
         config = appconfig.get()
 
-        LOGGER.debug(f"Responding to a message from {event.sender}...")
+        LOGGER.debug("Responding to a message from %s...", event.sender)
 
         if event.sender == self.client.user:
             msglog("Ignoring message from myself", room, event)
             return
         elif event.body.startswith(config.command_prefix):
             msg = event.body[len(config.command_prefix) :]
-            await process_command(self.client, msg, room, event)
+            await process_command(self.client, msg, room, event, self.jobs, ratelimit)
             return
         else:
             for response in config.responses:
@@ -103,12 +174,55 @@ class Callbacks(object):
                     )
             return
 
+    async def recover_jobs(
+        self,
+        resume: typing.Optional[
+            typing.Callable[[MatrixRoom, RoomMessageText], typing.Any]
+        ] = None,
+    ):
+        """Handle commands that had not finished when the bot last stopped
+
+        If the bot is configured to resume jobs, run them again,
+        and otherwise, tell the users who ran them that they did not finish.
+        Commands are run again by passing their messages to resume,
+        which defaults to `handle`.
+
+        Call this after the client has synced, so that it knows about the rooms.
+        """
+        if not self.jobs:
+            return
+        config = appconfig.get()
+        for job in self.jobs.unfinished():
+            LOGGER.info(
+                "Command %s from %s in %s was interrupted (%s)",
+                job.command,
+                job.sender,
+                job.room_id,
+                job.state.name,
+            )
+            event = Event.parse_event(job.event)
+            room = self.client.rooms.get(job.room_id)
+            if config.resume_jobs and room and isinstance(event, RoomMessageText):
+                await send_text_to_room(
+                    self.client,
+                    job.room_id,
+                    f"Running command {job.command} for {job.sender} again, since the bot restarted before it finished.",
+                )
+                (resume or self.handle)(room, event)
+            else:
+                await send_text_to_room(
+                    self.client,
+                    job.room_id,
+                    f"The bot restarted before command {job.command} for {job.sender} finished.",
+                )
+
     async def invite(self, room, event):
         """Handle an incoming invite event.
 
         If an invite is received, then join the room specified in the invite.
         """
-        LOGGER.debug(f"Got invite to {room.room_id} from {event.sender}.")
+        EVENTS_RECEIVED.inc(type(event).__name__)
+        LOGGER.debug("Got invite to %s from %s.", room.room_id, event.sender)
 
         # Attempt to join 3 times before giving up
         for attempt in range(3):
@@ -134,10 +248,11 @@ class Callbacks(object):
         It will accept an incoming Emoji verification requests
         and follow the verification protocol.
         """
+        EVENTS_RECEIVED.inc(type(event).__name__)
         try:
             client = self.client
             LOGGER.debug(
-                f"Device Event of type {type(event)} received in " "to_device_cb()."
+                "Device Event of type %s received in to_device_cb().", type(event)
             )
 
             if isinstance(event, KeyVerificationStart):  # first step
@@ -10,20 +10,27 @@ This file implements utility functions for
 
 import html
 import os
+import tempfile
+import time
 import traceback
 import typing
 
 import aiofiles.os
 import magic
 from markdown import markdown
-from nio import SendRetryError, UploadResponse
+from nio import RoomSendResponse, SendRetryError, UploadResponse
 from PIL import Image
 from nio.client.async_client import AsyncClient
 from nio.events.room_events import RoomMessageText
 from nio.rooms import MatrixRoom
 
+from trappedbot import appconfig
 from trappedbot.applogger import LOGGER
+from trappedbot.metrics import ROOM_SEND_FAILURES, ROOM_SEND_LATENCY
 from trappedbot.mxutil import MessageFormat
+from trappedbot.replyorder import wait_turn
+from trappedbot.splitting import split_by_size
+from trappedbot.tracing import span
 
 
 def reply_fallback_html_from_message(
@@ -54,6 +61,73 @@ def reply_fallback_text_from_message(
     return fallback
 
 
+def text_content(
+    message: str,
+    notice: bool = True,
+    format: typing.Optional[MessageFormat] = MessageFormat.NATURAL,
+) -> typing.Dict[str, typing.Any]:
+    """Build the content of a text message event
+
+    message: The message content
+    notice: Whether the message should be sent with an
+        "m.notice" message type (will not ping users)
+    format: The format for the message
+    """
+    # Determine whether to ping room members or not
+    msgtype = "m.notice" if notice else "m.text"
+
+    content: typing.Dict[str, typing.Any] = {
+        "msgtype": msgtype,
+        "body": message,
+    }
+    if format == MessageFormat.FORMATTED:
+        content["format"] = "org.matrix.custom.html"
+        content["formatted_body"] = message
+    elif format == MessageFormat.MARKDOWN:
+        content["format"] = "org.matrix.custom.html"
+        content["formatted_body"] = markdown(message)
+    elif format == MessageFormat.CODE:
+        content["format"] = "org.matrix.custom.html"
+        content["formatted_body"] = "<pre><code>" + message + "\n</code></pre>\n"
+        # next line: work-around for Element on Android
+        content["body"] = "```\n" + message + "\n```"  # to format it as code
+    else:
+        pass
+    return content
+
+
+async def send_content_to_room(
+    client: AsyncClient,
+    room_id: str,
+    content: typing.Dict[str, typing.Any],
+) -> typing.Optional[str]:
+    """Send a message event to a matrix room.
+
+    Return the event ID of the sent message, or None if sending failed.
+    """
+    await wait_turn(room_id)
+    started = time.perf_counter()
+    try:
+        with span("room_send"):
+            resp = await client.room_send(
+                room_id,
+                "m.room.message",
+                content,
+                ignore_unverified_devices=True,
+            )
+    except SendRetryError:
+        ROOM_SEND_FAILURES.inc()
+        LOGGER.exception(f"Unable to send message response to {room_id}")
+        return None
+    finally:
+        ROOM_SEND_LATENCY.observe(time.perf_counter() - started)
+    if isinstance(resp, RoomSendResponse):
+        return resp.event_id
+    ROOM_SEND_FAILURES.inc()
+    LOGGER.error(f"Unable to send message response to {room_id}: {resp}")
+    return None
+
+
 async def send_text_to_room(
     client: AsyncClient,
     room_id: str,
@@ -63,7 +137,7 @@ async def send_text_to_room(
     split: typing.Optional[str] = None,
     replyto: typing.Optional[RoomMessageText] = None,
     replyto_room: typing.Optional[MatrixRoom] = None,
-):
+) -> typing.Optional[str]:
     """Send text to a matrix room.
 
     Arguments:
@@ -77,85 +151,175 @@ async def send_text_to_room(
     split: if set, split the message into multiple messages wherever
         the string specified in split occurs
         Defaults to None
+
+    Messages that are too large to fit into a single event are also split,
+    according to the max_event_size setting.
+    If splitting by size would take more than max_messages messages,
+    not counting the ones that split asks for,
+    the message is uploaded as a file attachment instead.
+    A reply quotes the message it replies to, unless that would take up
+    more than half of max_event_size.
+
+    Returns the event ID of the last message sent, if any.
     """
-    LOGGER.debug(f"send_text_to_room {room_id} {message}")
+    LOGGER.debug("send_text_to_room %s %s", room_id, message)
+    config = appconfig.get()
+    max_event_size = config.max_event_size
+    fallback = False
+    if replyto:
+        # The reply fallback quotes the original message in the body and the HTML
+        quoted = 2 * len(replyto.body.encode())
+        # Clients do not need the fallback, so leave it out
+        # rather than leave too little room for the reply itself
+        if quoted <= max_event_size // 2:
+            fallback = True
+            max_event_size -= quoted
+
     messages = []
-    if split:
-        for paragraph in message.split(split):
-            # strip again to get get rid of leading/trailing newlines and
-            # whitespaces left over from previous split
-            if paragraph.strip() != "":
-                messages.append(paragraph)
-    else:
-        messages.append(message)
+    paragraphs = 0
+    with span("render", size=len(message)):
+        if split:
+            for paragraph in message.split(split):
+                # strip again to get get rid of leading/trailing newlines and
+                # whitespaces left over from previous split
+                if paragraph.strip() != "":
+                    messages += split_by_size(paragraph, max_event_size, format)
+                    paragraphs += 1
+        else:
+            messages += split_by_size(message, max_event_size, format)
+            paragraphs = 1
 
-    for message in messages:
-        # Determine whether to ping room members or not
-        msgtype = "m.notice" if notice else "m.text"
+    # Splitting explicitly is what the caller asked for,
+    # so only the messages that splitting by size adds count toward max_messages
+    bysize = len(messages) - paragraphs + 1
+    if config.max_messages and bysize > config.max_messages:
+        LOGGER.debug(
+            "send_text_to_room would need %s messages, sending as a file instead",
+            len(messages),
+        )
+        await send_text_as_file_to_room(
+            client,
+            room_id,
+            message,
+            format,
+            replyto_event_id=replyto.event_id if replyto else None,
+        )
+        return None
 
-        content: typing.Dict[str, typing.Any] = {
-            "msgtype": msgtype,
-            "body": message,
-        }
-        if format == MessageFormat.FORMATTED:
-            content["format"] = "org.matrix.custom.html"
-            content["formatted_body"] = message
-        elif format == MessageFormat.MARKDOWN:
-            content["format"] = "org.matrix.custom.html"
-            content["formatted_body"] = markdown(message)
-        elif format == MessageFormat.CODE:
-            content["format"] = "org.matrix.custom.html"
-            content["formatted_body"] = "<pre><code>" + message + "\n</code></pre>\n"
-            # next line: work-around for Element on Android
-            content["body"] = "```\n" + message + "\n```"  # to format it as code
-        else:
-            pass
+    event_id = None
+    for message in messages:
+        content = text_content(message, notice=notice, format=format)
 
         if (replyto and not replyto_room) or (not replyto and replyto_room):
             LOGGER.error(
                 f"send_text_to_room was passed only one of replyto and replyto_room, NOT sending message as reply"
             )
         elif replyto and replyto_room:
-            LOGGER.debug(f"send_text_to_room replying to message {replyto.event_id}")
-
-            # If there was no HTML-formatted body in the original message,
-            # build one from the unformatted body.
-            if (
-                not content.get("formatted_body")
-                or content.get("format") != "org.matrix.custom.html"
-            ):
-                content["format"] = "org.matrix.custom.html"
-                content["formatted_body"] = html.escape(content["body"])
-
-            content["body"] = (
-                reply_fallback_text_from_message(replyto.sender, replyto.body)
-                + content["body"]
-            )
-            content["formatted_body"] = (
-                reply_fallback_html_from_message(
-                    replyto_room.canonical_alias or replyto_room.room_id,
-                    replyto.event_id,
-                    replyto.sender,
-                    replyto_room.user_name(replyto.sender) or replyto.sender,
-                    replyto.body,
+            LOGGER.debug("send_text_to_room replying to message %s", replyto.event_id)
+
+            if fallback:
+                # If there was no HTML-formatted body in the original message,
+                # build one from the unformatted body.
+                if (
+                    not content.get("formatted_body")
+                    or content.get("format") != "org.matrix.custom.html"
+                ):
+                    content["format"] = "org.matrix.custom.html"
+                    content["formatted_body"] = html.escape(content["body"])
+
+                content["body"] = (
+                    reply_fallback_text_from_message(replyto.sender, replyto.body)
+                    + content["body"]
+                )
+                content["formatted_body"] = (
+                    reply_fallback_html_from_message(
+                        replyto_room.canonical_alias or replyto_room.room_id,
+                        replyto.event_id,
+                        replyto.sender,
+                        replyto_room.user_name(replyto.sender) or replyto.sender,
+                        replyto.body,
+                    )
+                    + content["formatted_body"]
                 )
-                + content["formatted_body"]
-            )
             content["m.relates_to"] = {
                 "m.in_reply_to": {
                     "event_id": replyto.event_id,
                 }
             }
 
-        try:
-            await client.room_send(
-                room_id,
-                "m.room.message",
-                content,
-                ignore_unverified_devices=True,
-            )
-        except SendRetryError:
-            LOGGER.exception(f"Unable to send message response to {room_id}")
+        event_id = await send_content_to_room(client, room_id, content)
+    return event_id
+
+
+async def edit_text_in_room(
+    client: AsyncClient,
+    room_id: str,
+    event_id: str,
+    message: str,
+    notice: bool = True,
+    format: typing.Optional[MessageFormat] = MessageFormat.NATURAL,
+) -> typing.Optional[str]:
+    """Replace the content of a message we sent earlier with an m.replace edit.
+
+    Arguments:
+    ---------
+    client: The client to communicate with Matrix
+    room_id: The ID of the room the original message was sent to
+    event_id: The event ID of the original message
+    message: The new message content
+    notice: Whether the message should be sent with an
+        "m.notice" message type (will not ping users)
+    format: The format for the message
+
+    Returns the event ID of the edit event, if it was sent.
+    """
+    new_content = text_content(message, notice=notice, format=format)
+    # Clients that don't understand edits show the fallback body,
+    # which by convention is prefixed with an asterisk.
+    content = dict(new_content)
+    content["body"] = "* " + new_content["body"]
+    if "formatted_body" in new_content:
+        content["formatted_body"] = "* " + new_content["formatted_body"]
+    content["m.new_content"] = new_content
+    content["m.relates_to"] = {
+        "rel_type": "m.replace",
+        "event_id": event_id,
+    }
+    return await send_content_to_room(client, room_id, content)
+
+
+async def send_text_as_file_to_room(
+    client: AsyncClient,
+    room_id: str,
+    message: str,
+    format: typing.Optional[MessageFormat] = MessageFormat.NATURAL,
+    filename: str = "output",
+    replyto_event_id: typing.Optional[str] = None,
+):
+    """Upload text to the server and send it to a room as a file attachment
+
+    Useful for output that is too large to send as a handful of messages.
+
+    Arguments:
+    ---------
+    client: The client to communicate with Matrix
+    room_id: The ID of the room to send the file to
+    message: The text content of the file
+    format: The format of the text, used to pick a file extension
+    filename: The name of the file, without an extension
+    replyto_event_id: If set, send the file as a reply to this event
+    """
+    if format == MessageFormat.FORMATTED:
+        extension = "html"
+    elif format == MessageFormat.MARKDOWN:
+        extension = "md"
+    else:
+        extension = "txt"
+    with tempfile.TemporaryDirectory() as tempdir:
+        path = os.path.join(tempdir, f"{filename}.{extension}")
+        async with aiofiles.open(path, "w") as f:
+            await f.write(message)
+        await send_file_to_room(client, room_id, path, replyto_event_id)
 
 
 async def send_image_to_room(client, room_id, image):
@@ -254,6 +418,7 @@ async def send_image_to_rooms(client, rooms, image):
 
     try:
         for room_id in rooms:
+            await wait_turn(room_id)
             await client.room_send(
                 room_id, message_type="m.room.message", content=content
             )
@@ -265,7 +430,7 @@ async def send_image_to_rooms(client, rooms, image):
         LOGGER.debug(traceback.format_exc())
 
 
-async def send_file_to_room(client, room_id, file):
+async def send_file_to_room(client, room_id, file, replyto_event_id=None):
     """Send file to single room.
 
     Arguments:
@@ -273,13 +438,14 @@ async def send_file_to_room(client, room_id, file):
     client (nio.AsyncClient): The client to communicate with Matrix
     room_id (str): The ID of the room to send the file to
     file (str): file name/path of file
+    replyto_event_id (str): if set, send the file as a reply to this event
 
     """
     LOGGER.debug(f"send_file_to_room {room_id} {file}")
-    await send_file_to_rooms(client, [room_id], file)
+    await send_file_to_rooms(client, [room_id], file, replyto_event_id)
 
 
-async def send_file_to_rooms(client, rooms, file):
+async def send_file_to_rooms(client, rooms, file, replyto_event_id=None):
     """Send file to multiple rooms.
 
     Upload file to server and then send link to rooms.
@@ -298,6 +464,7 @@ async def send_file_to_rooms(client, rooms, file):
     room_id (str): The ID of the room to send the file to
     rooms (list): list of room_id-s
     file (str): file name/path of file
+    replyto_event_id (str): if set, send the file as a reply to this event
 
     This is a working example for a PDF file.
     It can be viewed or downloaded from:
@@ -384,6 +551,7 @@ async def send_file_to_rooms(client, rooms, file):
             f'filessize="{file_stat.st_size}"'
             f"Failed to upload: {resp}"
         )
+        return
 
     # determine msg_type:
     if mime_type.startswith("audio/"):
@@ -402,9 +570,12 @@ async def send_file_to_rooms(client, rooms, file):
         "msgtype": msg_type,
         "url": resp.content_uri,
     }
+    if replyto_event_id:
+        content["m.relates_to"] = {"m.in_reply_to": {"event_id": replyto_event_id}}
 
     try:
         for room_id in rooms:
+            await wait_turn(room_id)
             await client.room_send(
                 room_id, message_type="m.room.message", content=content
             )
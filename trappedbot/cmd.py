@@ -3,6 +3,7 @@
 import argparse
 import asyncio
 import getpass
+import json
 import logging
 import os
 import sys
@@ -13,9 +14,11 @@ import requests
 
 from trappedbot import appconfig, util
 from trappedbot.applogger import LOGGER
-from trappedbot.botclient import botloop
-from trappedbot.configparser import parse_config
+from trappedbot.botclient import run_bots
+from trappedbot.configparser import parse_config, parse_configs
 from trappedbot.constants import HELP_TRAPPED_MSG
+from trappedbot.recording import replay
+from trappedbot.shutdown import install_signal_handlers
 from trappedbot.tasks.builtin import BUILTIN_TASKS
 from trappedbot.version import version_cute
 
@@ -77,6 +80,33 @@ def parseargs(arguments: typing.List[str]) -> argparse.Namespace:
     sub_bot.add_argument(
         "configpath", type=ExistingResolvedPath, help="Path to the config file"
     )
+    sub_bot.add_argument(
+        "--record",
+        help="Record the messages the bot receives to this file, for the replay command",
+    )
+
+    sub_replay = subparsers.add_parser(
+        "replay",
+        help="Replay messages recorded with 'bot --record' through the bot, without connecting to a homeserver, and report on performance",
+    )
+    sub_replay.add_argument(
+        "configpath", type=ExistingResolvedPath, help="Path to the config file"
+    )
+    sub_replay.add_argument(
+        "recording", type=ExistingResolvedPath, help="Path to the recording"
+    )
+    sub_replay.add_argument(
+        "--speed",
+        type=float,
+        default=1.0,
+        help="How many times faster than real time to replay; 0 means as fast as possible. Default 1.",
+    )
+    sub_replay.add_argument(
+        "--latency",
+        type=float,
+        default=0.0,
+        help="Simulated homeserver latency in seconds for each message the bot sends",
+    )
 
     # sub_builtins =
     subparsers.add_parser("builtin-tasks", help="List built in tasks")
@@ -127,9 +157,16 @@ def main(arguments: typing.List[str] = sys.argv[1:]):
         sys.exit(0)
 
     elif parsed.action == "bot":
-        appconfig.set(parse_config(parsed.configpath, force_log_debug))
+        configs = parse_configs(parsed.configpath, force_log_debug)
+        appconfig.set(configs[0])
+        loop = asyncio.get_event_loop()
+        bots = asyncio.ensure_future(run_bots(configs, parsed.record))
+        install_signal_handlers(bots, configs[0].shutdown_timeout)
         try:
-            asyncio.get_event_loop().run_until_complete(botloop())
+            loop.run_until_complete(bots)
+        except asyncio.CancelledError:
+            LOGGER.info("Stopped")
+            sys.exit(0)
         except KeyboardInterrupt:
             LOGGER.debug("Received keyboard interrupt, exiting...")
             sys.exit(0)
@@ -139,6 +176,13 @@ def main(arguments: typing.List[str] = sys.argv[1:]):
             )
             sys.exit(1)
 
+    elif parsed.action == "replay":
+        appconfig.set(parse_config(parsed.configpath, force_log_debug))
+        report = asyncio.get_event_loop().run_until_complete(
+            replay(parsed.recording, parsed.speed, parsed.latency)
+        )
+        print(json.dumps(report, indent=2))
+
     elif parsed.action == "builtin-tasks":
         print("The following tasks are built-in to the bot:")
         for k, v in BUILTIN_TASKS.items():
@@ -17,4 +17,27 @@ BUILTIN_COMMANDS = {
         help="Show bot version",
         allow_untrusted=True,
     ),
+    "more": Command(
+        "more",
+        BUILTIN_TASKS["more"],
+        help="Show the next page of your last command's output",
+        allow_untrusted=True,
+    ),
+    "next": Command(
+        "next",
+        BUILTIN_TASKS["more"],
+        help="Show the next page of your last command's output",
+        allow_untrusted=True,
+    ),
+    "cancel": Command(
+        "cancel",
+        BUILTIN_TASKS["cancel"],
+        help="Cancel your running commands in this room, or a named command",
+        allow_untrusted=True,
+    ),
+    "stats": Command(
+        "stats",
+        BUILTIN_TASKS["stats"],
+        help="Show runtime performance figures (trusted users only)",
+    ),
 }
@@ -5,9 +5,16 @@ and `whoami`? Have a close look at them and style your commands after these
 example commands.
 """
 
+import asyncio
+import contextvars
+import enum
+import functools
+import inspect
+import math
 import shlex
+import time
 import traceback
-from typing import List, Optional
+from typing import AbstractSet, Any, Awaitable, Callable, List, Optional
 
 from nio import AsyncClient
 from nio.events.room_events import RoomMessageText
@@ -15,9 +22,40 @@ from nio.rooms import MatrixRoom
 
 from trappedbot import appconfig
 from trappedbot.applogger import LOGGER
+from trappedbot.jobs import Job, JobQueue
+from trappedbot.metrics import (
+    COMMANDS_DISPATCHED,
+    RATELIMIT_BACKOFFS,
+    TASK_ERRORS,
+    TASK_LATENCY,
+)
 from trappedbot.mxutil import MessageFormat, Mxid
 from trappedbot.chat_functions import send_text_to_room
+from trappedbot.pager import send_paged_text_to_room
+from trappedbot.ratelimit import RateLimitDecision
+from trappedbot.replyorder import start_turn, wait_turn
+from trappedbot.streaming import aiter_chunks, send_task_chunks, stream_task_output
+from trappedbot.tasks.running import RUNNING
+from trappedbot.tasks.singleflight import SINGLEFLIGHT
 from trappedbot.tasks.task import Task, TaskMessageContext
+from trappedbot.tracing import record, span
+
+
+class Authorization(enum.Enum):
+    """Why a user may (or may not) run a command
+
+    TRUSTED:    The user is in the list of trusted users
+    UNTRUSTED:  The command allows untrusted invocation
+    HOMESERVER: The command allows users from the user's homeserver
+    USER:       The command allows the user explicitly
+    DENIED:     None of the above
+    """
+
+    TRUSTED = enum.auto()
+    UNTRUSTED = enum.auto()
+    HOMESERVER = enum.auto()
+    USER = enum.auto()
+    DENIED = enum.auto()
 
 
 class Command(object):
@@ -29,6 +67,9 @@ class Command(object):
     allow_untrusted: Allow any user to run this command?
     allow_homeservers: Allow any user from these homeservers to run this command?
     allow_users: Allow any user in this list to run this command?
+
+    The allow lists are indexed as sets when the command is created,
+    so that authorizing a user takes constant time however long they are.
     """
 
     def __init__(
@@ -48,6 +89,32 @@ class Command(object):
         self.allow_untrusted = allow_untrusted
         self.allow_homeservers = allow_homeservers or []
         self.allow_users = allow_users or []
+        self._allow_homeservers = frozenset(self.allow_homeservers)
+        self._allow_users = frozenset(self.allow_users)
+
+    def authorize(
+        self, sender: Mxid, trusted_users: AbstractSet[str]
+    ) -> Authorization:
+        """Decide whether a user may run this command"""
+        if sender.mxid in trusted_users:
+            return Authorization.TRUSTED
+        elif self.allow_untrusted:
+            return Authorization.UNTRUSTED
+        elif sender.homeserver in self._allow_homeservers:
+            return Authorization.HOMESERVER
+        elif sender.mxid in self._allow_users:
+            return Authorization.USER
+        return Authorization.DENIED
+
+
+def split_command(input: str) -> List[str]:
+    """Split a command into its name and arguments"""
+    cmdsplit = shlex.split(input)
+    if cmdsplit:
+        # Always use lower case for the command name
+        # (No reason to allow commands like 'host' and 'Host' to be different, right?)
+        cmdsplit[0] = cmdsplit[0].lower()
+    return cmdsplit
 
 
 async def process_command(
@@ -55,20 +122,26 @@ async def process_command(
     input: str,
     room: MatrixRoom,
     event: RoomMessageText,
+    jobs: Optional[JobQueue] = None,
+    ratelimit: Optional[RateLimitDecision] = None,
 ) -> None:
-    """Process the command."""
+    """Process the command.
+
+    If jobs is set, the command is recorded there until it finishes.
+    If ratelimit is set, the rate limits have already been checked for the command,
+    as the bot process does for commands it hands to worker processes.
+    """
 
     config = appconfig.get()
+    authstart = time.time_ns()
 
-    # Split the command into arguments, and always user lower case for the command name
-    # (No reason to allow commands like 'host' and 'Host' to be different, right?)
-    cmdsplit = shlex.split(input)
-    cmdsplit[0] = cmdsplit[0].lower()
+    cmdsplit = split_command(input)
     cmdname = cmdsplit[0]
 
-    LOGGER.debug(f"commands :: Command.process: {input} {room}")
+    LOGGER.debug("commands :: Command.process: %s %s", input, room)
 
     command = config.commands.get(cmdname)
+
     if not command:
         await send_text_to_room(
             client,
@@ -79,21 +152,34 @@ async def process_command(
         return
 
     sender = Mxid.fromstr(event.sender)
-    if sender.mxid in config.trusted_users:
+    authorization = command.authorize(sender, config.trusted_users)
+    if authorization == Authorization.TRUSTED:
         LOGGER.debug(
-            f"Processing command {input} from sender {sender.mxid} because sender is in the list of trusted users"
+            "Processing command %s from sender %s because sender is in the list of trusted users",
+            input,
+            sender.mxid,
         )
-    elif command.allow_untrusted:
+    elif authorization == Authorization.UNTRUSTED:
         LOGGER.debug(
-            f"Processing command {input} from sender {sender.mxid} because the invoked command {command.name} allows untrusted invocation"
+            "Processing command %s from sender %s because the invoked command %s allows untrusted invocation",
+            input,
+            sender.mxid,
+            command.name,
         )
-    elif command.allow_homeservers and sender.homeserver in command.allow_homeservers:
+    elif authorization == Authorization.HOMESERVER:
         LOGGER.debug(
-            f"Processing command {input} from sender {sender.mxid} because the invoked command {command.name} allows users from homeserver {sender.homeserver}"
+            "Processing command %s from sender %s because the invoked command %s allows users from homeserver %s",
+            input,
+            sender.mxid,
+            command.name,
+            sender.homeserver,
         )
-    elif command.allow_users and sender.mxid in command.allow_users:
+    elif authorization == Authorization.USER:
         LOGGER.debug(
-            f"Processing command {input} from sender {sender.mxid} because the invoked command {command.name} allows that user explicitly"
+            "Processing command %s from sender %s because the invoked command %s allows that user explicitly",
+            input,
+            sender.mxid,
+            command.name,
         )
     else:
         LOGGER.critical(
@@ -108,28 +194,206 @@ async def process_command(
         )
         return
 
+    # Only charge the rate limits for commands the user may run,
+    # so that users who may not run a command cannot use up everyone else's tokens
+    if ratelimit is None:
+        ratelimit = config.ratelimits.check(event.sender, room.room_id, command.name)
+    if not ratelimit.allowed:
+        RATELIMIT_BACKOFFS.inc(ratelimit.scope)
+        LOGGER.info(
+            "Refusing to process command %s from sender %s because of the %s rate limit",
+            input,
+            event.sender,
+            ratelimit.scope,
+        )
+        if ratelimit.warn:
+            await send_text_to_room(
+                client,
+                room.room_id,
+                f"Slow down! Too many commands; try again in {math.ceil(ratelimit.wait)} seconds.",
+                format=MessageFormat.NATURAL,
+            )
+        return
+
+    record("authorize", authstart, command=command.name)
+    COMMANDS_DISPATCHED.inc(command.name)
+    job = Job(
+        event.event_id,
+        command.name,
+        cmdsplit[1:],
+        event.sender,
+        room.room_id,
+        event.source,
+    )
+    if jobs:
+        job = jobs.add(job)
+    started = time.perf_counter()
     taskctx = TaskMessageContext(event.sender, room.room_id)
+    reply = None
+    # Start the task inside the span, so that the task inherits it as its parent
+    with span("task", command=command.name):
+        # Later messages need not wait long for this one to send what they have to
+        start_turn(room.room_id)
+        if streams_output(command.task):
+            # It sends its output as it runs, so it can only run in its turn
+            await wait_turn(room.room_id)
+        running = RUNNING.start(
+            config.user_id,
+            command.name,
+            taskctx,
+            run_task(client, command.task, cmdsplit[1:], taskctx),
+        )
+        if jobs:
+            jobs.start(job)
+        try:
+            try:
+                reply = await asyncio.wait_for(running.future, command.task.timeout)
+            except asyncio.TimeoutError:
+                TASK_ERRORS.inc(command.name)
+                LOGGER.warning(
+                    f"Task {command.task.name} timed out after {command.task.timeout} seconds"
+                )
+                await send_text_to_room(
+                    client,
+                    room.room_id,
+                    f"Command {command.name} timed out after {command.task.timeout} seconds and was stopped.",
+                    format=MessageFormat.NATURAL,
+                )
+            except asyncio.CancelledError:
+                if not running.cancelled:
+                    raise
+                LOGGER.info("Task %s was cancelled", command.task.name)
+                await send_text_to_room(
+                    client,
+                    room.room_id,
+                    f"Command {command.name} was cancelled.",
+                    format=MessageFormat.NATURAL,
+                )
+            finally:
+                # A task that is only waiting to send its output is not running
+                RUNNING.finish(running)
+            if reply is not None:
+                await reply()
+        finally:
+            if jobs:
+                jobs.finish(job.job_id)
+            TASK_LATENCY.observe(time.perf_counter() - started, command.name)
+
+
+async def call_task(
+    task: Task,
+    arguments: List[str],
+    taskctx: TaskMessageContext,
+) -> Any:
+    """Call a task's taskfunc and return its result
+
+    Coroutine and async generator taskfuncs run on the event loop;
+    anything else is called in the default executor so it cannot block the bot,
+    in a copy of the current context, so that it sees the invoking bot's config.
+    The result is a TaskResult, or a generator or async generator of them.
+    """
+    with span("execute", task=task.name):
+        if inspect.iscoroutinefunction(task.taskfunc) or inspect.isasyncgenfunction(
+            task.taskfunc
+        ):
+            result = task.taskfunc(arguments, taskctx)
+        else:
+            loop = asyncio.get_event_loop()
+            context = contextvars.copy_context()
+            result = await loop.run_in_executor(
+                None, context.run, task.taskfunc, arguments, taskctx
+            )
+        if inspect.isawaitable(result):
+            result = await result
+    return result
+
+
+def streams_output(task: Task) -> bool:
+    """Whether a task sends its output to the room while it runs"""
+    return inspect.isasyncgenfunction(task.taskfunc) or inspect.isgeneratorfunction(
+        task.taskfunc
+    )
+
+
+async def run_task(
+    client: AsyncClient,
+    task: Task,
+    arguments: List[str],
+    taskctx: TaskMessageContext,
+) -> Optional[Callable[[], Awaitable]]:
+    """Run a task, and return a function that sends its output
+
+    The output goes to the room the task was invoked from.
+    It is returned rather than sent, so that the caller can send it
+    when it is the invoking message's turn, after the task has finished;
+    see `trappedbot.replyorder`.
+    If the task is a generator, its output is sent as it is produced,
+    and this returns None, unless the task fails and there is an error to send.
+
+    If the task is a single-flight task, share the result of an identical
+    invocation that is already running, if there is one.
+    """
     try:
-        result = command.task.taskfunc(cmdsplit[1:], taskctx)
+        if task.singleflight:
+            result, shared = await SINGLEFLIGHT.do(
+                (appconfig.get().user_id, task.name, tuple(arguments)),
+                lambda: call_task(task, arguments, taskctx),
+            )
+            if shared and (inspect.isasyncgen(result) or inspect.isgenerator(result)):
+                # Only one invocation can consume a generator, so run our own
+                result = await call_task(task, arguments, taskctx)
+            elif shared:
+                LOGGER.debug("Task %s shared result of identical invocation", task.name)
+        else:
+            result = await call_task(task, arguments, taskctx)
+        if inspect.isasyncgen(result) or inspect.isgenerator(result):
+            chunks = aiter_chunks(result)
+            if task.stream:
+                await stream_task_output(
+                    client,
+                    taskctx.room,
+                    chunks,
+                    interval=task.stream_interval,
+                    tail=task.stream_tail,
+                )
+            else:
+                await send_task_chunks(client, taskctx.room, chunks)
+            LOGGER.debug("Task %s finished streaming output", task.name)
+            return None
         message = result.output
         format = result.format
         split = result.split
         LOGGER.debug(
-            f"Task {command.task.name} completed successfully; replying with output:\n{message}"
+            "Task %s completed successfully; replying with output:\n%s",
+            task.name,
+            message,
         )
-    except BaseException as exc:
+    except Exception as exc:
+        TASK_ERRORS.inc(task.name)
         message = f"Error:\n{exc}\n{traceback.format_exc()}"
         # Always format errors in a code block
         format = MessageFormat.CODE
         split = None
         LOGGER.debug(
-            f"Task {command.task.name} encountered an error; replying with error:\n{message}"
+            "Task %s encountered an error; replying with error:\n%s", task.name, message
         )
+    else:
+        if appconfig.get().page_size:
+            return functools.partial(
+                send_paged_text_to_room,
+                client,
+                taskctx.room,
+                taskctx.sender,
+                message,
+                format,
+                split,
+            )
 
-    await send_text_to_room(
+    return functools.partial(
+        send_text_to_room,
         client,
-        room.room_id,
+        taskctx.room,
         message,
         format=format,
         split=split,
-    )
\ No newline at end of file
+    )
@@ -5,9 +5,10 @@ import typing
 
 from trappedbot.applogger import LOGGER
 from trappedbot.commands.command import Command
+from trappedbot.constants import DEFAULT_STREAM_INTERVAL, DEFAULT_STREAM_TAIL
 from trappedbot.tasks.builtin import BUILTIN_TASKS
 from trappedbot.tasks.dynload import trappedbot_dynload_for_taskfunc
-from trappedbot.tasks.task import Task, systemcmd2taskfunc
+from trappedbot.tasks.task import Task, systemcmd2streamfunc, systemcmd2taskfunc
 
 
 def yamlobj2command(
@@ -17,7 +18,10 @@ def yamlobj2command(
     if (builtin_name := yamlobj.get("builtin")) :
         taskfunc = BUILTIN_TASKS[builtin_name].taskfunc
     elif (cmd := yamlobj.get("systemcmd")) :
-        taskfunc = systemcmd2taskfunc(cmd)
+        if yamlobj.get("stream", False):
+            taskfunc = systemcmd2streamfunc(cmd)
+        else:
+            taskfunc = systemcmd2taskfunc(cmd)
     elif (modpath := yamlobj.get("modulepath")) :
         taskfunc_opt = trappedbot_dynload_for_taskfunc(name, modpath)
         if not taskfunc_opt:
@@ -35,6 +39,11 @@ def yamlobj2command(
             name,
             taskfunc,
             split=yamlobj.get("split"),
+            stream=yamlobj.get("stream", False),
+            stream_interval=yamlobj.get("stream_interval", DEFAULT_STREAM_INTERVAL),
+            stream_tail=yamlobj.get("stream_tail", DEFAULT_STREAM_TAIL),
+            timeout=yamlobj.get("timeout"),
+            singleflight=yamlobj.get("singleflight", False),
         ),
         help=yamlobj.get("help", None),
         allow_untrusted=yamlobj.get("allow_untrusted", False),
@@ -6,12 +6,29 @@ import typing
 
 import yaml
 
-from trappedbot.applogger import LOGGER
+from trappedbot.applogger import LOGGER, set_json_format
 from trappedbot.commands.builtin import BUILTIN_COMMANDS
 from trappedbot.commands.command_list import yamlobj2cmddict
 from trappedbot.configuration import ConfigError, Configuration
+from trappedbot.constants import (
+    DEFAULT_LOW_MEMORY_IDLE,
+    DEFAULT_MAX_EVENT_SIZE,
+    DEFAULT_MAX_MESSAGES,
+    DEFAULT_PAGE_BUFFERS,
+    DEFAULT_PAGE_MAX,
+    DEFAULT_PAGE_TTL,
+    DEFAULT_SHUTDOWN_TIMEOUT,
+    SYNC_FILTER_KEYS,
+)
 from trappedbot.events import EventNotifyAction
+from trappedbot.feeds import yamlobj2feeds
+from trappedbot.ratelimit import (
+    DEFAULT_RATELIMIT_MAX_KEYS,
+    RateLimits,
+    yamlobj2ratelimitspec,
+)
 from trappedbot.responses.response_list import yamlobj2rsplist
+from trappedbot.scheduler import yamlobj2schedules
 
 
 def parse_config(
@@ -20,7 +37,21 @@ def parse_config(
 ) -> Configuration:
     """Parse a config file
 
-    Return a tuple of an AppConfig object and a Logger
+    If the file defines several bots, return the configuration of the first one.
+    """
+    return parse_configs(filepath, force_log_debug)[0]
+
+
+def parse_configs(
+    filepath: str,
+    force_log_debug: bool = False,
+) -> typing.List[Configuration]:
+    """Parse a config file, returning a configuration for each bot it defines
+
+    A config file may have a top-level `bots` list, to run several Matrix accounts
+    in one process. Each item is a partial config file, usually with its own
+    `matrix` and `storage` sections, whose sections replace the top-level ones.
+    Without `bots`, the file defines a single bot.
     """
     filepath = os.path.abspath(filepath)
     if not os.path.isfile(filepath):
@@ -34,7 +65,33 @@ def parse_config(
         LOGGER.setLevel(logging.DEBUG)
     elif (config_log_lvl := configuration["logging"].get("level", None)) :
         LOGGER.setLevel(config_log_lvl)
+    log_format = configuration["logging"].get("format", "text")
+    if log_format not in ("text", "json"):
+        raise ConfigError("logging.format must be 'text' or 'json'")
+    set_json_format(log_format == "json")
+
+    bots = configuration.get("bots")
+    if not bots:
+        return [yamlobj2config(configuration, filepath)]
+    if not isinstance(bots, list):
+        raise ConfigError("bots must be a list")
+
+    configs = []
+    for bot in bots:
+        botconfig = {k: v for k, v in configuration.items() if k != "bots"}
+        botconfig.update(bot)
+        configs.append(yamlobj2config(botconfig, filepath))
+
+    for attr in ("user_id", "database_filepath", "store_filepath"):
+        values = [getattr(c, attr) for c in configs]
+        if len(set(values)) != len(values):
+            raise ConfigError(f"Each of the bots must have a different {attr}")
+
+    return configs
+
 
+def yamlobj2config(configuration: typing.Dict, filepath: str) -> Configuration:
+    """Build the configuration for one bot from a parsed config file"""
     database_filepath = os.path.abspath(configuration["storage"]["database_filepath"])
     store_filepath = os.path.abspath(configuration["storage"]["store_filepath"])
     os.makedirs(store_filepath, exist_ok=True)
@@ -68,7 +125,15 @@ def parse_config(
             raise ConfigError(f"Unknown event action for {name}")
 
     command_prefix = configuration["bot"]["command_prefix"]
-    trusted_users = configuration["bot"].get("trusted_users", [])
+    trusted_users = frozenset(configuration["bot"].get("trusted_users", []))
+    max_event_size = configuration["bot"].get("max_event_size", DEFAULT_MAX_EVENT_SIZE)
+    max_messages = configuration["bot"].get("max_messages", DEFAULT_MAX_MESSAGES)
+
+    pagination = configuration["bot"].get("pagination", {})
+    page_size = pagination.get("page_size", 0)
+    page_ttl = pagination.get("ttl", DEFAULT_PAGE_TTL)
+    page_buffers = pagination.get("max_buffers", DEFAULT_PAGE_BUFFERS)
+    page_max = pagination.get("max_pages", DEFAULT_PAGE_MAX)
 
     commands = yamlobj2cmddict(configuration.get("commands", {}))
     for cmdname, cmd in BUILTIN_COMMANDS.items():
@@ -78,6 +143,64 @@ def parse_config(
             )
         commands[cmdname] = cmd
     responses = yamlobj2rsplist(configuration.get("responses", []))
+    schedules = yamlobj2schedules(configuration.get("schedules"), commands)
+    feeds, feed_concurrency = yamlobj2feeds(configuration.get("feeds"))
+
+    ratelimit_config = configuration["bot"].get("ratelimit", {})
+    command_ratelimits = {}
+    for cmdname, cdefn in configuration.get("commands", {}).items():
+        if (spec := yamlobj2ratelimitspec(cdefn.get("ratelimit"))) :
+            command_ratelimits[cmdname] = spec
+    ratelimits = RateLimits(
+        user=yamlobj2ratelimitspec(ratelimit_config.get("user")),
+        room=yamlobj2ratelimitspec(ratelimit_config.get("room")),
+        command=yamlobj2ratelimitspec(ratelimit_config.get("command")),
+        commands=command_ratelimits,
+        max_keys=ratelimit_config.get("max_keys", DEFAULT_RATELIMIT_MAX_KEYS),
+    )
+
+    workers = configuration["bot"].get("workers", 0)
+    if not isinstance(workers, int) or workers < 0:
+        raise ConfigError("bot.workers must be a whole number")
+
+    resume_jobs = configuration["bot"].get("resume_jobs", False)
+
+    sync_filter = configuration["bot"].get("sync_filter", True)
+    if not isinstance(sync_filter, (bool, dict)):
+        raise ConfigError("bot.sync_filter must be true, false, or a Matrix filter")
+    if isinstance(sync_filter, dict):
+        # The whole filter is uploaded, so a misspelled key would be silently ignored
+        unknown = set(sync_filter) - SYNC_FILTER_KEYS
+        if unknown:
+            raise ConfigError(
+                f"bot.sync_filter has unknown keys {', '.join(sorted(unknown))}; "
+                f"a Matrix filter may only have {', '.join(sorted(SYNC_FILTER_KEYS))}"
+            )
+        if sync_filter.get("event_format", "client") not in ("client", "federation"):
+            raise ConfigError(
+                "bot.sync_filter.event_format must be 'client' or 'federation'"
+            )
+
+    low_memory = configuration["bot"].get("low_memory", False)
+    low_memory_idle = configuration["bot"].get(
+        "low_memory_idle", DEFAULT_LOW_MEMORY_IDLE
+    )
+
+    shutdown_timeout = configuration["bot"].get(
+        "shutdown_timeout", DEFAULT_SHUTDOWN_TIMEOUT
+    )
+
+    metrics_listen = (configuration.get("metrics") or {}).get("listen", "")
+    if metrics_listen and ":" not in metrics_listen:
+        raise ConfigError("metrics.listen must be in the form host:port")
+
+    tracing = configuration.get("tracing") or {}
+    trace_sample_rate = float(tracing.get("sample_rate", 0.0))
+    if not 0 <= trace_sample_rate <= 1:
+        raise ConfigError("tracing.sample_rate must be between 0 and 1")
+    trace_file = tracing.get("file", "")
+    if trace_file:
+        trace_file = os.path.abspath(trace_file)
 
     appconfig = Configuration(
         configuration=configuration,
@@ -94,9 +217,28 @@ def parse_config(
         change_device_name=change_device_name,
         command_prefix=command_prefix,
         trusted_users=trusted_users,
+        max_event_size=max_event_size,
+        max_messages=max_messages,
+        page_size=page_size,
+        page_ttl=page_ttl,
+        page_buffers=page_buffers,
+        page_max=page_max,
+        ratelimits=ratelimits,
+        workers=workers,
+        resume_jobs=resume_jobs,
+        sync_filter=sync_filter,
+        low_memory=low_memory,
+        low_memory_idle=low_memory_idle,
+        shutdown_timeout=shutdown_timeout,
+        metrics_listen=metrics_listen,
+        trace_sample_rate=trace_sample_rate,
+        trace_file=trace_file,
         events=events,
         commands=commands,
         responses=responses,
+        schedules=schedules,
+        feeds=feeds,
+        feed_concurrency=feed_concurrency,
     )
 
     return appconfig
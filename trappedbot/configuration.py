@@ -9,6 +9,18 @@
 import json
 import typing
 
+from trappedbot.constants import (
+    DEFAULT_FEED_CONCURRENCY,
+    DEFAULT_LOW_MEMORY_IDLE,
+    DEFAULT_MAX_EVENT_SIZE,
+    DEFAULT_MAX_MESSAGES,
+    DEFAULT_PAGE_BUFFERS,
+    DEFAULT_PAGE_MAX,
+    DEFAULT_PAGE_TTL,
+    DEFAULT_SHUTDOWN_TIMEOUT,
+)
+from trappedbot.ratelimit import RateLimits
+
 
 class ConfigError(RuntimeError):
     """Error encountered during reading the config file.
@@ -38,10 +50,29 @@ class Configuration(typing.NamedTuple):
     trust_own_devices: bool = False
     change_device_name: bool = False
     command_prefix: str = ""
-    trusted_users: typing.List[str] = []
+    trusted_users: typing.FrozenSet[str] = frozenset()
+    max_event_size: int = DEFAULT_MAX_EVENT_SIZE
+    max_messages: int = DEFAULT_MAX_MESSAGES
+    page_size: int = 0
+    page_ttl: float = DEFAULT_PAGE_TTL
+    page_buffers: int = DEFAULT_PAGE_BUFFERS
+    page_max: int = DEFAULT_PAGE_MAX
+    ratelimits: RateLimits = RateLimits()
+    workers: int = 0
+    resume_jobs: bool = False
+    sync_filter: typing.Union[bool, typing.Dict[str, typing.Any]] = True
+    low_memory: bool = False
+    low_memory_idle: float = DEFAULT_LOW_MEMORY_IDLE
+    shutdown_timeout: float = DEFAULT_SHUTDOWN_TIMEOUT
+    metrics_listen: str = ""
+    trace_sample_rate: float = 0.0
+    trace_file: str = ""
     events: typing.Dict[str, "TrappedBotEventAction"] = {}
     commands: typing.Dict[str, "Command"] = {}
     responses: typing.List["Response"] = []
+    schedules: typing.List["Schedule"] = []
+    feeds: typing.List["Feed"] = []
+    feed_concurrency: int = DEFAULT_FEED_CONCURRENCY
 
     def extension(self, section: str, setting: str):
         """Retrieve an extension from the config
@@ -1,4 +1,53 @@
 """Application constants"""
 
 
-HELP_TRAPPED_MSG = "Trapped in a Matrix server, send help!"
\ No newline at end of file
+HELP_TRAPPED_MSG = "Trapped in a Matrix server, send help!"
+
+
+DEFAULT_STREAM_INTERVAL = 2.0
+"""Default minimum number of seconds between edits of a streamed message"""
+
+DEFAULT_STREAM_TAIL = 40
+"""Default number of output lines kept in a streamed message"""
+
+DEFAULT_MAX_EVENT_SIZE = 40000
+"""Default maximum size in bytes of the content of a message we send
+
+Homeservers reject events over 64KiB, including signatures and other metadata,
+and encrypting an event makes it about a third larger.
+"""
+
+DEFAULT_MAX_MESSAGES = 4
+"""Default maximum number of messages to split output into
+
+Output that would need more messages than this is sent as a file attachment instead.
+"""
+
+DEFAULT_PAGE_TTL = 600
+"""Default number of seconds to keep paged output for the `more` command"""
+
+DEFAULT_PAGE_BUFFERS = 100
+"""Default maximum number of paged output buffers to keep at once"""
+
+DEFAULT_PAGE_MAX = 100
+"""Default maximum number of pages to keep in a single paged output buffer"""
+
+DEFAULT_FEED_INTERVAL = 900
+"""Default minimum number of seconds between polls of a feed"""
+
+DEFAULT_FEED_MAX_INTERVAL = 21600
+"""Default maximum number of seconds between polls of a feed that rarely changes"""
+
+DEFAULT_FEED_CONCURRENCY = 8
+"""Default maximum number of feeds to fetch at once"""
+
+DEFAULT_LOW_MEMORY_IDLE = 600
+"""Default number of seconds without a message before a room's members are evicted"""
+
+DEFAULT_SHUTDOWN_TIMEOUT = 30
+"""Default maximum number of seconds to wait for in-flight commands when shutting down"""
+
+SYNC_FILTER_KEYS = frozenset(
+    ["event_fields", "event_format", "presence", "account_data", "room"]
+)
+"""The top-level keys of a Matrix filter definition"""
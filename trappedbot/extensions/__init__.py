@@ -15,6 +15,8 @@ Things in this namespace are guaranteed not to change between major version.
   An argument passed to the TaskFunction that extensions must implement.
 * TaskResult:
   The return value for the TaskFunction that extensions must implement.
+  A TaskFunction may also be a generator or async generator that yields TaskResult chunks,
+  which are sent to the room as they are produced.
 * version_cute():
   Return an on-brand bot version string
 * version_raw():
@@ -0,0 +1,136 @@
+"""An in-memory stand-in for `nio.AsyncClient`
+
+Implements just enough of the client for the bot's callbacks and chat functions
+to run without a homeserver:
+sent messages and uploads are recorded in memory instead of being sent anywhere.
+This is used by the benchmarks in support/ and by `trappedbot replay`.
+
+Also provides helpers for building synthetic rooms and message events.
+"""
+
+import asyncio
+import itertools
+import time
+import typing
+
+from nio import JoinResponse, RoomSendResponse, UploadResponse
+from nio.events.room_events import RoomMessageText
+from nio.rooms import MatrixRoom
+
+
+class SentEvent(typing.NamedTuple):
+    """An event sent by the fake client
+
+    sent:       When it was sent, in time.perf_counter() seconds
+    """
+
+    room_id: str
+    message_type: str
+    content: typing.Dict[str, typing.Any]
+    sent: float
+
+
+class FakeAsyncClient(object):
+    """An in-memory stand-in for `nio.AsyncClient`
+
+    user:       The mxid the client is logged in as
+    latency:    Seconds to wait before completing each request,
+                to simulate a homeserver round trip
+    keep:       Whether to keep sent events in `sent`;
+                benchmarks that send a lot may not want to
+    on_send:    If set, called with each SentEvent as it is sent
+    """
+
+    def __init__(
+        self,
+        user: str = "@trappedbot:example.com",
+        latency: float = 0.0,
+        keep: bool = True,
+        on_send: typing.Optional[typing.Callable[[SentEvent], None]] = None,
+    ):
+        self.user = user
+        self.user_id = user
+        self.latency = latency
+        self.keep = keep
+        self.on_send = on_send
+        self.sent: typing.List[SentEvent] = []
+        self.sent_count = 0
+        self.uploads: typing.List[str] = []
+        self.joined: typing.List[str] = []
+        self.rooms: typing.Dict[str, MatrixRoom] = {}
+        self._ids = itertools.count(1)
+
+    async def _wait(self):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    async def room_send(
+        self,
+        room_id: str,
+        message_type: str,
+        content: typing.Dict[str, typing.Any],
+        tx_id: typing.Optional[str] = None,
+        ignore_unverified_devices: bool = False,
+    ) -> RoomSendResponse:
+        await self._wait()
+        sent = SentEvent(room_id, message_type, content, time.perf_counter())
+        self.sent_count += 1
+        if self.keep:
+            self.sent.append(sent)
+        if self.on_send:
+            self.on_send(sent)
+        return RoomSendResponse(f"$fake{next(self._ids)}", room_id)
+
+    async def upload(
+        self, data_provider, content_type: str = "", filename=None, **kwargs
+    ):
+        await self._wait()
+        if hasattr(data_provider, "read"):
+            data = data_provider.read()
+            if asyncio.iscoroutine(data):
+                await data
+        uri = f"mxc://fake/{next(self._ids)}"
+        self.uploads.append(uri)
+        return UploadResponse(uri), None
+
+    async def join(self, room_id: str) -> JoinResponse:
+        await self._wait()
+        self.joined.append(room_id)
+        return JoinResponse(room_id)
+
+    async def close(self):
+        pass
+
+
+def fake_room(
+    room_id: str,
+    own_user_id: str = "@trappedbot:example.com",
+    members: typing.Sequence[str] = (),
+) -> MatrixRoom:
+    """Make a synthetic room with the given members"""
+    room = MatrixRoom(room_id, own_user_id)
+    room.add_member(own_user_id, "trappedbot", None)
+    for member in members:
+        room.add_member(member, member[1:].split(":")[0], None)
+    return room
+
+
+_EVENT_IDS = itertools.count(1)
+
+
+def fake_message(
+    sender: str,
+    body: str,
+    origin_server_ts: typing.Optional[int] = None,
+    event_id: typing.Optional[str] = None,
+) -> RoomMessageText:
+    """Make a synthetic text message event"""
+    return RoomMessageText.from_dict(
+        {
+            "event_id": event_id or f"$synthetic{next(_EVENT_IDS)}",
+            "sender": sender,
+            "origin_server_ts": origin_server_ts or int(time.time() * 1000),
+            "type": "m.room.message",
+            "content": {"msgtype": "m.text", "body": body},
+        }
+    )
@@ -0,0 +1,326 @@
+"""Poll RSS and Atom feeds, and post new items to rooms
+
+Feeds are polled to be cheap on bandwidth and CPU, even with hundreds of them:
+
+* Requests are conditional, with `If-None-Match` and `If-Modified-Since`,
+  so a feed that has not changed costs a `304 Not Modified` and no parsing.
+* All feeds share one HTTP session and its connection pool,
+  and at most `concurrency` are fetched and parsed at once.
+* Each feed's polling interval adapts to how often it changes:
+  it is halved (down to the feed's interval) when a poll finds new items,
+  and grows by half (up to the feed's max_interval) when it does not,
+  or doubles when fetching fails.
+* All feeds are scheduled on one heap, by a single coroutine.
+
+Which items have been posted is kept in the bot database,
+along with each feed's ETag, Last-Modified and current interval,
+so restarting the bot does not post anything twice.
+The first time a feed is polled, its existing items are recorded but not posted.
+"""
+
+import asyncio
+import heapq
+import html
+import itertools
+import random
+import time
+import typing
+import urllib.parse
+from xml.etree import ElementTree
+
+import aiohttp
+from nio import AsyncClient
+
+from trappedbot.applogger import LOGGER
+from trappedbot.chat_functions import send_content_to_room
+from trappedbot.configuration import ConfigError
+from trappedbot.constants import (
+    DEFAULT_FEED_CONCURRENCY,
+    DEFAULT_FEED_INTERVAL,
+    DEFAULT_FEED_MAX_INTERVAL,
+)
+from trappedbot.metrics import CACHE_REQUESTS
+from trappedbot.storage import Storage
+from trappedbot.util import BackgroundTasks
+from trappedbot.version import version_raw
+
+
+FEED_MAX_POSTS = 5
+"""Maximum number of new items to post from one poll of a feed"""
+
+FEED_ITEM_RETENTION = 90 * 24 * 60 * 60
+"""Seconds to remember items that are no longer in their feed"""
+
+FEED_TIMEOUT = 60
+"""Seconds to wait for a feed to download"""
+
+_ATOM = "{http://www.w3.org/2005/Atom}"
+
+
+class Feed(typing.NamedTuple):
+    """A feed to poll
+
+    name:           A unique name, used in posts and to remember the feed's state
+    url:            The URL of the RSS or Atom feed
+    room:           The room to post new items to
+    interval:       Minimum seconds between polls
+    max_interval:   Maximum seconds between polls
+    """
+
+    name: str
+    url: str
+    room: str
+    interval: float = DEFAULT_FEED_INTERVAL
+    max_interval: float = DEFAULT_FEED_MAX_INTERVAL
+
+
+class FeedItem(typing.NamedTuple):
+    item_id: str
+    title: str
+    link: str
+
+
+def yamlobj2feeds(yamlobj: typing.Any) -> typing.Tuple[typing.List[Feed], int]:
+    """Return a list of Feeds and the poll concurrency from a YAML object"""
+    yamlobj = yamlobj or {}
+    interval = yamlobj.get("interval", DEFAULT_FEED_INTERVAL)
+    max_interval = yamlobj.get("max_interval", DEFAULT_FEED_MAX_INTERVAL)
+    concurrency = yamlobj.get("concurrency", DEFAULT_FEED_CONCURRENCY)
+    if concurrency < 1:
+        raise ConfigError("feeds.concurrency must be at least 1")
+    feeds = []
+    for item in yamlobj.get("subscriptions") or []:
+        try:
+            feed = Feed(
+                item.get("name") or item["url"],
+                item["url"],
+                item["room"],
+                float(item.get("interval", interval)),
+                float(item.get("max_interval", max_interval)),
+            )
+        except (KeyError, ValueError) as exc:
+            raise ConfigError(f"Invalid feed {item}: {exc}")
+        if not 0 < feed.interval <= feed.max_interval:
+            raise ConfigError(
+                f"Feed {feed.name} must have 0 < interval <= max_interval"
+            )
+        feeds.append(feed)
+    names = [f.name for f in feeds]
+    if len(set(names)) != len(names):
+        raise ConfigError("Each feed must have a different name")
+    return feeds, concurrency
+
+
+def feed_item_content(feed_name: str, item: FeedItem) -> typing.Dict[str, typing.Any]:
+    """Build the message content that posts a feed item
+
+    Titles and links come from the feed, so they are escaped rather than trusted
+    to be valid Markdown or HTML, and only http and https links are linked.
+    """
+    title = item.title or item.link
+    body = f"{feed_name}: {title}"
+    formatted = html.escape(title)
+    if item.link:
+        if item.title:
+            body += f" {item.link}"
+        if urllib.parse.urlsplit(item.link).scheme.lower() in ("http", "https"):
+            # Quote what a URL may not contain, like spaces, but keep what it may
+            href = urllib.parse.quote(item.link, safe=":/?#[]@!$&'()*+,;=%~")
+            formatted = f'<a href="{html.escape(href)}">{formatted}</a>'
+    return {
+        "msgtype": "m.notice",
+        "body": body,
+        "format": "org.matrix.custom.html",
+        "formatted_body": f"<strong>{html.escape(feed_name)}</strong>: {formatted}",
+    }
+
+
+def _localname(element: ElementTree.Element) -> str:
+    return element.tag.rsplit("}", 1)[-1]
+
+
+def _child_text(element: ElementTree.Element, name: str) -> str:
+    for child in element:
+        if _localname(child) == name:
+            return (child.text or "").strip()
+    return ""
+
+
+def parse_feed(body: bytes) -> typing.List[FeedItem]:
+    """Parse the items from an RSS 1.0, RSS 2.0 or Atom feed"""
+    root = ElementTree.fromstring(body)
+    items = []
+    if root.tag == f"{_ATOM}feed":
+        for entry in root.iter(f"{_ATOM}entry"):
+            link = ""
+            for linkelem in entry.iter(f"{_ATOM}link"):
+                if linkelem.get("rel", "alternate") == "alternate":
+                    link = linkelem.get("href", "")
+                    break
+            title = _child_text(entry, "title")
+            items.append(FeedItem(_child_text(entry, "id") or link, title, link))
+    else:
+        for element in root.iter():
+            if _localname(element) != "item":
+                continue
+            link = _child_text(element, "link")
+            title = _child_text(element, "title")
+            item_id = _child_text(element, "guid") or link or title
+            items.append(FeedItem(item_id, title, link))
+    return [item for item in items if item.item_id]
+
+
+class _FeedState(object):
+    def __init__(
+        self,
+        etag: typing.Optional[str],
+        last_modified: typing.Optional[str],
+        interval: float,
+        polled: bool,
+    ):
+        self.etag = etag
+        self.last_modified = last_modified
+        self.interval = interval
+        self.polled = polled
+
+
+class FeedPoller(object):
+    """Poll a bot's feeds"""
+
+    def __init__(self, feeds: typing.List[Feed], store: Storage, concurrency: int):
+        self.feeds = feeds
+        self.store = store
+        self.concurrency = concurrency
+        self._states: typing.Dict[str, _FeedState] = {}
+        # Entries are (when to poll, tiebreaker, feed index)
+        self._heap: typing.List[typing.Tuple[float, int, int]] = []
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._polling = BackgroundTasks("polling a feed")
+
+    def _push(self, idx: int, due: float):
+        heapq.heappush(self._heap, (due, next(self._seq), idx))
+        self._wakeup.set()
+
+    async def run(self, client: AsyncClient):
+        """Poll feeds forever"""
+        self.store.prune_feed_items(time.time() - FEED_ITEM_RETENTION)
+        stored = self.store.feed_states()
+        now = time.time()
+        for idx, feed in enumerate(self.feeds):
+            if feed.name in stored:
+                etag, last_modified, interval = stored[feed.name]
+                interval = min(max(interval, feed.interval), feed.max_interval)
+                state = _FeedState(etag, last_modified, interval, True)
+            else:
+                state = _FeedState(None, None, feed.interval, False)
+            self._states[feed.name] = state
+            # Spread out the first polls, rather than fetching every feed at once
+            self._push(idx, now + random.uniform(0, min(state.interval, 60)))
+
+        semaphore = asyncio.Semaphore(self.concurrency)
+        async with aiohttp.ClientSession(
+            timeout=aiohttp.ClientTimeout(total=FEED_TIMEOUT),
+            connector=aiohttp.TCPConnector(limit=self.concurrency),
+            headers={"User-Agent": f"trappedbot/{version_raw()}"},
+        ) as session:
+            while True:
+                # Polls in progress push their feed back on the heap when they finish
+                delay = self._heap[0][0] - time.time() if self._heap else None
+                if delay is None or delay > 0:
+                    self._wakeup.clear()
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), delay)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                _, _, idx = heapq.heappop(self._heap)
+                self._polling.start(self._poll(client, session, semaphore, idx))
+
+    async def _poll(
+        self,
+        client: AsyncClient,
+        session: aiohttp.ClientSession,
+        semaphore: asyncio.Semaphore,
+        idx: int,
+    ):
+        feed = self.feeds[idx]
+        state = self._states[feed.name]
+        headers = {}
+        if state.etag:
+            headers["If-None-Match"] = state.etag
+        if state.last_modified:
+            headers["If-Modified-Since"] = state.last_modified
+
+        items: typing.List[FeedItem] = []
+        try:
+            async with semaphore:
+                async with session.get(feed.url, headers=headers) as resp:
+                    if resp.status == 304:
+                        CACHE_REQUESTS.inc("feed", "hit")
+                        body = None
+                    else:
+                        CACHE_REQUESTS.inc("feed", "miss")
+                        resp.raise_for_status()
+                        body = await resp.read()
+                        state.etag = resp.headers.get("ETag")
+                        state.last_modified = resp.headers.get("Last-Modified")
+                if body:
+                    loop = asyncio.get_event_loop()
+                    items = await loop.run_in_executor(None, parse_feed, body)
+        except Exception as exc:
+            state.interval = min(state.interval * 2, feed.max_interval)
+            LOGGER.warning(
+                f"Unable to poll feed {feed.name}, retrying in {state.interval}s: {exc}"
+            )
+            self._push(idx, time.time() + state.interval)
+            return
+
+        # Always poll the feed again, even if posting or recording its items fails
+        try:
+            await self._post(client, feed, state, items)
+        except Exception:
+            LOGGER.exception(f"Unable to handle items of feed {feed.name}")
+        finally:
+            self._push(idx, time.time() + state.interval)
+
+    async def _post(
+        self,
+        client: AsyncClient,
+        feed: Feed,
+        state: _FeedState,
+        items: typing.List[FeedItem],
+    ):
+        """Post a feed's new items to its room, and record them as seen"""
+        ids = [item.item_id for item in items]
+        seen = self.store.seen_feed_items(feed.name, ids) if ids else set()
+        new = [item for item in items if item.item_id not in seen]
+        if new and state.polled:
+            state.interval = max(state.interval / 2, feed.interval)
+            # Feeds list the newest items first; post the oldest of them first
+            for item in reversed(new[:FEED_MAX_POSTS]):
+                event_id = await send_content_to_room(
+                    client, feed.room, feed_item_content(feed.name, item)
+                )
+                if event_id is None:
+                    LOGGER.warning(
+                        f"Unable to post item {item.item_id} of feed {feed.name} to {feed.room}"
+                    )
+        else:
+            state.interval = min(state.interval * 1.5, feed.max_interval)
+        LOGGER.debug(
+            "Polled feed %s: %s items, %s new; next poll in %ss",
+            feed.name,
+            len(items),
+            len(new),
+            state.interval,
+        )
+        state.polled = True
+        self.store.write_feed(
+            feed.name,
+            state.etag,
+            state.last_modified,
+            state.interval,
+            ids,
+            time.time(),
+        )
@@ -0,0 +1,107 @@
+"""Keep track of the connection to the homeserver, and back off when it fails
+
+When the homeserver cannot be reached, or its syncs fail,
+the bot waits before trying again, for exponentially longer each time,
+with random jitter so that many bots do not all retry at once.
+While it waits, it checks whether the homeserver is back with a single cheap request,
+rather than logging in and syncing again, which costs much more.
+The waits are asynchronous, so scheduled commands and feeds keep running,
+and the client keeps its HTTP session and connection pool.
+The first successful sync resets the backoff.
+"""
+
+import asyncio
+import random
+import time
+import typing
+
+from aiohttp import ClientConnectionError
+from nio import AsyncClient, SyncError, SyncResponse
+
+from trappedbot.applogger import LOGGER
+from trappedbot.metrics import SYNC_FAILURES
+
+
+RECONNECT_BASE_DELAY = 1.0
+"""Seconds to wait after the first failure"""
+
+RECONNECT_MAX_DELAY = 300.0
+"""Maximum seconds to wait between attempts"""
+
+
+class Backoff(object):
+    """Exponential backoff with full jitter
+
+    Each delay is chosen at random between zero and
+    base * 2 ** (number of failures), up to cap.
+    """
+
+    def __init__(
+        self, base: float = RECONNECT_BASE_DELAY, cap: float = RECONNECT_MAX_DELAY
+    ):
+        self.base = base
+        self.cap = cap
+        self.failures = 0
+
+    def next(self) -> float:
+        """Count a failure and return how long to wait before trying again"""
+        ceiling = min(self.cap, self.base * 2 ** min(self.failures, 32))
+        self.failures += 1
+        return random.uniform(0, ceiling)
+
+    def reset(self):
+        self.failures = 0
+
+
+class ConnectionMonitor(object):
+    """Track a client's connection to its homeserver
+
+    Use `synced` as a response callback for SyncResponse and SyncError.
+    Call `wait_to_reconnect` after a connection error,
+    before logging in and syncing again.
+    """
+
+    def __init__(self, client: AsyncClient):
+        self.client = client
+        self.backoff = Backoff()
+        self.last_sync: typing.Optional[float] = None
+
+    @property
+    def healthy(self) -> bool:
+        """Whether the most recent sync succeeded"""
+        return self.last_sync is not None and self.backoff.failures == 0
+
+    async def synced(self, response: typing.Union[SyncResponse, SyncError]):
+        if isinstance(response, SyncResponse):
+            if self.backoff.failures:
+                LOGGER.info("Syncing with the homeserver again")
+            self.last_sync = time.monotonic()
+            self.backoff.reset()
+            return
+        # nio's sync_forever retries immediately, and awaits response callbacks,
+        # so sleeping here slows down its retries
+        SYNC_FAILURES.inc("error")
+        delay = self.backoff.next()
+        LOGGER.warning(f"Sync failed, retrying in {delay:.1f}s: {response}")
+        await asyncio.sleep(delay)
+
+    async def _reachable(self) -> bool:
+        try:
+            if self.client.logged_in:
+                await self.client.whoami()
+            else:
+                await self.client.discovery_info()
+        except (ClientConnectionError, asyncio.TimeoutError):
+            return False
+        # Any response, even an error, means the homeserver is there
+        return True
+
+    async def wait_to_reconnect(self):
+        """Wait, with backoff, until the homeserver can be reached"""
+        SYNC_FAILURES.inc("connection")
+        while True:
+            delay = self.backoff.next()
+            LOGGER.warning(f"Unable to connect to homeserver, retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+            if await self._reachable():
+                return
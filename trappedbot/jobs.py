@@ -0,0 +1,164 @@
+"""A durable record of the commands the bot is running
+
+Each command the bot accepts is recorded as a job in the bot database
+until it finishes, so that if the bot is restarted in the middle of a command,
+it can tell the user, or run the command again, when it starts back up.
+
+Writes are batched: changes to jobs are kept in memory,
+and written to the database in a single transaction
+every `JOBS_FLUSH_INTERVAL` seconds, or sooner if `JOBS_MAX_BATCH` are waiting.
+A command that starts and finishes between flushes is never written at all,
+so most commands cost nothing here;
+the cost is that a command accepted less than a flush interval before the bot
+is killed may be forgotten.
+"""
+
+import asyncio
+import enum
+import json
+import time
+import typing
+
+from trappedbot.applogger import LOGGER
+from trappedbot.storage import Storage
+
+
+JOBS_FLUSH_INTERVAL = 1.0
+"""Maximum seconds between writing job changes to the database"""
+
+JOBS_MAX_BATCH = 500
+"""Write job changes to the database as soon as this many are waiting"""
+
+
+class JobState(enum.Enum):
+    """The state of a job
+
+    PENDING:    Accepted, but not started
+    RUNNING:    Started, and not finished
+    """
+
+    PENDING = enum.auto()
+    RUNNING = enum.auto()
+
+
+class Job(typing.NamedTuple):
+    """A command invocation
+
+    job_id:     The ID of the event that invoked the command
+    event:      The source of that event, so it can be handled again
+    created:    When the job was created, in seconds since the epoch
+    """
+
+    job_id: str
+    command: str
+    arguments: typing.List[str]
+    sender: str
+    room_id: str
+    event: typing.Dict[str, typing.Any]
+    state: JobState = JobState.PENDING
+    created: float = 0.0
+
+    def row(self) -> typing.Tuple:
+        return (
+            self.job_id,
+            self.command,
+            json.dumps(self.arguments),
+            self.sender,
+            self.room_id,
+            json.dumps(self.event),
+            self.state.name,
+            self.created,
+            time.time(),
+        )
+
+    @classmethod
+    def fromrow(cls, row: typing.Tuple) -> "Job":
+        job_id, command, arguments, sender, room_id, event, state, created, _ = row
+        return cls(
+            job_id,
+            command,
+            json.loads(arguments),
+            sender,
+            room_id,
+            json.loads(event),
+            JobState[state],
+            created,
+        )
+
+
+class JobQueue(object):
+    """Batch job changes, and write them to the bot database"""
+
+    def __init__(self, store: Storage):
+        self.store = store
+        # Changed jobs, by ID; None means the job finished
+        self._changed: typing.Dict[str, typing.Optional[Job]] = {}
+        # IDs of jobs that are in the database
+        self._stored: typing.Set[str] = set()
+        self._flusher: typing.Optional[asyncio.Future] = None
+        # Jobs created before this are from an earlier run of the bot
+        self._since = time.time()
+
+    def _change(self, job_id: str, job: typing.Optional[Job]):
+        self._changed[job_id] = job
+        if len(self._changed) >= JOBS_MAX_BATCH:
+            self.flush()
+        elif self._flusher is None or self._flusher.done():
+            self._flusher = asyncio.ensure_future(self._flush_later())
+
+    def add(self, job: Job) -> Job:
+        """Record a new job, and return it with its creation time set"""
+        if not job.created:
+            job = job._replace(created=time.time())
+        self._change(job.job_id, job)
+        return job
+
+    def start(self, job: Job):
+        """Record that a job has started"""
+        self._change(job.job_id, job._replace(state=JobState.RUNNING))
+
+    def finish(self, job_id: str):
+        """Record that a job has finished, successfully or not"""
+        if job_id in self._stored:
+            self._change(job_id, None)
+        else:
+            # It was never written, so there is nothing to delete
+            self._changed.pop(job_id, None)
+
+    async def _flush_later(self):
+        await asyncio.sleep(JOBS_FLUSH_INTERVAL)
+        self.flush()
+
+    def flush(self):
+        """Write all changed jobs to the database"""
+        if not self._changed:
+            return
+        upserts = []
+        deletes = []
+        for job_id, job in self._changed.items():
+            if job is None:
+                deletes.append(job_id)
+                self._stored.discard(job_id)
+            else:
+                upserts.append(job.row())
+                self._stored.add(job_id)
+        self._changed.clear()
+        try:
+            self.store.write_jobs(upserts, deletes)
+        except Exception as exc:
+            LOGGER.error(f"Unable to write {len(upserts) + len(deletes)} jobs: {exc}")
+        else:
+            LOGGER.debug("Wrote %s jobs and deleted %s", len(upserts), len(deletes))
+
+    def unfinished(self) -> typing.List[Job]:
+        """Return the jobs that were unfinished when the bot last stopped
+
+        The jobs are forgotten; add them again to run them again.
+        """
+        jobs = [Job.fromrow(row) for row in self.store.unfinished_jobs()]
+        # Commands in the first sync may already be running, and even written out
+        jobs = [job for job in jobs if job.created < self._since]
+        self._stored.update(job.job_id for job in jobs)
+        for job in jobs:
+            self.finish(job.job_id)
+        return jobs
@@ -0,0 +1,111 @@
+"""Share encryption keys with encrypted rooms ahead of time
+
+Before nio can send the first message to an encrypted room,
+or the first one after the room's members change,
+it loads the room's members, queries their devices' keys,
+and shares a new Megolm group session with every device.
+`room_send` does all of that itself, but then the bot's reply waits on it,
+which can take seconds in a large room.
+
+`KeySharer` does it in the background instead, after syncs,
+for encrypted rooms that have had a message recently,
+so that replies to commands can be encrypted and sent right away.
+When the bot starts, that is the rooms with a recent message in the first sync,
+rather than every encrypted room the bot is in,
+which would load the members and keys of rooms that have long been quiet.
+"""
+
+import asyncio
+import time
+import typing
+
+from nio import AsyncClient, MatrixRoom, RoomMessage, SyncResponse
+
+from trappedbot.applogger import LOGGER
+from trappedbot.util import BackgroundTasks
+
+
+KEYSHARING_ACTIVE_TTL = 60 * 60
+"""Seconds after its last message that a room is still kept ready to send to"""
+
+KEYSHARING_CONCURRENCY = 4
+"""Maximum number of rooms to prepare at once"""
+
+
+class KeySharer(object):
+    """Keep group sessions shared for a client's active encrypted rooms
+
+    Use `message` as a room message callback, and `synced` as a sync response callback.
+    Rooms are kept ready for ttl seconds after their last message.
+    Does nothing if the client does not have encryption enabled.
+    """
+
+    def __init__(self, client: AsyncClient, ttl: float = KEYSHARING_ACTIVE_TTL):
+        self.client = client
+        self.ttl = ttl
+        # Room IDs to when they last had a message
+        self._active: typing.Dict[str, float] = {}
+        self._preparing: typing.Set[str] = set()
+        self._semaphore = asyncio.Semaphore(KEYSHARING_CONCURRENCY)
+        self._tasks = BackgroundTasks("sharing keys")
+
+    async def message(self, room: MatrixRoom, event: RoomMessage):
+        if not room.encrypted:
+            return
+        # The first sync has the latest messages of every room, however old they are
+        age = max(0.0, time.time() - event.server_timestamp / 1000)
+        if age <= self.ttl:
+            self._active[room.room_id] = time.monotonic() - age
+
+    async def synced(self, response: SyncResponse):
+        if not self.client.olm:
+            return
+        now = time.monotonic()
+        for room_id, last in list(self._active.items()):
+            if now - last > self.ttl:
+                del self._active[room_id]
+            elif self._needs_sharing(room_id):
+                self._preparing.add(room_id)
+                self._tasks.start(self._prepare(room_id))
+
+    def _needs_sharing(self, room_id: str) -> bool:
+        room = self.client.rooms.get(room_id)
+        return (
+            room is not None
+            and room.encrypted
+            and room_id not in self._preparing
+            and room_id not in self.client.sharing_session
+            and (
+                not room.members_synced
+                or self.client.olm.should_share_group_session(room_id)
+            )
+        )
+
+    async def _prepare(self, room_id: str):
+        """Do what room_send would do before encrypting a message to a room"""
+        try:
+            async with self._semaphore:
+                start = time.monotonic()
+                room = self.client.rooms.get(room_id)
+                if room and not room.members_synced:
+                    await self.client.joined_members(room_id)
+                if self.client.should_query_keys:
+                    await self.client.keys_query()
+                # room_send may have shared a session while we were waiting
+                if (
+                    self.client.olm.should_share_group_session(room_id)
+                    and room_id not in self.client.sharing_session
+                ):
+                    await self.client.share_group_session(
+                        room_id, ignore_unverified_devices=True
+                    )
+                LOGGER.debug(
+                    "Shared keys with room %s in %.3fs",
+                    room_id,
+                    time.monotonic() - start,
+                )
+        except Exception as exc:
+            # room_send will try again when it needs to
+            LOGGER.warning(f"Unable to share keys with room {room_id}: {exc}")
+        finally:
+            self._preparing.discard(room_id)
@@ -0,0 +1,333 @@
+"""Runtime metrics, with an optional Prometheus-compatible HTTP endpoint
+
+Metrics are always recorded, since recording them is cheap:
+a labelled child is looked up in a dict once and then cached by the caller,
+and updating a counter or histogram is a few arithmetic operations.
+If `metrics.listen` is set in the config, a small HTTP server exposes them
+in the Prometheus text format at `/metrics`.
+
+The metrics themselves are defined at the bottom of this module.
+"""
+
+import abc
+import bisect
+import threading
+import time
+import typing
+
+from aiohttp import web
+
+from trappedbot.applogger import LOGGER
+
+
+DEFAULT_LATENCY_BUCKETS = (
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+)
+"""Default histogram buckets for latencies, in seconds"""
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labelstr(names: typing.Sequence[str], values: typing.Sequence[str]) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(f'{n}="{_escape(str(v))}"' for n, v in zip(names, values))
+    return "{" + pairs + "}"
+
+
+class _Metric(abc.ABC):
+    """Base class for metrics with optional labels"""
+
+    kind = ""
+    suffix = ""
+
+    def __init__(self, name: str, help: str, labelnames: typing.Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._children: typing.Dict[typing.Tuple[str, ...], typing.Any] = {}
+        # Children may be created from executor threads
+        self._lock = threading.Lock()
+
+    @abc.abstractmethod
+    def _new_child(self):
+        """Create the child metric for one set of label values"""
+
+    def labels(self, *values: str):
+        """Return the child metric for a set of label values"""
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def children(self):
+        return list(self._children.items())
+
+    def expose(self) -> typing.List[str]:
+        fullname = self.name + self.suffix
+        lines = [f"# HELP {fullname} {self.help}", f"# TYPE {fullname} {self.kind}"]
+        for values, child in self.children():
+            lines += child.expose(self.name, _labelstr(self.labelnames, values))
+        return lines
+
+
+class _CounterChild(object):
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount: float = 1.0):
+        self.value += amount
+
+    def expose(self, name: str, labels: str) -> typing.List[str]:
+        return [f"{name}_total{labels} {self.value}"]
+
+
+class Counter(_Metric):
+    """A value that only goes up"""
+
+    kind = "counter"
+    suffix = "_total"
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, *labels: str, amount: float = 1.0):
+        self.labels(*labels).inc(amount)
+
+    def total(self) -> float:
+        return sum(child.value for _, child in self.children())
+
+
+class _GaugeChild(object):
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0.0
+
+    def set(self, value: float):
+        self.value = value
+
+    def expose(self, name: str, labels: str) -> typing.List[str]:
+        return [f"{name}{labels} {self.value}"]
+
+
+class Gauge(_Metric):
+    """A value that can go up and down
+
+    A gauge may have a function that is called to get its value when it is exposed,
+    for values like queue depths that are cheaper to read on demand than to track.
+    """
+
+    kind = "gauge"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labelnames: typing.Sequence[str] = (),
+        func: typing.Optional[typing.Callable[[], float]] = None,
+    ):
+        super().__init__(name, help, labelnames)
+        self.func = func
+
+    def _new_child(self):
+        return _GaugeChild()
+
+    def set(self, value: float, *labels: str):
+        self.labels(*labels).set(value)
+
+    def get(self, *labels: str) -> float:
+        if self.func:
+            return self.func()
+        return self.labels(*labels).value
+
+    def children(self):
+        if self.func:
+            child = _GaugeChild()
+            child.set(self.func())
+            return [((), child)]
+        return super().children()
+
+
+class _HistogramChild(object):
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets: typing.Sequence[float]):
+        self.buckets = buckets
+        # One count per bucket, plus one for +Inf
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        """Estimate a quantile by interpolating within the bucket it falls in"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        lower = 0.0
+        for idx, count in enumerate(self.counts):
+            if seen + count >= rank and count:
+                if idx == len(self.buckets):
+                    return self.buckets[-1]
+                upper = self.buckets[idx]
+                return lower + (upper - lower) * ((rank - seen) / count)
+            seen += count
+            if idx < len(self.buckets):
+                lower = self.buckets[idx]
+        return self.buckets[-1]
+
+    def expose(self, name: str, labels: str) -> typing.List[str]:
+        lines = []
+        prefix = labels[:-1] + "," if labels else "{"
+        cumulative = 0
+        for bound, count in zip(list(self.buckets) + ["+Inf"], self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{prefix}le="{bound}"}} {cumulative}')
+        lines.append(f"{name}_sum{labels} {self.sum}")
+        lines.append(f"{name}_count{labels} {self.count}")
+        return lines
+
+
+class Histogram(_Metric):
+    """A distribution of values, counted into buckets"""
+
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labelnames: typing.Sequence[str] = (),
+        buckets: typing.Sequence[float] = DEFAULT_LATENCY_BUCKETS,
+    ):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value: float, *labels: str):
+        self.labels(*labels).observe(value)
+
+
+class Registry(object):
+    """A collection of metrics"""
+
+    def __init__(self):
+        self.metrics: typing.List[_Metric] = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def expose(self) -> str:
+        """Render all metrics in the Prometheus text exposition format"""
+        lines = []
+        for metric in self.metrics:
+            lines += metric.expose()
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+"""The global metrics registry"""
+
+STARTED = time.time()
+"""When the process started, in seconds since the epoch"""
+
+
+async def start_metrics_server(host: str, port: int) -> web.AppRunner:
+    """Start an HTTP server that exposes metrics at /metrics
+
+    Returns the aiohttp AppRunner; call its cleanup() method to stop the server.
+    """
+
+    async def _metrics(_request):
+        return web.Response(
+            text=REGISTRY.expose(), content_type="text/plain", charset="utf-8"
+        )
+
+    app = web.Application()
+    app.router.add_get("/metrics", _metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    LOGGER.info(f"Serving metrics at http://{host}:{port}/metrics")
+    return runner
+
+
+EVENTS_RECEIVED = REGISTRY.register(
+    Counter(
+        "trappedbot_events_received", "Events received from the homeserver", ["type"]
+    )
+)
+COMMANDS_DISPATCHED = REGISTRY.register(
+    Counter(
+        "trappedbot_commands_dispatched", "Commands dispatched to tasks", ["command"]
+    )
+)
+TASK_LATENCY = REGISTRY.register(
+    Histogram(
+        "trappedbot_task_seconds", "Time taken to run a task and reply", ["command"]
+    )
+)
+TASK_ERRORS = REGISTRY.register(
+    Counter("trappedbot_task_errors", "Tasks that raised an error", ["command"])
+)
+ROOM_SEND_LATENCY = REGISTRY.register(
+    Histogram("trappedbot_room_send_seconds", "Time taken to send an event to a room")
+)
+ROOM_SEND_FAILURES = REGISTRY.register(
+    Counter("trappedbot_room_send_failures", "Events that could not be sent to a room")
+)
+RATELIMIT_BACKOFFS = REGISTRY.register(
+    Counter(
+        "trappedbot_ratelimit_backoffs", "Commands refused by a rate limit", ["scope"]
+    )
+)
+SYNC_DURATION = REGISTRY.register(
+    Histogram(
+        "trappedbot_sync_seconds",
+        "Duration of sync requests to the homeserver, including long polling",
+    )
+)
+CACHE_REQUESTS = REGISTRY.register(
+    Counter(
+        "trappedbot_cache_requests",
+        "Lookups in internal caches, by whether they hit or missed",
+        ["cache", "result"],
+    )
+)
+LAST_SYNC_DURATION = REGISTRY.register(
+    Gauge("trappedbot_last_sync_seconds", "Duration of the most recent sync request")
+)
+SYNC_FAILURES = REGISTRY.register(
+    Counter(
+        "trappedbot_sync_failures",
+        "Failed syncs and connection errors, before backing off",
+        ["reason"],
+    )
+)
@@ -1,9 +1,16 @@
 """Matrix utilities for trappedbot"""
 
 import enum
+import functools
 import re
 
 
+MXID_CACHE_SIZE = 4096
+"""Maximum number of parsed Matrix IDs to keep in the `Mxid.fromstr` cache"""
+
+_MXID_REGEX = re.compile(r"\@([a-zA-Z0-9-_]+)\:([a-zA-Z0-9-_]+\.[a-zA-Z0-9-_]+)$")
+
+
 class InvalidMxidError(ValueError):
     """An invalid Matrix ID (mxid)"""
 
@@ -15,24 +22,40 @@ class InvalidMxidError(ValueError):
 
 
 class Mxid(object):
+    """A parsed Matrix ID
+
+    Instances returned by `fromstr` are cached and shared, so do not modify them.
+    """
+
     def __init__(self, user: str, homeserver: str):
         self.user = user
         self.homeserver = homeserver
+        self._mxid = f"@{user}:{homeserver}"
 
     @property
     def mxid(self):
-        return f"@{self.user}:{self.homeserver}"
+        return self._mxid
 
     @classmethod
     def fromstr(cls, mxid: str) -> "Mxid":
-        m = re.match(r"\@([a-zA-Z0-9-_]+)\:([a-zA-Z0-9-_]+\.[a-zA-Z0-9-_]+)$", mxid)
-        if not m:
-            raise InvalidMxidError(mxid)
-        username = m.group(1)
-        homeserver = m.group(2)
-        if not username or not homeserver:
-            raise InvalidMxidError(mxid)
-        return Mxid(username, homeserver)
+        return _parse_mxid(mxid)
+
+
+@functools.lru_cache(maxsize=MXID_CACHE_SIZE)
+def _parse_mxid(mxid: str) -> Mxid:
+    """Parse a Matrix ID
+
+    The same few users send most commands, so results are cached.
+    Invalid IDs raise, and are not cached.
+    """
+    m = _MXID_REGEX.match(mxid)
+    if not m:
+        raise InvalidMxidError(mxid)
+    username = m.group(1)
+    homeserver = m.group(2)
+    if not username or not homeserver:
+        raise InvalidMxidError(mxid)
+    return Mxid(username, homeserver)
 
 
 class MessageFormat(enum.Enum):
@@ -0,0 +1,179 @@
+"""Server-side pagination of large task output
+
+Rather than flooding a room with thousands of lines,
+oversized output is split into pages.
+The first page is sent right away,
+and the rest are kept in a buffer for the user who ran the command in that room,
+who can fetch them one at a time with the builtin `more` command.
+
+Buffers are kept in a least-recently-used order and expire after a TTL,
+and both the number of buffers and the number of pages per buffer are capped,
+so memory use stays bounded no matter how much output tasks produce.
+"""
+
+import collections
+import time
+import typing
+
+from nio.client.async_client import AsyncClient
+
+from trappedbot import appconfig
+from trappedbot.chat_functions import send_text_to_room
+from trappedbot.metrics import CACHE_REQUESTS, REGISTRY, Gauge
+from trappedbot.mxutil import MessageFormat
+from trappedbot.splitting import split_by_size
+
+
+PagerKey = typing.Tuple[str, str, str]
+"""A (bot, room, sender) tuple that identifies an output buffer
+
+The bot is the bot's user ID, since several bots may run in one process.
+"""
+
+
+class PagedOutput(object):
+    """The remaining pages of some task output
+
+    pages:      Pages that have not yet been sent
+    format:     The format of the pages
+    split:      The split string of the task that produced the output
+    total:      The total number of pages, including those already sent
+    expires:    When the buffer expires, in time.monotonic() seconds
+    """
+
+    def __init__(
+        self,
+        pages: typing.Deque[str],
+        format: MessageFormat,
+        split: typing.Optional[str],
+        total: int,
+        expires: float,
+    ):
+        self.pages = pages
+        self.format = format
+        self.split = split
+        self.total = total
+        self.expires = expires
+
+    @property
+    def current(self) -> int:
+        """The number of the next page that will be sent"""
+        return self.total - len(self.pages) + 1
+
+
+class Pager(object):
+    """A bounded store of paged output, keyed by bot, room and sender"""
+
+    def __init__(self):
+        self._buffers: "collections.OrderedDict[PagerKey, PagedOutput]" = (
+            collections.OrderedDict()
+        )
+
+    def __len__(self):
+        return len(self._buffers)
+
+    def _expire(self, now: float):
+        # Every access moves a buffer to the end and renews its TTL,
+        # so the buffers are also in order of expiry.
+        while self._buffers:
+            key, paged = next(iter(self._buffers.items()))
+            if paged.expires > now:
+                break
+            del self._buffers[key]
+
+    def store(
+        self,
+        key: PagerKey,
+        pages: typing.List[str],
+        format: MessageFormat,
+        split: typing.Optional[str] = None,
+    ):
+        """Store pages for later retrieval, replacing any previous buffer for key"""
+        config = appconfig.get()
+        now = time.monotonic()
+        self._expire(now)
+        self._buffers.pop(key, None)
+        if not pages:
+            return
+        if config.page_max and len(pages) > config.page_max:
+            dropped = len(pages) - config.page_max
+            pages = pages[: config.page_max]
+            pages[-1] += f"\n\n[... output truncated, {dropped} more pages not kept ...]"
+        self._buffers[key] = PagedOutput(
+            collections.deque(pages), format, split, len(pages), now + config.page_ttl
+        )
+        while len(self._buffers) > config.page_buffers:
+            self._buffers.popitem(last=False)
+
+    def next(self, key: PagerKey) -> typing.Optional[typing.Tuple[str, PagedOutput]]:
+        """Retrieve the next page for key, if there is one
+
+        Returns a tuple of the page text and the buffer it came from.
+        """
+        config = appconfig.get()
+        now = time.monotonic()
+        self._expire(now)
+        paged = self._buffers.get(key)
+        if paged is None:
+            CACHE_REQUESTS.inc("pager", "miss")
+            return None
+        CACHE_REQUESTS.inc("pager", "hit")
+        page = paged.pages.popleft()
+        if paged.pages:
+            paged.expires = now + config.page_ttl
+            self._buffers.move_to_end(key)
+        else:
+            del self._buffers[key]
+        return page, paged
+
+
+PAGER = Pager()
+"""The global pager"""
+
+REGISTRY.register(
+    Gauge(
+        "trappedbot_pager_buffers",
+        "Paged output buffers waiting for the more command",
+        func=lambda: len(PAGER),
+    )
+)
+
+
+def page_footer(paged: PagedOutput) -> str:
+    """A message explaining how to fetch the next page"""
+    config = appconfig.get()
+    if not paged.pages:
+        return f"End of output ({paged.total} pages)."
+    return (
+        f"Page {paged.current - 1} of {paged.total}. "
+        f"Send `{config.command_prefix} more` for the next page."
+    )
+
+
+async def send_paged_text_to_room(
+    client: AsyncClient,
+    room_id: str,
+    sender: str,
+    message: str,
+    format: MessageFormat,
+    split: typing.Optional[str] = None,
+):
+    """Send text to a room, keeping all but the first page for the `more` command
+
+    If the message fits on a single page, it is sent as normal.
+    """
+    config = appconfig.get()
+    pages = split_by_size(message, config.page_size, format)
+    if len(pages) == 1:
+        await send_text_to_room(client, room_id, message, format=format, split=split)
+        return
+    key = (config.user_id, room_id, sender)
+    PAGER.store(key, pages, format, split)
+    paged_next = PAGER.next(key)
+    if paged_next is None:
+        return
+    page, paged = paged_next
+    await send_text_to_room(client, room_id, page, format=format, split=split)
+    await send_text_to_room(
+        client, room_id, page_footer(paged), format=MessageFormat.MARKDOWN
+    )
@@ -0,0 +1,170 @@
+"""Token-bucket rate limiting for commands
+
+Each limiter holds one bucket per key (a sender, a room, or a command name).
+A bucket holds up to `burst` tokens and refills at `rate` tokens per second;
+each command costs one token, and a command is refused when any bucket it
+draws from is empty.
+
+Buckets are kept in least-recently-used order.
+A bucket that has been idle long enough to refill completely is
+indistinguishable from a new one, so it is evicted the next time the limiter
+is used; the total number of buckets is also capped.
+This keeps every check O(1) and the memory used by a limiter bounded,
+even when someone is deliberately spamming the bot from many accounts.
+"""
+
+import collections
+import time
+import typing
+
+
+DEFAULT_RATELIMIT_MAX_KEYS = 10000
+"""Default maximum number of buckets a single limiter keeps"""
+
+
+class RateLimitSpec(typing.NamedTuple):
+    """The parameters of a token bucket
+
+    rate:   Tokens added per second
+    burst:  Maximum number of tokens the bucket can hold
+    """
+
+    rate: float
+    burst: float
+
+
+def yamlobj2ratelimitspec(
+    yamlobj: typing.Optional[typing.Dict],
+) -> typing.Optional[RateLimitSpec]:
+    """Make a RateLimitSpec from a YAML object like {rate: 0.5, burst: 5}"""
+    if not yamlobj:
+        return None
+    rate = float(yamlobj["rate"])
+    return RateLimitSpec(rate, float(yamlobj.get("burst", max(rate, 1))))
+
+
+class TokenBucketLimiter(object):
+    """A set of token buckets that share the same rate and burst
+
+    Each bucket is stored as a [tokens, last_update, warned] list.
+    `warned` records whether we have already told the user they are limited,
+    so that being rate limited does not itself cause a flood of replies.
+    """
+
+    def __init__(self, spec: RateLimitSpec, max_keys: int = DEFAULT_RATELIMIT_MAX_KEYS):
+        self.spec = spec
+        self.max_keys = max_keys
+        # After this many seconds a bucket is full again and can be forgotten
+        self.idle = spec.burst / spec.rate if spec.rate > 0 else float("inf")
+        self._buckets: "collections.OrderedDict[str, list]" = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def _evict(self, now: float):
+        while self._buckets:
+            key, bucket = next(iter(self._buckets.items()))
+            if now - bucket[1] < self.idle and len(self._buckets) <= self.max_keys:
+                break
+            del self._buckets[key]
+
+    def _bucket(self, key: str, now: float) -> list:
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = [self.spec.burst, now, False]
+            self._buckets[key] = bucket
+        else:
+            bucket[0] = min(
+                self.spec.burst, bucket[0] + (now - bucket[1]) * self.spec.rate
+            )
+            bucket[1] = now
+            self._buckets.move_to_end(key)
+        return bucket
+
+    def wait(self, key: str, now: float) -> float:
+        """Return how many seconds until key has a token available (0 if it has one now)
+
+        This does not consume a token.
+        """
+        self._evict(now)
+        bucket = self._bucket(key, now)
+        if bucket[0] >= 1:
+            return 0.0
+        if self.spec.rate <= 0:
+            return float("inf")
+        return (1 - bucket[0]) / self.spec.rate
+
+    def consume(self, key: str):
+        """Take a token from key's bucket, which must have been checked with wait()"""
+        bucket = self._buckets[key]
+        bucket[0] -= 1
+        bucket[2] = False
+
+    def warn(self, key: str) -> bool:
+        """Return True the first time key is refused since it last had a token"""
+        bucket = self._buckets[key]
+        first = not bucket[2]
+        bucket[2] = True
+        return first
+
+
+class RateLimitDecision(typing.NamedTuple):
+    """Whether a command may run
+
+    allowed:    True if the command may run
+    wait:       If not allowed, seconds until it may run again
+    scope:      If not allowed, which limit refused it ('user', 'room' or 'command')
+    warn:       If not allowed, whether the user should be told about it
+    """
+
+    allowed: bool
+    wait: float = 0.0
+    scope: str = ""
+    warn: bool = False
+
+
+class RateLimits(object):
+    """Rate limits by sender, by room, and by command name
+
+    Any of the limits may be None, in which case it is not enforced.
+    Individual commands may have their own limit,
+    which replaces the default command limit for that command.
+    """
+
+    def __init__(
+        self,
+        user: typing.Optional[RateLimitSpec] = None,
+        room: typing.Optional[RateLimitSpec] = None,
+        command: typing.Optional[RateLimitSpec] = None,
+        commands: typing.Optional[typing.Dict[str, RateLimitSpec]] = None,
+        max_keys: int = DEFAULT_RATELIMIT_MAX_KEYS,
+    ):
+        self.user = TokenBucketLimiter(user, max_keys) if user else None
+        self.room = TokenBucketLimiter(room, max_keys) if room else None
+        self.command = TokenBucketLimiter(command, max_keys) if command else None
+        self.commands = {
+            name: TokenBucketLimiter(spec, 1) for name, spec in (commands or {}).items()
+        }
+
+    def check(
+        self, sender: str, room: str, command: typing.Optional[str]
+    ) -> RateLimitDecision:
+        """Check all limits for a command, consuming a token from each if allowed"""
+        now = time.monotonic()
+        limits: typing.List[typing.Tuple[str, TokenBucketLimiter, str]] = []
+        if self.user is not None:
+            limits.append(("user", self.user, sender))
+        if self.room is not None:
+            limits.append(("room", self.room, room))
+        if command is not None:
+            cmdlimiter = self.commands.get(command, self.command)
+            if cmdlimiter is not None:
+                limits.append(("command", cmdlimiter, command))
+
+        for scope, limiter, key in limits:
+            wait = limiter.wait(key, now)
+            if wait > 0:
+                return RateLimitDecision(False, wait, scope, limiter.warn(key))
+        for _, limiter, key in limits:
+            limiter.consume(key)
+        return RateLimitDecision(True)
@@ -0,0 +1,181 @@
+"""Record and replay the events that reach the bot's callbacks
+
+`trappedbot bot --record FILE` writes every room message the bot receives to FILE,
+and `trappedbot replay CONFIG FILE` feeds them back through `Callbacks.handle`
+with an in-memory fake client, to measure how the bot performs on real traffic.
+
+Recordings are gzip-compressed JSON lines.
+The first line is a header; every other line is one event:
+
+    {"trappedbot_recording": 1, "user_id": "@bot:example.com"}
+    {"t": 12.345, "room": "!room:example.com", "event": {...the event source...}}
+
+where `t` is seconds since recording started.
+
+The recorder flushes the file at most once a second,
+so a recording is readable even if the bot is killed while recording.
+"""
+
+import asyncio
+import gzip
+import json
+import statistics
+import time
+import typing
+
+from nio.events.room_events import Event, RoomMessage
+from nio.rooms import MatrixRoom
+
+from trappedbot.applogger import LOGGER
+from trappedbot.callbacks import Callbacks
+from trappedbot.fakeclient import FakeAsyncClient, fake_room
+
+
+RECORDING_VERSION = 1
+"""The version of the recording format"""
+
+RECORDING_FLUSH_INTERVAL = 1.0
+"""Minimum seconds between flushes of a recording"""
+
+
+class Recorder(object):
+    """Record room messages to a compressed file
+
+    Use `record` as a nio event callback.
+    """
+
+    def __init__(self, filepath: str, user_id: str):
+        self.filepath = filepath
+        self.started = time.monotonic()
+        self.count = 0
+        self._flushed = self.started
+        self._fp = gzip.open(filepath, "wt", encoding="utf-8")
+        self._write({"trappedbot_recording": RECORDING_VERSION, "user_id": user_id})
+
+    def _write(self, obj: typing.Dict):
+        self._fp.write(json.dumps(obj, separators=(",", ":")) + "\n")
+
+    async def record(self, room: MatrixRoom, event: RoomMessage):
+        now = time.monotonic()
+        self._write(
+            {
+                "t": round(now - self.started, 3),
+                "room": room.room_id,
+                "event": event.source,
+            }
+        )
+        self.count += 1
+        if now - self._flushed >= RECORDING_FLUSH_INTERVAL:
+            self.flush()
+
+    def flush(self):
+        self._fp.flush()
+        self._flushed = time.monotonic()
+
+    def close(self):
+        self._fp.close()
+        LOGGER.info(f"Recorded {self.count} events to {self.filepath}")
+
+
+class RecordedEvent(typing.NamedTuple):
+    offset: float
+    room_id: str
+    event: Event
+
+
+def read_recording(
+    filepath: str,
+) -> typing.Tuple[str, typing.List[RecordedEvent]]:
+    """Read a recording, returning the bot's user ID and the recorded events"""
+    with gzip.open(filepath, "rt", encoding="utf-8") as fp:
+        header = json.loads(fp.readline())
+        if header.get("trappedbot_recording") != RECORDING_VERSION:
+            raise ValueError(f"{filepath} is not a trappedbot recording")
+        events = []
+        try:
+            for line in fp:
+                obj = json.loads(line)
+                event = Event.parse_event(obj["event"])
+                events.append(RecordedEvent(obj["t"], obj["room"], event))
+        except (EOFError, json.JSONDecodeError):
+            # The bot was stopped without closing the file; use what was flushed
+            LOGGER.warning(f"Recording {filepath} is truncated")
+    return header["user_id"], events
+
+
+def _percentile(values: typing.List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+async def replay(
+    filepath: str, speed: float = 1.0, latency: float = 0.0
+) -> typing.Dict[str, typing.Any]:
+    """Replay a recording through Callbacks.handle, and report on it
+
+    speed:      How much faster than real time to replay;
+                0 replays every event as fast as possible
+    latency:    Simulated homeserver latency for each request the bot makes
+
+    Each event is passed to `Callbacks.handle` when it is due, like the bot does,
+    so a slow command does not hold up the events after it,
+    and replies to each room are sent in the order its events were recorded.
+    Latency is measured from when an event is due until the bot has finished
+    handling it, including sending any replies.
+
+    The application must already be configured.
+    """
+    user_id, events = read_recording(filepath)
+    client = FakeAsyncClient(user_id, latency=latency, keep=False)
+    callbacks = Callbacks(client, None)
+    rooms: typing.Dict[str, MatrixRoom] = {}
+    latencies: typing.List[float] = []
+    errors = 0
+
+    async def _handled(recorded: RecordedEvent, handling: asyncio.Future, due: float):
+        nonlocal errors
+        try:
+            await handling
+        except Exception as exc:
+            errors += 1
+            LOGGER.error(f"Error replaying event {recorded.event.event_id}: {exc}")
+        latencies.append(time.perf_counter() - due)
+
+    tasks = []
+    started = time.perf_counter()
+    for recorded in events:
+        if not isinstance(recorded.event, RoomMessage):
+            continue
+        due = started + (recorded.offset / speed if speed else 0)
+        if (delay := due - time.perf_counter()) > 0:
+            await asyncio.sleep(delay)
+        else:
+            # Let the tasks we have started make progress
+            await asyncio.sleep(0)
+        room = rooms.get(recorded.room_id)
+        if room is None:
+            room = rooms[recorded.room_id] = fake_room(recorded.room_id, user_id)
+        # Hand it over right away, so that it takes its turn in its room in order
+        handling = callbacks.handle(room, recorded.event)
+        tasks.append(asyncio.ensure_future(_handled(recorded, handling, due)))
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "recording": filepath,
+        "speed": speed,
+        "events": len(tasks),
+        "errors": errors,
+        "messages_sent": client.sent_count,
+        "elapsed": round(elapsed, 3),
+        "throughput": round(len(tasks) / elapsed, 2) if elapsed else 0.0,
+        "latency_ms": {
+            "mean": round(statistics.mean(latencies) * 1000, 3) if latencies else 0,
+            "p50": round(_percentile(latencies, 0.50) * 1000, 3),
+            "p90": round(_percentile(latencies, 0.90) * 1000, 3),
+            "p99": round(_percentile(latencies, 0.99) * 1000, 3),
+            "max": round(latencies[-1] * 1000, 3) if latencies else 0,
+        },
+    }
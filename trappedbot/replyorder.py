@@ -0,0 +1,156 @@
+"""Send replies to each room in the order of the messages they reply to
+
+The bot handles each message it receives in its own asyncio task,
+so that a slow command does not hold up the messages after it,
+and so that the builtin `cancel` command can cancel it while it runs.
+But people expect the bot's replies to appear in the order they sent their messages.
+
+So each message takes a turn in its room when it is received,
+and everything sent to that room while handling it waits for the messages before it.
+Commands still run at the same time; only sending waits, and never for long:
+
+* What a message sends before its command starts, like responses, "Unknown command",
+  "Not authorized" and "Slow down!", only waits for the earlier messages
+  that have not started a command yet, which takes no time at all.
+* What a message sends once its command has started, like the command's output,
+  waits for the earlier messages to be handled,
+  but not for a command that has been running for more than REPLY_ORDER_WAIT seconds.
+  A command that hangs holds up the replies after it for no longer than that,
+  and its own reply may come after them.
+
+The current turn is kept in a context variable, like the current trace,
+which asyncio copies into tasks it creates,
+so anything that sends to a room below `Callbacks.handle` waits for its turn.
+Sends outside of handling a message, like scheduled commands and feeds, never wait.
+"""
+
+import asyncio
+import contextlib
+import contextvars
+import typing
+
+
+REPLY_ORDER_WAIT = 2.0
+"""Seconds a running command holds up the replies to the messages after it"""
+
+
+def _resolve(future: asyncio.Future):
+    if not future.done():
+        future.set_result(None)
+
+
+def _resolve_after(previous: typing.Optional[asyncio.Future], future: asyncio.Future):
+    """Resolve future once previous is resolved"""
+    if previous is None or previous.done():
+        _resolve(future)
+    else:
+        previous.add_done_callback(lambda _: _resolve(future))
+
+
+class Turn(object):
+    """A message's place in the order of replies to its room
+
+    started:    Whether the message has started running a command
+    quiet:      Resolved once this message, and every message before it in the room,
+                has started a command or been handled
+    clear:      Resolved once this message, and every message before it in the room,
+                has been handled, or has been running a command for too long
+    """
+
+    __slots__ = (
+        "room_id",
+        "started",
+        "quiet",
+        "clear",
+        "_previous_quiet",
+        "_previous_clear",
+        "_timer",
+    )
+
+    def __init__(self, room_id: str, previous: typing.Optional["Turn"]):
+        loop = asyncio.get_event_loop()
+        self.room_id = room_id
+        self.started = False
+        self.quiet = loop.create_future()
+        self.clear = loop.create_future()
+        self._previous_quiet = previous.quiet if previous else None
+        self._previous_clear = previous.clear if previous else None
+        self._timer: typing.Optional[asyncio.TimerHandle] = None
+
+    async def wait(self):
+        """Wait until this message may send"""
+        previous = self._previous_clear if self.started else self._previous_quiet
+        if previous is not None:
+            # Shield it, so that cancelling this message does not cancel the chain
+            await asyncio.shield(previous)
+
+    def start(self):
+        """Record that this message has started running a command"""
+        if self.started:
+            return
+        self.started = True
+        _resolve_after(self._previous_quiet, self.quiet)
+        self._timer = asyncio.get_event_loop().call_later(
+            REPLY_ORDER_WAIT, self._release
+        )
+
+    def finish(self):
+        """Record that this message has been handled"""
+        if self._timer is not None:
+            self._timer.cancel()
+        _resolve_after(self._previous_quiet, self.quiet)
+        self._release()
+
+    def _release(self):
+        _resolve_after(self._previous_clear, self.clear)
+
+
+class ReplyOrder(object):
+    """The latest turn in each room"""
+
+    def __init__(self):
+        self._last: typing.Dict[str, Turn] = {}
+
+    def __len__(self):
+        return len(self._last)
+
+    def take(self, room_id: str) -> Turn:
+        """Take the next turn in a room"""
+        turn = Turn(room_id, self._last.get(room_id))
+        self._last[room_id] = turn
+
+        def _forget(_):
+            # Forget rooms with nothing in progress, so idle rooms cost nothing
+            if self._last.get(room_id) is turn:
+                del self._last[room_id]
+
+        turn.clear.add_done_callback(_forget)
+        return turn
+
+
+_TURN: "contextvars.ContextVar[typing.Optional[Turn]]" = contextvars.ContextVar(
+    "trappedbot_turn", default=None
+)
+
+
+@contextlib.contextmanager
+def taking(turn: Turn):
+    """Handle a message in its turn, finishing the turn when done"""
+    token = _TURN.set(turn)
+    try:
+        yield
+    finally:
+        _TURN.reset(token)
+        turn.finish()
+
+
+def start_turn(room_id: str):
+    """Record that the current message has started running a command in a room"""
+    if (turn := _TURN.get()) is not None and turn.room_id == room_id:
+        turn.start()
+
+
+async def wait_turn(room_id: str):
+    """Wait until the current message may send to a room"""
+    if (turn := _TURN.get()) is not None and turn.room_id == room_id:
+        await turn.wait()
@@ -0,0 +1,250 @@
+"""Run commands on a schedule
+
+Schedules are defined in the config file with cron expressions,
+and run a configured command, posting its output to a room.
+
+All schedules are kept in a single heap ordered by when they are next due,
+and run by one coroutine that sleeps until the earliest of them,
+so thousands of schedules cost no more than one timer.
+When each schedule last ran is kept in the bot database,
+so that restarting the bot does not run a schedule twice for the same time.
+Runs that were missed while the bot was stopped are skipped, not made up.
+"""
+
+import asyncio
+import datetime
+import heapq
+import itertools
+import random
+import shlex
+import time
+import typing
+
+from nio import AsyncClient
+
+from trappedbot import appconfig
+from trappedbot.applogger import LOGGER
+from trappedbot.commands.command import run_task
+from trappedbot.configuration import ConfigError
+from trappedbot.shutdown import DRAIN
+from trappedbot.storage import Storage
+from trappedbot.tasks.running import RUNNING
+from trappedbot.tasks.task import TaskMessageContext
+from trappedbot.util import BackgroundTasks
+
+
+SCHEDULER_MAX_SLEEP = 60.0
+"""Maximum seconds to sleep at once, so that the scheduler notices clock changes"""
+
+_CRON_ALIASES = {
+    "@yearly": "0 0 1 1 *",
+    "@annually": "0 0 1 1 *",
+    "@monthly": "0 0 1 * *",
+    "@weekly": "0 0 * * 0",
+    "@daily": "0 0 * * *",
+    "@midnight": "0 0 * * *",
+    "@hourly": "0 * * * *",
+}
+
+# Enough to find the next run of any expression that runs at all,
+# like "0 0 29 2 *" (Feb 29), which can be years away
+_CRON_MAX_STEPS = 100000
+
+
+def _parse_cron_field(field: str, low: int, high: int) -> typing.FrozenSet[int]:
+    values: typing.Set[int] = set()
+    for part in field.split(","):
+        span, _, stepstr = part.partition("/")
+        step = int(stepstr) if stepstr else 1
+        if span == "*":
+            start, end = low, high
+        elif "-" in span:
+            start, end = (int(v) for v in span.split("-", 1))
+        else:
+            start = int(span)
+            end = high if stepstr else start
+        if step < 1 or not low <= start <= end <= high:
+            raise ValueError(f"Invalid cron field '{field}'")
+        values.update(range(start, end + 1, step))
+    return frozenset(values)
+
+
+class CronSpec(object):
+    """A parsed cron expression
+
+    Supports the standard five fields (minute, hour, day of month, month, day of week)
+    with lists, ranges and steps, and aliases like @hourly and @daily.
+    Times are in the bot's local time zone.
+    """
+
+    def __init__(self, expression: str):
+        self.expression = expression
+        fields = _CRON_ALIASES.get(expression, expression).split()
+        if len(fields) != 5:
+            raise ValueError(f"Cron expression '{expression}' must have five fields")
+        self.minutes = _parse_cron_field(fields[0], 0, 59)
+        self.hours = _parse_cron_field(fields[1], 0, 23)
+        self.days = _parse_cron_field(fields[2], 1, 31)
+        self.months = _parse_cron_field(fields[3], 1, 12)
+        # Sunday is 0 or 7
+        self.weekdays = frozenset(d % 7 for d in _parse_cron_field(fields[4], 0, 7))
+        # Like cron, if both days of the month and of the week are restricted,
+        # a day matching either one will do
+        self._either_day = fields[2] != "*" and fields[4] != "*"
+
+    def _day_matches(self, dt: datetime.datetime) -> bool:
+        day = dt.day in self.days
+        weekday = (dt.weekday() + 1) % 7 in self.weekdays
+        return (day or weekday) if self._either_day else (day and weekday)
+
+    def next_after(self, timestamp: float) -> float:
+        """Return the first time after timestamp that the expression matches"""
+        dt = datetime.datetime.fromtimestamp(timestamp).replace(
+            second=0, microsecond=0
+        ) + datetime.timedelta(minutes=1)
+        for _ in range(_CRON_MAX_STEPS):
+            if dt.month not in self.months:
+                dt = (dt.replace(day=1) + datetime.timedelta(days=32)).replace(
+                    day=1, hour=0, minute=0
+                )
+            elif not self._day_matches(dt):
+                dt = (dt + datetime.timedelta(days=1)).replace(hour=0, minute=0)
+            elif dt.hour not in self.hours:
+                dt = (dt + datetime.timedelta(hours=1)).replace(minute=0)
+            elif dt.minute not in self.minutes:
+                dt += datetime.timedelta(minutes=1)
+            else:
+                return dt.timestamp()
+        raise ValueError(f"Cron expression '{self.expression}' never matches")
+
+
+class Schedule(typing.NamedTuple):
+    """A command to run on a schedule
+
+    name:       A unique name, used to remember when the schedule last ran
+    cron:       When to run
+    command:    The name of a configured command
+    arguments:  Arguments to pass to the command
+    room:       The room to post the command's output to
+    jitter:     Run up to this many seconds late, chosen at random each time,
+                to spread out schedules that would otherwise all run at once
+    """
+
+    name: str
+    cron: CronSpec
+    command: str
+    arguments: typing.List[str]
+    room: str
+    jitter: float = 0.0
+
+
+def yamlobj2schedules(
+    yamlobj: typing.Any, commands: typing.Dict[str, typing.Any]
+) -> typing.List[Schedule]:
+    """Return a list of Schedules from a YAML object"""
+    schedules = []
+    for item in yamlobj or []:
+        try:
+            cron = CronSpec(item["cron"])
+            cron.next_after(time.time())
+            cmdsplit = shlex.split(item["command"])
+            name = item.get("name") or f"{item['cron']} {item['command']}"
+            jitter = float(item.get("jitter", 0))
+            room = item["room"]
+        except (KeyError, ValueError) as exc:
+            raise ConfigError(f"Invalid schedule {item}: {exc}")
+        if cmdsplit[0] not in commands:
+            raise ConfigError(f"Schedule {name} runs unknown command {cmdsplit[0]}")
+        schedules.append(Schedule(name, cron, cmdsplit[0], cmdsplit[1:], room, jitter))
+    names = [s.name for s in schedules]
+    if len(set(names)) != len(names):
+        raise ConfigError("Each schedule must have a different name")
+    return schedules
+
+
+class Scheduler(object):
+    """Run a bot's schedules"""
+
+    def __init__(
+        self, schedules: typing.List[Schedule], store: typing.Optional[Storage]
+    ):
+        self.schedules = schedules
+        self.store = store
+        # Entries are (when to run, tiebreaker, schedule index, when it was due)
+        self._heap: typing.List[typing.Tuple[float, int, int, float]] = []
+        self._seq = itertools.count()
+        self._running = BackgroundTasks("running a schedule")
+
+    def _push(self, idx: int, due: float):
+        jitter = random.uniform(0, self.schedules[idx].jitter)
+        heapq.heappush(self._heap, (due + jitter, next(self._seq), idx, due))
+
+    def _next_due(self, schedule: Schedule, last: float, now: float) -> float:
+        due = schedule.cron.next_after(last)
+        if due + schedule.jitter < now:
+            LOGGER.info(
+                "Skipping missed runs of schedule %s since %s",
+                schedule.name,
+                time.ctime(due),
+            )
+            due = schedule.cron.next_after(now)
+        return due
+
+    async def run(self, client: AsyncClient):
+        """Run schedules forever"""
+        last_runs = self.store.schedule_runs() if self.store else {}
+        now = time.time()
+        for idx, schedule in enumerate(self.schedules):
+            last = last_runs.get(schedule.name, now)
+            self._push(idx, self._next_due(schedule, last, now))
+
+        while self._heap:
+            delay = self._heap[0][0] - time.time()
+            if delay > 0:
+                await asyncio.sleep(min(delay, SCHEDULER_MAX_SLEEP))
+                continue
+            now = time.time()
+            ran: typing.Dict[str, float] = {}
+            while self._heap and self._heap[0][0] <= now:
+                _, _, idx, due = heapq.heappop(self._heap)
+                schedule = self.schedules[idx]
+                self._running.start(self._run(client, schedule))
+                ran[schedule.name] = due
+                self._push(idx, self._next_due(schedule, due, now))
+            if self.store:
+                self.store.write_schedule_runs(ran)
+
+    async def _run(self, client: AsyncClient, schedule: Schedule):
+        if DRAIN.draining:
+            LOGGER.info("Not running schedule %s while shutting down", schedule.name)
+            return
+        config = appconfig.get()
+        command = config.commands.get(schedule.command)
+        if not command:
+            LOGGER.error(
+                f"Schedule {schedule.name} runs unknown command {schedule.command}"
+            )
+            return
+        LOGGER.debug("Running schedule %s", schedule.name)
+        taskctx = TaskMessageContext(config.user_id, schedule.room)
+        running = RUNNING.start(
+            config.user_id,
+            command.name,
+            taskctx,
+            run_task(client, command.task, schedule.arguments, taskctx),
+        )
+        reply = None
+        try:
+            reply = await asyncio.wait_for(running.future, command.task.timeout)
+        except asyncio.TimeoutError:
+            LOGGER.warning(
+                f"Schedule {schedule.name} timed out after {command.task.timeout} seconds"
+            )
+        except asyncio.CancelledError:
+            if not running.cancelled:
+                raise
+            LOGGER.info("Schedule %s was cancelled", schedule.name)
+        finally:
+            RUNNING.finish(running)
+        if reply is not None:
+            await reply()
@@ -0,0 +1,116 @@
+"""Drain the bot before it exits
+
+On SIGINT or SIGTERM, the bot stops syncing, so that it receives no new commands,
+and waits for the messages it has already received to be handled,
+including running commands and sending their replies,
+for up to `bot.shutdown_timeout` seconds.
+Then it stops the bots, which flushes their storage and closes their clients,
+and exits.
+Messages that arrive while the bot is draining are left on the homeserver,
+and the next run of the bot picks them up where this one stopped syncing.
+
+A second signal skips the wait.
+"""
+
+import asyncio
+import signal
+import time
+import typing
+
+from trappedbot.applogger import LOGGER
+from trappedbot.metrics import REGISTRY, Gauge
+from trappedbot.tasks.running import RUNNING
+
+
+DRAIN_POLL_INTERVAL = 0.1
+"""Seconds between checks for whether in-flight work has finished"""
+
+
+class Drain(object):
+    """In-flight work, and whether the bot is draining it to shut down"""
+
+    def __init__(self):
+        self.draining = False
+        self._handling = 0
+        self._callbacks: typing.List[typing.Callable[[], None]] = []
+
+    def begin(self):
+        """Count a message that has started being handled"""
+        self._handling += 1
+
+    def end(self):
+        """Count a message that has finished being handled"""
+        self._handling -= 1
+
+    @property
+    def handling(self) -> int:
+        return self._handling
+
+    @property
+    def idle(self) -> bool:
+        return not self._handling and not len(RUNNING)
+
+    def on_drain(self, callback: typing.Callable[[], None]):
+        """Call callback when draining starts, to stop accepting new work"""
+        self._callbacks.append(callback)
+
+    def start(self):
+        self.draining = True
+        for callback in self._callbacks:
+            callback()
+
+    async def wait_idle(self, timeout: float) -> bool:
+        """Wait up to timeout seconds for in-flight work to finish
+
+        Return whether it finished.
+        """
+        deadline = time.monotonic() + timeout
+        while not self.idle and time.monotonic() < deadline:
+            await asyncio.sleep(DRAIN_POLL_INTERVAL)
+        return self.idle
+
+
+DRAIN = Drain()
+"""The global record of in-flight work"""
+
+REGISTRY.register(
+    Gauge(
+        "trappedbot_messages_in_progress",
+        "Room messages that are being handled, including by worker processes",
+        func=lambda: DRAIN.handling,
+    )
+)
+
+
+async def drain(task: asyncio.Future, timeout: float):
+    """Drain in-flight work, then cancel task"""
+    DRAIN.start()
+    if not await DRAIN.wait_idle(timeout):
+        LOGGER.warning(
+            f"Stopping after {timeout}s with {DRAIN.handling} messages "
+            f"and {len(RUNNING)} commands still in progress"
+        )
+    task.cancel()
+
+
+def install_signal_handlers(task: asyncio.Future, timeout: float):
+    """Drain and then cancel task on SIGINT or SIGTERM
+
+    Where signal handlers are not supported, like on Windows,
+    Ctrl-C still raises KeyboardInterrupt.
+    """
+    loop = asyncio.get_event_loop()
+
+    def _handle(signame: str):
+        if DRAIN.draining:
+            LOGGER.warning(f"Received {signame} again, stopping now")
+            task.cancel()
+            return
+        LOGGER.info(f"Received {signame}, finishing in-flight commands...")
+        asyncio.ensure_future(drain(task, timeout))
+
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(signum, _handle, signum.name)
+        except NotImplementedError:
+            pass
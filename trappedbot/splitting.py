@@ -0,0 +1,235 @@
+"""Split message text into pieces that fit into a single Matrix event
+
+Homeservers reject events larger than 64KiB,
+and the content of a message is usually sent more than once
+(as the plain `body` and the HTML `formatted_body`),
+and may grow again when it is encrypted.
+Rather than sending one huge event that never shows up,
+we split long messages into several events that each fit within a byte budget.
+
+Splits happen at line boundaries,
+or for HTML at the end of block elements like table rows and paragraphs.
+Elements that are still open at a split (like a `<table>`, or a Markdown code fence)
+are closed at the end of one piece and reopened at the start of the next,
+so that each piece renders on its own.
+"""
+
+import json
+import re
+import typing
+
+from trappedbot.mxutil import MessageFormat
+
+
+CONTENT_OVERHEAD = 256
+"""Bytes reserved for the keys and punctuation of the event content itself"""
+
+# Tags that never have a closing tag
+_VOID_TAGS = {"br", "hr", "img", "wbr"}
+
+# Split HTML after any of these
+_HTML_BOUNDARY_REGEX = re.compile(
+    r"(</(?:tr|p|li|div|table|thead|tbody|ul|ol|pre|blockquote|h[1-6])>|<br\s*/?>|\n)",
+    re.IGNORECASE,
+)
+
+_HTML_TAG_REGEX = re.compile(r"<(/?)([a-zA-Z][a-zA-Z0-9]*)[^>]*?(/?)>")
+
+_MARKDOWN_FENCE_REGEX = re.compile(r"^\s*(`{3,}|~{3,})(.*)")
+
+
+def encoded_size(text: str) -> int:
+    """The number of bytes a string takes up once JSON-encoded in an event"""
+    return len(json.dumps(text)) - 2
+
+
+def size_factor(format: typing.Optional[MessageFormat]) -> int:
+    """Roughly how many times the message text is repeated in the event content"""
+    if format == MessageFormat.MARKDOWN:
+        # Once in the body, and once rendered into HTML, which adds tags
+        return 3
+    if format in (MessageFormat.FORMATTED, MessageFormat.CODE):
+        return 2
+    return 1
+
+
+def _hard_split(text: str, budget: int) -> typing.List[str]:
+    """Split a single overlong line into pieces of at most budget encoded bytes"""
+    pieces = []
+    current = ""
+    current_size = 0
+    for char in text:
+        size = encoded_size(char)
+        if current and current_size + size > budget:
+            pieces.append(current)
+            current = ""
+            current_size = 0
+        current += char
+        current_size += size
+    if current:
+        pieces.append(current)
+    return pieces
+
+
+class _Packer(object):
+    """Greedily pack segments into pieces that fit a byte budget
+
+    Subclasses track elements that must be closed at the end of a piece
+    and reopened at the start of the next one.
+    """
+
+    def __init__(self, budget: int):
+        self.budget = budget
+        self.pieces: typing.List[str] = []
+        self.current: typing.List[str] = []
+        self.size = 0
+        self.prefix = ""
+
+    def opening(self) -> str:
+        """Text to start a piece with, given the elements that are currently open"""
+        return ""
+
+    def closing(self) -> str:
+        """Text to end a piece with, given the elements that are currently open"""
+        return ""
+
+    def track(self, segment: str):
+        """Update the open elements after a segment"""
+
+    def add(self, segment: str):
+        size = encoded_size(segment)
+        closing = encoded_size(self.closing())
+        if self.current and self.size + size + closing > self.budget:
+            self.finish_piece()
+        if not self.current and self.size + size > self.budget:
+            for part in _hard_split(segment, max(self.budget - self.size, 1)):
+                self.current.append(part)
+                self.size += encoded_size(part)
+                self.finish_piece()
+        else:
+            self.current.append(segment)
+            self.size += size
+        self.track(segment)
+
+    def finish_piece(self):
+        if not self.current:
+            return
+        self.pieces.append(self.prefix + "".join(self.current) + self.closing())
+        self.current = []
+        self.prefix = self.opening()
+        self.size = encoded_size(self.prefix)
+
+    def result(self) -> typing.List[str]:
+        if self.current:
+            self.pieces.append(self.prefix + "".join(self.current))
+            self.current = []
+        return self.pieces
+
+
+class _HtmlPacker(_Packer):
+    """Pack HTML, reopening any elements that are open at a split"""
+
+    def __init__(self, budget: int):
+        super().__init__(budget)
+        self.stack: typing.List[typing.Tuple[str, str]] = []
+
+    def opening(self) -> str:
+        return "".join(tag for _, tag in self.stack)
+
+    def closing(self) -> str:
+        return "".join(f"</{name}>" for name, _ in reversed(self.stack))
+
+    def track(self, segment: str):
+        for match in _HTML_TAG_REGEX.finditer(segment):
+            close, name, selfclose = match.groups()
+            name = name.lower()
+            if selfclose or name in _VOID_TAGS:
+                continue
+            if not close:
+                self.stack.append((name, match.group(0)))
+                continue
+            for idx in range(len(self.stack) - 1, -1, -1):
+                if self.stack[idx][0] == name:
+                    del self.stack[idx:]
+                    break
+
+
+class _MarkdownPacker(_Packer):
+    """Pack Markdown lines, reopening a code fence that is open at a split"""
+
+    def __init__(self, budget: int):
+        super().__init__(budget)
+        # The line that opened the fence, and its ``` or ~~~ marker
+        self.fence = ""
+        self.marker = ""
+
+    def opening(self) -> str:
+        return self.fence
+
+    def closing(self) -> str:
+        return f"\n{self.marker}" if self.fence else ""
+
+    def track(self, segment: str):
+        match = _MARKDOWN_FENCE_REGEX.match(segment)
+        if not match:
+            return
+        marker, rest = match.groups()
+        if not self.fence:
+            self.fence, self.marker = segment, marker
+        elif (
+            marker[0] == self.marker[0]
+            and len(marker) >= len(self.marker)
+            and not rest.strip()
+        ):
+            # Only the same kind of fence, at least as long and with no info string,
+            # closes a fence
+            self.fence, self.marker = "", ""
+
+
+def _segments(message: str, format: typing.Optional[MessageFormat]):
+    """Split a message into the smallest pieces we are willing to split between"""
+    if format == MessageFormat.FORMATTED:
+        parts = _HTML_BOUNDARY_REGEX.split(message)
+        # re.split with a capturing group alternates text and boundaries;
+        # keep each boundary attached to the text before it.
+        for idx in range(0, len(parts), 2):
+            segment = parts[idx] + (parts[idx + 1] if idx + 1 < len(parts) else "")
+            if segment:
+                yield segment
+    else:
+        yield from message.splitlines(keepends=True)
+
+
+def split_by_size(
+    message: str,
+    max_size: int,
+    format: typing.Optional[MessageFormat] = MessageFormat.NATURAL,
+) -> typing.List[str]:
+    """Split a message into pieces whose event content fits in max_size bytes
+
+    message:    The message text
+    max_size:   The maximum size of the event content, in bytes
+    format:     The format the message will be sent in
+    """
+    factor = size_factor(format)
+    if (encoded_size(message) * factor) + CONTENT_OVERHEAD <= max_size:
+        return [message]
+
+    budget = max((max_size - CONTENT_OVERHEAD) // factor, 1)
+    packer: _Packer
+    if format == MessageFormat.FORMATTED:
+        packer = _HtmlPacker(budget)
+    elif format == MessageFormat.MARKDOWN:
+        packer = _MarkdownPacker(budget)
+    else:
+        packer = _Packer(budget)
+    for segment in _segments(message, format):
+        packer.add(segment)
+
+    pieces = []
+    for piece in packer.result():
+        # Trailing newlines at a split point are just noise in the room
+        piece = piece.rstrip("\n")
+        if piece.strip():
+            pieces.append(piece)
+    return pieces
@@ -1,12 +1,56 @@
 import sqlite3
 import os.path
 import logging
+import typing
 
-latest_db_version = 0
+latest_db_version = 3
 
 logger = logging.getLogger(__name__)
 
 
+# The statements that migrate the database to each version.
+# The database's version is kept in its user_version pragma.
+_MIGRATIONS: typing.Dict[int, typing.List[str]] = {
+    # Commands that have not finished; see trappedbot.jobs
+    1: [
+        "CREATE TABLE job ("
+        "job_id TEXT PRIMARY KEY, "
+        "command TEXT NOT NULL, "
+        "arguments TEXT NOT NULL, "
+        "sender TEXT NOT NULL, "
+        "room_id TEXT NOT NULL, "
+        "event TEXT NOT NULL, "
+        "state TEXT NOT NULL, "
+        "created REAL NOT NULL, "
+        "updated REAL NOT NULL"
+        ")",
+    ],
+    # When each scheduled command last ran; see trappedbot.scheduler
+    2: [
+        "CREATE TABLE schedule_run ("
+        "name TEXT PRIMARY KEY, "
+        "last_run REAL NOT NULL"
+        ")",
+    ],
+    # Feed polling state, and the feed items already posted; see trappedbot.feeds
+    3: [
+        "CREATE TABLE feed ("
+        "name TEXT PRIMARY KEY, "
+        "etag TEXT, "
+        "last_modified TEXT, "
+        "interval REAL NOT NULL"
+        ")",
+        "CREATE TABLE feed_item ("
+        "feed TEXT NOT NULL, "
+        "item_id TEXT NOT NULL, "
+        "seen REAL NOT NULL, "
+        "PRIMARY KEY (feed, item_id)"
+        ")",
+        "CREATE INDEX feed_item_seen ON feed_item (seen)",
+    ],
+}
+
+
 class Storage(object):
     def __init__(self, db_path):
         """Setup the database
@@ -40,6 +84,7 @@ class Storage(object):
             "token TEXT NOT NULL"
             ")"
         )
+        self._migrate(0)
 
         logger.info("Database setup complete")
 
@@ -48,3 +93,106 @@ class Storage(object):
         # Initialize a connection to the database
         self.conn = sqlite3.connect(self.db_path)
         self.cursor = self.conn.cursor()
+
+        self.cursor.execute("PRAGMA user_version")
+        self._migrate(self.cursor.fetchone()[0])
+
+    def _migrate(self, version: int):
+        """Migrate the database from version to the latest version"""
+        for target in range(version + 1, latest_db_version + 1):
+            logger.info(f"Migrating database to version {target}...")
+            with self.conn:
+                for statement in _MIGRATIONS[target]:
+                    self.cursor.execute(statement)
+                self.cursor.execute(f"PRAGMA user_version = {target}")
+
+    def close(self):
+        """Close the database connection"""
+        self.conn.close()
+
+    def write_jobs(
+        self,
+        upserts: typing.Sequence[typing.Tuple],
+        deletes: typing.Sequence[str],
+    ):
+        """Insert or update some jobs and delete others, in a single transaction
+
+        upserts:    Rows of (job_id, command, arguments, sender, room_id, event,
+                    state, created, updated)
+        deletes:    IDs of jobs to delete
+        """
+        with self.conn:
+            self.cursor.executemany(
+                "INSERT OR REPLACE INTO job VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                upserts,
+            )
+            self.cursor.executemany(
+                "DELETE FROM job WHERE job_id = ?", [(job_id,) for job_id in deletes]
+            )
+
+    def unfinished_jobs(self) -> typing.List[typing.Tuple]:
+        """Return the rows of all jobs in the table, oldest first"""
+        self.cursor.execute("SELECT * FROM job ORDER BY created")
+        return self.cursor.fetchall()
+
+    def schedule_runs(self) -> typing.Dict[str, float]:
+        """Return when each schedule last ran, in seconds since the epoch"""
+        self.cursor.execute("SELECT name, last_run FROM schedule_run")
+        return dict(self.cursor.fetchall())
+
+    def write_schedule_runs(self, runs: typing.Dict[str, float]):
+        """Record when some schedules last ran, in a single transaction"""
+        with self.conn:
+            self.cursor.executemany(
+                "INSERT OR REPLACE INTO schedule_run VALUES (?, ?)", runs.items()
+            )
+
+    def feed_states(self) -> typing.Dict[str, typing.Tuple]:
+        """Return the (etag, last_modified, interval) of each feed, by name"""
+        self.cursor.execute("SELECT name, etag, last_modified, interval FROM feed")
+        return {row[0]: row[1:] for row in self.cursor.fetchall()}
+
+    def write_feed(
+        self,
+        name: str,
+        etag: typing.Optional[str],
+        last_modified: typing.Optional[str],
+        interval: float,
+        items: typing.Sequence[str] = (),
+        seen: float = 0.0,
+    ):
+        """Record a feed's polling state and the items in it, in a single transaction
+
+        Items are marked as seen at the time seen,
+        so that items still in the feed are not pruned.
+        """
+        with self.conn:
+            self.cursor.execute(
+                "INSERT OR REPLACE INTO feed VALUES (?, ?, ?, ?)",
+                (name, etag, last_modified, interval),
+            )
+            self.cursor.executemany(
+                "INSERT OR REPLACE INTO feed_item VALUES (?, ?, ?)",
+                [(name, item_id, seen) for item_id in items],
+            )
+
+    def seen_feed_items(
+        self, name: str, item_ids: typing.Sequence[str]
+    ) -> typing.Set[str]:
+        """Return which of some item IDs have already been seen in a feed"""
+        seen: typing.Set[str] = set()
+        # SQLite limits how many parameters a statement can have
+        for idx in range(0, len(item_ids), 500):
+            chunk = item_ids[idx : idx + 500]
+            self.cursor.execute(
+                "SELECT item_id FROM feed_item WHERE feed = ? AND item_id IN "
+                f"({', '.join('?' * len(chunk))})",
+                (name, *chunk),
+            )
+            seen.update(row[0] for row in self.cursor.fetchall())
+        return seen
+
+    def prune_feed_items(self, before: float):
+        """Forget feed items last seen in their feed before a time"""
+        with self.conn:
+            self.cursor.execute("DELETE FROM feed_item WHERE seen < ?", (before,))
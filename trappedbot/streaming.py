@@ -0,0 +1,227 @@
+"""Stream task output into a room as it is produced
+
+Long-running tasks can produce output a little at a time,
+by returning a generator or async generator of `TaskResult` chunks.
+Rather than waiting until the task finishes and sending one huge message,
+chunks are either sent as their own messages as soon as they arrive,
+or collected into a `StreamedMessage`.
+
+A `StreamedMessage` posts a message right away and then replaces its content
+with `m.replace` edits as more output arrives.
+Edits are throttled so that at most one is sent every `interval` seconds,
+and only the last `tail` lines of output are kept in memory (and shown in the room).
+"""
+
+import asyncio
+import collections
+import contextvars
+import inspect
+import time
+import traceback
+import typing
+
+from nio.client.async_client import AsyncClient
+
+from trappedbot import appconfig
+from trappedbot.applogger import LOGGER
+from trappedbot.chat_functions import edit_text_in_room, send_text_to_room
+from trappedbot.constants import DEFAULT_STREAM_INTERVAL, DEFAULT_STREAM_TAIL
+from trappedbot.mxutil import MessageFormat
+from trappedbot.splitting import CONTENT_OVERHEAD, encoded_size, size_factor
+
+
+class StreamedMessage(object):
+    """A message in a room that is edited as task output arrives
+
+    client:     The client to communicate with Matrix
+    room_id:    The ID of the room to send the message to
+    format:     The format for the message
+    interval:   Minimum number of seconds between edits
+    tail:       Number of lines of output to keep
+    """
+
+    def __init__(
+        self,
+        client: AsyncClient,
+        room_id: str,
+        format: MessageFormat = MessageFormat.CODE,
+        interval: float = DEFAULT_STREAM_INTERVAL,
+        tail: int = DEFAULT_STREAM_TAIL,
+    ):
+        self.client = client
+        self.room_id = room_id
+        self.format = format
+        self.interval = interval
+        self.tail = tail
+        self.lines: typing.Deque[str] = collections.deque()
+        self.dropped = 0
+        # An edit carries the message twice: once as a fallback, and once as the new content
+        self.max_size = (
+            appconfig.get().max_event_size - CONTENT_OVERHEAD
+        ) // (2 * size_factor(format))
+        self._size = 0
+        self.status = ""
+        self.event_id: typing.Optional[str] = None
+        self._last_edit = 0.0
+        self._dirty = False
+        self._pending: typing.Optional[asyncio.Task] = None
+        self._lock = asyncio.Lock()
+
+    def render(self) -> str:
+        """Render the current tail window as message text"""
+        lines = []
+        if self.dropped:
+            lines.append(f"[... {self.dropped} earlier lines not shown ...]")
+        lines.extend(self.lines)
+        if self.status:
+            lines.append(self.status)
+        return "\n".join(lines) or "(waiting for output)"
+
+    async def start(self):
+        """Post the initial message that later output will be edited into"""
+        self.event_id = await send_text_to_room(
+            self.client, self.room_id, self.render(), format=self.format
+        )
+        self._last_edit = time.monotonic()
+
+    async def append(self, text: str):
+        """Add output to the message
+
+        The room is only updated if at least `interval` seconds have passed
+        since the last edit; otherwise an edit is scheduled for later.
+        """
+        for line in text.splitlines() or [""]:
+            self.lines.append(line)
+            self._size += encoded_size(line) + 2
+        while len(self.lines) > 1 and (
+            len(self.lines) > self.tail or self._size > self.max_size
+        ):
+            self._size -= encoded_size(self.lines.popleft()) + 2
+            self.dropped += 1
+        self._dirty = True
+
+        wait = self.interval - (time.monotonic() - self._last_edit)
+        if wait <= 0:
+            await self.flush()
+        elif not self._pending:
+            self._pending = asyncio.ensure_future(self._flush_later(wait))
+
+    async def finish(self, status: str = ""):
+        """Send a final edit containing all remaining output
+
+        status:     An optional line to show after the output,
+                    like an error message
+        """
+        if self._pending:
+            self._pending.cancel()
+            self._pending = None
+        if status:
+            self.status = status
+            self._dirty = True
+        await self.flush()
+
+    async def flush(self):
+        """Edit the message now, if there is new output"""
+        async with self._lock:
+            if not self._dirty:
+                return
+            self._dirty = False
+            self._last_edit = time.monotonic()
+            text = self.render()
+            if self.event_id is None:
+                self.event_id = await send_text_to_room(
+                    self.client, self.room_id, text, format=self.format
+                )
+            else:
+                await edit_text_in_room(
+                    self.client, self.room_id, self.event_id, text, format=self.format
+                )
+
+    async def _flush_later(self, delay: float):
+        try:
+            await asyncio.sleep(delay)
+            self._pending = None
+            await self.flush()
+        except asyncio.CancelledError:
+            pass
+        except Exception as exc:
+            LOGGER.error(f"Unable to update streamed message in {self.room_id}: {exc}")
+
+
+async def stream_task_output(
+    client: AsyncClient,
+    room_id: str,
+    chunks: typing.AsyncIterator,
+    interval: float = DEFAULT_STREAM_INTERVAL,
+    tail: int = DEFAULT_STREAM_TAIL,
+):
+    """Stream TaskResult chunks into a room by editing a single message
+
+    Errors raised while iterating are shown at the end of the streamed message,
+    below whatever output had been received.
+    """
+    message = StreamedMessage(client, room_id, interval=interval, tail=tail)
+    await message.start()
+    try:
+        async for chunk in chunks:
+            await message.append(chunk.output)
+    except asyncio.CancelledError:
+        await message.finish("Stopped.")
+        raise
+    except Exception as exc:
+        LOGGER.debug("Streaming task output to %s failed with %s", room_id, exc)
+        await message.finish(f"Error: {exc}")
+    else:
+        await message.finish()
+
+
+async def aiter_chunks(
+    chunks: typing.Union[typing.Iterator, typing.AsyncIterator]
+) -> typing.AsyncIterator:
+    """Iterate over TaskResult chunks from a generator or async generator
+
+    Plain generators are advanced in the default executor,
+    so that a slow extension does not block the event loop between chunks,
+    in a copy of the current context, so that they see the invoking bot's config.
+    """
+    if inspect.isasyncgen(chunks):
+        async for chunk in chunks:  # type: ignore
+            yield chunk
+        return
+    loop = asyncio.get_event_loop()
+    done = object()
+    while True:
+        context = contextvars.copy_context()
+        chunk = await loop.run_in_executor(None, context.run, next, chunks, done)
+        if chunk is done:
+            return
+        yield chunk
+
+
+async def send_task_chunks(
+    client: AsyncClient,
+    room_id: str,
+    chunks: typing.AsyncIterator,
+):
+    """Send each TaskResult chunk to a room as its own message, as it arrives
+
+    If iterating raises an error, the chunks already sent stay in the room,
+    and the error is sent afterwards in a code block.
+    """
+    try:
+        async for chunk in chunks:
+            await send_text_to_room(
+                client,
+                room_id,
+                chunk.output,
+                format=chunk.format,
+                split=chunk.split,
+            )
+    except Exception as exc:
+        LOGGER.debug("Sending task output chunks to %s failed with %s", room_id, exc)
+        await send_text_to_room(
+            client,
+            room_id,
+            f"Error:\n{exc}\n{traceback.format_exc()}",
+            format=MessageFormat.CODE,
+        )
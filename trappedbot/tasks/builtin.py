@@ -3,14 +3,38 @@
 These are not restricted to external system commands, but can just return Python code
 """
 
+import asyncio
 import dataclasses
+import os
 import platform
 import sys
+import time
 import typing
 
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None  # type: ignore
+
 from trappedbot import appconfig
 from trappedbot.constants import HELP_TRAPPED_MSG
+from trappedbot.metrics import (
+    CACHE_REQUESTS,
+    COMMANDS_DISPATCHED,
+    EVENTS_RECEIVED,
+    LAST_SYNC_DURATION,
+    REGISTRY,
+    STARTED,
+    SYNC_DURATION,
+    SYNC_FAILURES,
+    TASK_ERRORS,
+    TASK_LATENCY,
+    Gauge,
+)
 from trappedbot.mxutil import MessageFormat
+from trappedbot.pager import PAGER, page_footer
+from trappedbot.tasks.running import RUNNING
 from trappedbot.tasks.task import (
     Task,
     TaskMessageContext,
@@ -52,6 +76,141 @@ def builtin_task_platinfo(
     return TaskResult(result, MessageFormat.FORMATTED)
 
 
+async def builtin_task_more(
+    _arguments: typing.List[str], context: TaskMessageContext
+) -> typing.AsyncIterator[TaskResult]:
+    bot = appconfig.get().user_id
+    paged_next = PAGER.next((bot, context.room, context.sender))
+    if paged_next is None:
+        yield TaskResult("No more output.", MessageFormat.NATURAL)
+        return
+    page, paged = paged_next
+    yield TaskResult(page, paged.format, paged.split)
+    yield TaskResult(page_footer(paged), MessageFormat.MARKDOWN)
+
+
+async def builtin_task_cancel(
+    arguments: typing.List[str], context: TaskMessageContext
+) -> TaskResult:
+    """Cancel running commands in this room
+
+    With no arguments, cancel all of the sender's running commands.
+    With a command name, cancel only the sender's invocations of that command.
+    Trusted users can pass 'all' to cancel every running command in the room.
+    """
+    config = appconfig.get()
+    if arguments and arguments[0] == "all":
+        if context.sender not in config.trusted_users:
+            return TaskResult(
+                "Only trusted users can cancel other users' commands.",
+                MessageFormat.NATURAL,
+            )
+        running = RUNNING.find(config.user_id, context.room)
+    else:
+        running = RUNNING.find(config.user_id, context.room, context.sender)
+        if arguments:
+            running = [r for r in running if r.command == arguments[0]]
+
+    this = asyncio.current_task()
+    cancelled = []
+    for invocation in running:
+        if invocation.future is this:
+            continue
+        invocation.cancel()
+        cancelled.append(invocation.command)
+
+    if not cancelled:
+        return TaskResult("No running commands to cancel.", MessageFormat.NATURAL)
+    return TaskResult(
+        f"Cancelled {len(cancelled)} running command(s): {', '.join(cancelled)}",
+        MessageFormat.NATURAL,
+    )
+
+
+def _duration(seconds: float) -> str:
+    """Format a number of seconds like 3d 4h 5m 6s"""
+    minutes, secs = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    days, hours = divmod(hours, 24)
+    parts = [(days, "d"), (hours, "h"), (minutes, "m"), (secs, "s")]
+    return " ".join(f"{n}{unit}" for n, unit in parts if n) or "0s"
+
+
+def _ms(seconds: float) -> str:
+    return f"{seconds * 1000:.0f}ms"
+
+
+def _resident_memory() -> typing.Optional[int]:
+    """The current resident memory of the process in bytes, if known"""
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError, AttributeError):
+        # Not Linux
+        return None
+
+
+def _peak_memory() -> typing.Optional[int]:
+    """The peak resident memory of the process in bytes, if known"""
+    if resource is None:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS bytes
+    return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+
+def builtin_task_stats(
+    _arguments: typing.List[str], _context: TaskMessageContext
+) -> TaskResult:
+    """Report runtime performance figures from the bot's metrics
+
+    Everything here is read from in-process counters, so it is cheap to run.
+    With workers, this runs in the bot process, which counts the commands they run.
+    """
+    uptime = time.time() - STARTED
+    events = EVENTS_RECEIVED.total()
+    lines = [
+        f"**Uptime**: {_duration(uptime)}",
+        f"**Events received**: {events:.0f} ({events / max(uptime, 1):.2f}/s)",
+        f"**Last sync**: {_ms(LAST_SYNC_DURATION.get())}"
+        f" (median {_ms(SYNC_DURATION.labels().quantile(0.5))},"
+        f" {SYNC_FAILURES.total():.0f} failures)",
+    ]
+    if (resident := _resident_memory()) is not None:
+        lines.append(f"**Memory**: {resident / 1024 / 1024:.1f} MiB")
+    if (peak := _peak_memory()) is not None:
+        lines.append(f"**Peak memory**: {peak / 1024 / 1024:.1f} MiB")
+
+    lines += ["", "**Commands** (count, errors, latency p50/p90/p99):"]
+    errors = dict(TASK_ERRORS.children())
+    commands = sorted(COMMANDS_DISPATCHED.children(), key=lambda c: -c[1].value)
+    for labels, counter in commands:
+        latency = TASK_LATENCY.labels(*labels)
+        error = errors.get(labels)
+        lines.append(
+            f"- `{labels[0]}`: {counter.value:.0f}, {error.value if error else 0:.0f}, "
+            + "/".join(_ms(latency.quantile(q)) for q in (0.5, 0.9, 0.99))
+        )
+    if not commands:
+        lines.append("- None yet")
+
+    lines += ["", "**Queues**:"]
+    for metric in REGISTRY.metrics:
+        if isinstance(metric, Gauge) and metric.func:
+            lines.append(f"- {metric.help}: {metric.get():.0f}")
+
+    caches: typing.Dict[str, typing.Dict[str, float]] = {}
+    for (cache, result), counter in CACHE_REQUESTS.children():
+        caches.setdefault(cache, {})[result] = counter.value
+    if caches:
+        lines += ["", "**Cache hit rates**:"]
+        for cache, results in sorted(caches.items()):
+            hits, total = results.get("hit", 0), sum(results.values())
+            lines.append(f"- {cache}: {hits / total:.0%} of {total:.0f}")
+
+    return TaskResult("\n".join(lines), MessageFormat.MARKDOWN)
+
+
 @dataclasses.dataclass
 class HelpTopic:
     name: str
@@ -129,4 +288,16 @@ BUILTIN_TASKS = {
         "platinfo",
         taskfunc=builtin_task_platinfo,
     ),
+    "more": Task(
+        "more",
+        taskfunc=builtin_task_more,
+    ),
+    "cancel": Task(
+        "cancel",
+        taskfunc=builtin_task_cancel,
+    ),
+    "stats": Task(
+        "stats",
+        taskfunc=builtin_task_stats,
+    ),
 }
@@ -0,0 +1,103 @@
+"""Tasks that are currently running
+
+Every command invocation is run as its own asyncio task and registered here
+while it runs, so that it can be found and cancelled by the builtin `cancel` task.
+"""
+
+import asyncio
+import itertools
+import time
+import typing
+
+from trappedbot.metrics import REGISTRY, Gauge
+from trappedbot.tasks.task import TaskMessageContext
+
+
+class RunningTask(object):
+    """A command invocation that is currently running
+
+    id:         A unique number for this invocation
+    bot:        The user ID of the bot running the command
+    command:    The name of the command that was invoked
+    context:    The sender and room of the message that invoked the command
+    future:     The asyncio task running the command
+    started:    When the invocation started, in time.monotonic() seconds
+    cancelled:  Whether the invocation was cancelled by a user
+    """
+
+    def __init__(
+        self,
+        id: int,
+        bot: str,
+        command: str,
+        context: TaskMessageContext,
+        future: asyncio.Future,
+    ):
+        self.id = id
+        self.bot = bot
+        self.command = command
+        self.context = context
+        self.future = future
+        self.started = time.monotonic()
+        self.cancelled = False
+
+    def cancel(self):
+        """Cancel the invocation"""
+        self.cancelled = True
+        self.future.cancel()
+
+
+class RunningTasks(object):
+    """A registry of running command invocations"""
+
+    def __init__(self):
+        self._tasks: typing.Dict[int, RunningTask] = {}
+        self._ids = itertools.count(1)
+
+    def __len__(self):
+        return len(self._tasks)
+
+    def __iter__(self) -> typing.Iterator[RunningTask]:
+        return iter(list(self._tasks.values()))
+
+    def start(
+        self,
+        bot: str,
+        command: str,
+        context: TaskMessageContext,
+        coro: typing.Awaitable,
+    ) -> RunningTask:
+        """Start running a coroutine as a command invocation of a bot"""
+        running = RunningTask(
+            next(self._ids), bot, command, context, asyncio.ensure_future(coro)
+        )
+        self._tasks[running.id] = running
+        return running
+
+    def finish(self, running: RunningTask):
+        """Remove a finished invocation"""
+        self._tasks.pop(running.id, None)
+
+    def find(
+        self, bot: str, room: str, sender: typing.Optional[str] = None
+    ) -> typing.List[RunningTask]:
+        """Find a bot's invocations in a room, optionally only those from one sender"""
+        return [
+            t
+            for t in self._tasks.values()
+            if t.bot == bot
+            and t.context.room == room
+            and (sender is None or t.context.sender == sender)
+        ]
+
+
+RUNNING = RunningTasks()
+"""The global registry of running command invocations"""
+
+REGISTRY.register(
+    Gauge(
+        "trappedbot_running_tasks",
+        "Command invocations that are currently running",
+        func=lambda: len(RUNNING),
+    )
+)
@@ -0,0 +1,117 @@
+"""Coalesce identical command invocations that are in flight at the same time
+
+When many users run the same expensive command at once,
+there is no need to run it many times in parallel.
+Commands configured with `singleflight: yes` share a single execution
+between all invocations of the same bot with the same command name and arguments
+that arrive while it is running, and every invocation gets its result.
+
+Note that the shared execution sees the message context (sender and room)
+of whichever invocation started it.
+"""
+
+import asyncio
+import typing
+
+from trappedbot.metrics import CACHE_REQUESTS, REGISTRY, Gauge
+
+
+class SharedInvocationCancelled(RuntimeError):
+    """The shared execution that an invocation was waiting on was cancelled"""
+
+    def __str__(self):
+        return "The shared run of this command was cancelled before it finished"
+
+
+SingleFlightKey = typing.Tuple[str, str, typing.Tuple[str, ...]]
+"""A (bot, command name, arguments) tuple identifying identical invocations
+
+The bot is the bot's user ID, since several bots may run in one process,
+and their commands with the same name may do different things.
+"""
+
+
+class _Flight(object):
+    """An execution that is in flight, and how many invocations are waiting on it"""
+
+    __slots__ = ("task", "waiters")
+
+    def __init__(self, task: asyncio.Future):
+        self.task = task
+        self.waiters = 0
+
+
+class SingleFlight(object):
+    """A registry of in-flight executions, keyed by bot, command name and arguments
+
+    Each execution runs in its own asyncio task, which every invocation waits on,
+    so that cancelling one invocation, even the one that started it,
+    does not cancel it for the others.
+    It is only cancelled once no invocation is waiting on it any more.
+    """
+
+    def __init__(self):
+        self._inflight: typing.Dict[SingleFlightKey, _Flight] = {}
+
+    def __len__(self):
+        return len(self._inflight)
+
+    async def do(
+        self,
+        key: SingleFlightKey,
+        func: typing.Callable[[], typing.Awaitable],
+    ) -> typing.Tuple[typing.Any, bool]:
+        """Run func, unless an execution with the same key is already running
+
+        Returns a tuple of the result and whether it was shared from
+        an execution that another invocation started.
+        """
+        flight = self._inflight.get(key)
+        shared = flight is not None
+        CACHE_REQUESTS.inc("singleflight", "hit" if shared else "miss")
+        if flight is None:
+            flight = self._start(key, func)
+
+        flight.waiters += 1
+        try:
+            # Shield the shared execution, so that cancelling one waiter
+            # does not cancel it for everyone else.
+            return await asyncio.shield(flight.task), shared
+        except asyncio.CancelledError:
+            if flight.task.cancelled():
+                raise SharedInvocationCancelled()
+            raise
+        finally:
+            flight.waiters -= 1
+            if not flight.waiters and not flight.task.done():
+                # Nobody is waiting for the result any more
+                flight.task.cancel()
+
+    def _start(
+        self, key: SingleFlightKey, func: typing.Callable[[], typing.Awaitable]
+    ) -> _Flight:
+        flight = _Flight(asyncio.ensure_future(func()))
+
+        def _finished(task: asyncio.Future):
+            if self._inflight.get(key) is flight:
+                del self._inflight[key]
+            # Retrieve any exception, so it isn't logged as never retrieved
+            # if every invocation had stopped waiting.
+            if not task.cancelled():
+                task.exception()
+
+        flight.task.add_done_callback(_finished)
+        self._inflight[key] = flight
+        return flight
+
+
+SINGLEFLIGHT = SingleFlight()
+"""The global registry of in-flight single-flight executions"""
+
+REGISTRY.register(
+    Gauge(
+        "trappedbot_singleflight_executions",
+        "Single-flight command executions that are currently running",
+        func=lambda: len(SINGLEFLIGHT),
+    )
+)
@@ -1,9 +1,13 @@
+import asyncio
 import os
 import re
+import signal
 import subprocess
+import time
 import typing
 
 from trappedbot.applogger import LOGGER
+from trappedbot.constants import DEFAULT_STREAM_INTERVAL, DEFAULT_STREAM_TAIL
 from trappedbot.mxutil import MessageFormat
 
 
@@ -31,34 +35,107 @@ class TaskResult(typing.NamedTuple):
 # The message context contains the sender, room, and possibly other metadata,
 # and can be used to write tasks that take these values into account,
 # for instance replying to users by name.
-TaskFunction = typing.Callable[[typing.List[str], TaskMessageContext], TaskResult]
+# A TaskFunction usually returns a single TaskResult,
+# but it may instead be a generator or an async generator that yields TaskResult chunks.
+# It may also be a coroutine function (async def) that returns a TaskResult.
+# Functions that are not async are run in an executor thread,
+# so that they do not block the bot while they run.
+# Each chunk is sent to the room as soon as it is yielded,
+# so large or slow output never has to be held in memory all at once.
+TaskFunction = typing.Callable[
+    [typing.List[str], TaskMessageContext],
+    typing.Union[
+        TaskResult,
+        typing.Awaitable[TaskResult],
+        typing.Iterator[TaskResult],
+        typing.AsyncIterator[TaskResult],
+    ],
+]
+
+
+SYSTEMCMD_KILL_GRACE = 5.0
+"""Seconds to wait after SIGTERM before sending SIGKILL to a cancelled system command"""
+
+SYSTEMCMD_KILL_POLL = 0.1
+"""Seconds between checks for whether a system command's process group has exited"""
+
+
+def _systemcmd_env(context: TaskMessageContext) -> typing.Dict[str, str]:
+    """The environment for an external program run as a task"""
+    env = os.environ.copy()
+    env["MATRIX_SENDER"] = context.sender
+    env["MATRIX_ROOM"] = context.room
+    return env
+
+
+async def _spawn_systemcmd(
+    fullcmd: typing.List[str], context: TaskMessageContext, **kwargs
+) -> asyncio.subprocess.Process:
+    """Start an external program in its own session and process group
+
+    Running each program in its own process group lets us kill the program
+    along with any children it started if the task times out or is cancelled.
+    """
+    return await asyncio.create_subprocess_exec(
+        *fullcmd,
+        env=_systemcmd_env(context),
+        start_new_session=True,
+        **kwargs,
+    )
+
+
+def _signal_process_group(pgid: int, signum: int) -> bool:
+    """Send a signal to a process group, returning whether anything was left in it"""
+    try:
+        os.killpg(pgid, signum)
+    except ProcessLookupError:
+        return False
+    return True
+
+
+async def _kill_process_group(proc: asyncio.subprocess.Process):
+    """Kill anything left in an external program's process group
+
+    Send SIGTERM first, then SIGKILL after a grace period,
+    to anything left in the group.
+    This does not depend on whether the program itself is still running,
+    since it may have exited and left children behind, like `sleep 300 &`.
+    """
+    if _signal_process_group(proc.pid, signal.SIGTERM):
+        LOGGER.debug("Terminating process group %s", proc.pid)
+        deadline = time.monotonic() + SYSTEMCMD_KILL_GRACE
+        while time.monotonic() < deadline:
+            await asyncio.sleep(SYSTEMCMD_KILL_POLL)
+            if not _signal_process_group(proc.pid, 0):
+                break
+        else:
+            _signal_process_group(proc.pid, signal.SIGKILL)
+    await proc.wait()
 
 
 def systemcmd2taskfunc(cmd: str) -> TaskFunction:
     """Return a TaskFunction that runs an external program"""
 
-    def _run_systemcmd(
+    async def _run_systemcmd(
         arguments: typing.List[str], context: TaskMessageContext
     ) -> TaskResult:
         """Run an external program"""
 
         fullcmd = [cmd] + arguments
-        LOGGER.debug(f"Running system command {fullcmd}")
-
-        env = os.environ.copy()
-        env["MATRIX_SENDER"] = context.sender
-        env["MATRIX_ROOM"] = context.room
+        LOGGER.debug("Running system command %s", fullcmd)
 
-        proc = subprocess.Popen(
+        proc = await _spawn_systemcmd(
             fullcmd,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True,
-            env=env,
+            context,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
         )
-        stdout, stderr = proc.communicate()
-        stdout = stdout.strip()
-        stderr = stderr.strip()
+        try:
+            bstdout, bstderr = await proc.communicate()
+        finally:
+            await _kill_process_group(proc)
+        stdout = bstdout.decode(errors="replace").strip()
+        stderr = bstderr.decode(errors="replace").strip()
 
         if proc.returncode != 0:
             raise subprocess.CalledProcessError(
@@ -70,6 +147,43 @@ def systemcmd2taskfunc(cmd: str) -> TaskFunction:
     return _run_systemcmd
 
 
+def systemcmd2streamfunc(cmd: str) -> TaskFunction:
+    """Return a TaskFunction that runs an external program and streams its output
+
+    Each line the program writes to stdout or stderr is yielded as it arrives,
+    so the whole output is never held in memory at once.
+    """
+
+    async def _stream_systemcmd(
+        arguments: typing.List[str], context: TaskMessageContext
+    ) -> typing.AsyncIterator[TaskResult]:
+        """Run an external program, yielding its output line by line"""
+
+        fullcmd = [cmd] + arguments
+        LOGGER.debug("Streaming system command %s", fullcmd)
+
+        proc = await _spawn_systemcmd(
+            fullcmd,
+            context,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.STDOUT,
+        )
+        try:
+            assert proc.stdout is not None
+            async for line in proc.stdout:
+                yield TaskResult(
+                    line.decode(errors="replace").rstrip("\n"), MessageFormat.CODE
+                )
+            await proc.wait()
+        finally:
+            await _kill_process_group(proc)
+
+        if proc.returncode != 0:
+            raise subprocess.CalledProcessError(proc.returncode, fullcmd)
+
+    return _stream_systemcmd
+
+
 def constant2taskfunc(
     value: str, format: MessageFormat = MessageFormat.NATURAL
 ) -> TaskFunction:
@@ -90,8 +204,21 @@ class Task(typing.NamedTuple):
         taskfunc:               A TaskFunction callable.
         split:                  If set, split response into multiple messages
                                 whenever this string occurs in the taskfunc output.
+        stream:                 If set, post a message immediately and edit it
+                                as output chunks arrive from a generator taskfunc.
+                                Otherwise, each chunk is sent as its own message.
+        stream_interval:        Minimum number of seconds between edits.
+        stream_tail:            Number of output lines to keep in the message.
+        timeout:                If set, stop the task after this many seconds.
+        singleflight:           If set, identical invocations that arrive while
+                                the task is running share its result.
     """
 
     name: str
     taskfunc: TaskFunction
     split: typing.Optional[str] = None
+    stream: bool = False
+    stream_interval: float = DEFAULT_STREAM_INTERVAL
+    stream_tail: int = DEFAULT_STREAM_TAIL
+    timeout: typing.Optional[float] = None
+    singleflight: bool = False
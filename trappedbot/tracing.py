@@ -0,0 +1,223 @@
+"""Per-event latency tracing
+
+A trace follows a single message event through the bot:
+from the homeserver receiving it (its `origin_server_ts`),
+to the bot receiving it from sync,
+through rate limiting and authorization, running the task,
+rendering the output, and sending each reply with `room_send`.
+
+Only a fraction of events are traced, set by `tracing.sample_rate` in the config.
+The current trace and span are kept in context variables,
+which asyncio copies into tasks it creates,
+so code anywhere below `Callbacks.handle` can add a span with
+
+    with span("name"):
+        ...
+
+and this costs almost nothing when the event is not being traced.
+
+Finished traces are logged as a single structured (JSON) log line,
+and if `tracing.file` is set, appended to that file as OTLP/JSON,
+one `ExportTraceServiceRequest` per line.
+That is the format written by the OpenTelemetry Collector's file exporter,
+and it can be read by the Collector's `otlpjsonfile` receiver
+to forward traces to Jaeger, Tempo, or anything else that accepts OTLP.
+"""
+
+import contextlib
+import contextvars
+import json
+import logging
+import os
+import random
+import threading
+import time
+import typing
+
+from trappedbot import appconfig
+from trappedbot.applogger import LOGGER
+from trappedbot.version import version_raw
+
+
+class Span(object):
+    """A timed operation within a trace
+
+    Times are wall clock times in nanoseconds since the epoch,
+    so that they can be compared with the event's origin_server_ts.
+    """
+
+    __slots__ = ("span_id", "parent_id", "name", "start", "end", "attributes")
+
+    def __init__(
+        self,
+        name: str,
+        parent_id: str = "",
+        start: typing.Optional[int] = None,
+        attributes: typing.Optional[typing.Dict[str, typing.Any]] = None,
+    ):
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.name = name
+        self.start = time.time_ns() if start is None else start
+        self.end = 0
+        self.attributes = attributes or {}
+
+    @property
+    def duration_ms(self) -> float:
+        return (self.end - self.start) / 1e6
+
+
+class Trace(object):
+    """All the spans recorded while handling a single event"""
+
+    def __init__(self, event_id: str, room_id: str, origin_server_ts: int):
+        self.trace_id = os.urandom(16).hex()
+        self.event_id = event_id
+        self.room_id = room_id
+        # origin_server_ts is in milliseconds
+        self.origin = origin_server_ts * 1_000_000
+        self.root = Span("event", attributes={"event_id": event_id, "room_id": room_id})
+        self.spans: typing.List[Span] = [self.root]
+        # The time between the homeserver receiving the event and us receiving it
+        # from sync, which may be negative if the clocks disagree.
+        sync = Span("sync", self.root.span_id, start=self.origin)
+        sync.end = self.root.start
+        self.spans.append(sync)
+
+    def summary(self) -> typing.Dict[str, typing.Any]:
+        """Summarize the trace for a structured log line"""
+        summary: typing.Dict[str, typing.Any] = {
+            "trace_id": self.trace_id,
+            "event_id": self.event_id,
+            "room_id": self.room_id,
+            "total_ms": round((self.root.end - self.origin) / 1e6, 3),
+            "spans": [],
+        }
+        for span in self.spans[1:]:
+            summary["spans"].append(
+                {
+                    "name": span.name,
+                    "offset_ms": round((span.start - self.origin) / 1e6, 3),
+                    "duration_ms": round(span.duration_ms, 3),
+                }
+            )
+        return summary
+
+    def otlp(self) -> typing.Dict[str, typing.Any]:
+        """Render the trace as an OTLP/JSON ExportTraceServiceRequest"""
+
+        def _attrs(attributes):
+            return [
+                {"key": k, "value": {"stringValue": str(v)}}
+                for k, v in attributes.items()
+            ]
+
+        spans = []
+        for span in self.spans:
+            otlpspan = {
+                "traceId": self.trace_id,
+                "spanId": span.span_id,
+                "name": span.name,
+                "kind": 1,
+                "startTimeUnixNano": str(span.start),
+                "endTimeUnixNano": str(span.end),
+                "attributes": _attrs(span.attributes),
+            }
+            if span.parent_id:
+                otlpspan["parentSpanId"] = span.parent_id
+            spans.append(otlpspan)
+
+        return {
+            "resourceSpans": [
+                {
+                    "resource": {
+                        "attributes": _attrs(
+                            {
+                                "service.name": "trappedbot",
+                                "service.version": version_raw(),
+                            }
+                        )
+                    },
+                    "scopeSpans": [
+                        {"scope": {"name": "trappedbot.tracing"}, "spans": spans}
+                    ],
+                }
+            ]
+        }
+
+
+_TRACE: "contextvars.ContextVar[typing.Optional[Trace]]" = contextvars.ContextVar(
+    "trappedbot_trace", default=None
+)
+_PARENT: "contextvars.ContextVar[str]" = contextvars.ContextVar(
+    "trappedbot_span", default=""
+)
+
+_FILE_LOCK = threading.Lock()
+
+
+@contextlib.contextmanager
+def span(name: str, **attributes):
+    """Record a span in the current trace, if there is one"""
+    trace = _TRACE.get()
+    if trace is None:
+        yield
+        return
+    current = Span(name, _PARENT.get(), attributes=attributes)
+    trace.spans.append(current)
+    token = _PARENT.set(current.span_id)
+    try:
+        yield
+    finally:
+        current.end = time.time_ns()
+        _PARENT.reset(token)
+
+
+def record(name: str, start: int, **attributes):
+    """Record a span that started at start (from time.time_ns()) and ends now
+
+    For operations that do not fit neatly in a `with` block.
+    """
+    trace = _TRACE.get()
+    if trace is None:
+        return
+    current = Span(name, _PARENT.get(), start=start, attributes=attributes)
+    current.end = time.time_ns()
+    trace.spans.append(current)
+
+
+@contextlib.contextmanager
+def trace_event(event_id: str, room_id: str, origin_server_ts: int):
+    """Trace the handling of an event, if it is sampled"""
+    config = appconfig.get()
+    if not config.trace_sample_rate or random.random() >= config.trace_sample_rate:
+        yield
+        return
+
+    trace = Trace(event_id, room_id, origin_server_ts)
+    trace_token = _TRACE.set(trace)
+    parent_token = _PARENT.set(trace.root.span_id)
+    try:
+        yield
+    finally:
+        trace.root.end = time.time_ns()
+        _PARENT.reset(parent_token)
+        _TRACE.reset(trace_token)
+        export(trace, config.trace_file)
+
+
+def export(trace: Trace, filepath: str = ""):
+    """Log a finished trace, and append it to a file if one is configured"""
+    for span in trace.spans:
+        # Spans left open by a task that was cancelled end with the event
+        if not span.end:
+            span.end = trace.root.end
+    if LOGGER.isEnabledFor(logging.INFO):
+        LOGGER.info("trace %s", json.dumps(trace.summary()))
+    if filepath:
+        line = json.dumps(trace.otlp(), separators=(",", ":"))
+        try:
+            with _FILE_LOCK, open(filepath, "a") as fp:
+                fp.write(line + "\n")
+        except OSError as exc:
+            LOGGER.error(f"Unable to write trace to {filepath}: {exc}")
@@ -1,8 +1,16 @@
 """trappedbot utility functions"""
 
+import asyncio
 import pdb
 import traceback
 import sys
+import typing
+
+from trappedbot.applogger import LOGGER
+
+
+RESTART_DELAY = 10.0
+"""Seconds to wait before restarting a background loop that failed"""
 
 
 def idb_excepthook(type, value, tb):
@@ -17,3 +25,49 @@ def idb_excepthook(type, value, tb):
         traceback.print_exception(type, value, tb)
         print
         pdb.pm()
+
+
+class BackgroundTasks(object):
+    """Tasks running in the background, with nothing waiting on them
+
+    The event loop only keeps a weak reference to a task,
+    so these are kept until they finish,
+    and any exception they raise is logged, as doing what.
+    """
+
+    def __init__(self, doing: str):
+        self.doing = doing
+        self._tasks: typing.Set[asyncio.Future] = set()
+
+    def __len__(self):
+        return len(self._tasks)
+
+    def start(self, coro: typing.Awaitable) -> asyncio.Future:
+        """Start running a coroutine in the background"""
+        task = asyncio.ensure_future(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._finished)
+        return task
+
+    def _finished(self, task: asyncio.Future):
+        self._tasks.discard(task)
+        if not task.cancelled() and (exc := task.exception()) is not None:
+            LOGGER.error(
+                f"Error {self.doing}", exc_info=(type(exc), exc, exc.__traceback__)
+            )
+
+
+async def keep_running(
+    name: str, run: typing.Callable[[], typing.Awaitable], delay: float = RESTART_DELAY
+):
+    """Run a loop that should run forever, and start it again if it fails
+
+    run is called again each time, so it should start over from scratch.
+    """
+    while True:
+        try:
+            await run()
+            return
+        except Exception:
+            LOGGER.exception(f"{name} failed, restarting it in {delay} seconds")
+            await asyncio.sleep(delay)
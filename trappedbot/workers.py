@@ -0,0 +1,476 @@
+"""Run commands and responses in worker processes
+
+Normally the bot does everything in one process:
+syncing with the homeserver, decrypting events, matching responses and running tasks.
+With `bot.workers` set, the bot process only syncs and decrypts,
+and hands each room message to one of that many worker processes,
+which match responses and run tasks.
+Everything a worker sends to Matrix goes back through the bot process,
+which holds the only connection to the homeserver and the encryption keys.
+
+Each room is always handled by the same worker,
+so per-room state like running commands and paged output works as usual.
+Workers handle messages like the bot process does, each in its own task,
+and reply to each room in the order its messages arrived;
+see `trappedbot.replyorder`.
+The bot process sends a room's messages in the order the worker sent them.
+
+Rate limits and jobs are kept by the bot process, so that all workers share them.
+For each command the sender may run, the bot process charges the rate limits,
+records a job if the command is allowed,
+and passes the rate limit decision on to the worker with the message.
+Commands that report on the bot itself, like `stats`, run in the bot process.
+
+Workers communicate with the bot process over multiprocessing queues:
+
+* Each worker has an inbox, where the bot process puts
+  `("event", room, event, ratelimit)` for each room message, and
+  `("result", callid, result, exception)` for each finished client call.
+* All workers share an outbox, where they put
+  `("call", worker, callid, method, args, kwargs)` to call a method of the bot's client,
+  and `("done", worker, event_id, errors)` when they have finished handling an event,
+  so that the bot process can finish its job and wait for them when it shuts down.
+  errors is the worker's `TASK_ERRORS` counts.
+
+If a worker dies, the bot process stops waiting for the messages it was handling,
+and starts a new worker in its place.
+
+Workers are started with the "spawn" method, and each reads the config file itself,
+since commands may hold functions that cannot be pickled.
+Workers ignore SIGINT and SIGTERM, and are stopped by the bot process
+after it has drained them; see `trappedbot.shutdown`.
+The bot process counts the commands that workers run,
+how long they take to handle and how many fail, in its own metrics.
+Other metrics for handling messages, and traces, are kept by each worker,
+and are not exported by the bot process.
+"""
+
+import asyncio
+import functools
+import io
+import itertools
+import multiprocessing
+import pickle
+import signal
+import threading
+import time
+import typing
+import zlib
+
+from nio import AsyncClient
+from nio.events.room_events import RoomMessage
+from nio.rooms import MatrixRoom
+
+from trappedbot import appconfig
+from trappedbot.applogger import LOGGER
+from trappedbot.callbacks import Callbacks
+from trappedbot.commands.command import Authorization, Command, split_command
+from trappedbot.configparser import parse_configs
+from trappedbot.configuration import Configuration
+from trappedbot.jobs import Job
+from trappedbot.metrics import (
+    COMMANDS_DISPATCHED,
+    EVENTS_RECEIVED,
+    RATELIMIT_BACKOFFS,
+    TASK_ERRORS,
+    TASK_LATENCY,
+)
+from trappedbot.mxutil import Mxid
+from trappedbot.shutdown import DRAIN
+from trappedbot.tasks.builtin import BUILTIN_TASKS
+from trappedbot.util import BackgroundTasks
+
+
+WORKER_CHECK_INTERVAL = 1.0
+"""Seconds between checks for worker processes that have died"""
+
+# The methods of the bot's client that workers may call
+_CLIENT_METHODS = frozenset(["room_send", "upload"])
+
+# The tasks that report on the bot process, and so have to run there
+_BOT_PROCESS_TASKS = (BUILTIN_TASKS["stats"],)
+
+
+def _picklable(response: typing.Any) -> typing.Any:
+    """Drop the parts of a nio response that cannot be sent to a worker"""
+    if isinstance(response, tuple):
+        return tuple(_picklable(item) for item in response)
+    if hasattr(response, "transport_response"):
+        response.transport_response = None
+    return response
+
+
+def _room_snapshot(room: MatrixRoom, sender: str) -> MatrixRoom:
+    """Copy just the parts of a room that handling a message needs
+
+    The full room, with every member, can be large.
+    """
+    snapshot = MatrixRoom(room.room_id, room.own_user_id)
+    snapshot.canonical_alias = room.canonical_alias
+    snapshot.name = room.name
+    snapshot.summary = room.summary
+    if (user := room.users.get(sender)) :
+        snapshot.add_member(sender, user.display_name, user.avatar_url)
+    return snapshot
+
+
+class _RoomLock(object):
+    """A lock for sending to a room, and how many calls are using it"""
+
+    def __init__(self, lock: asyncio.Lock):
+        self.lock = lock
+        self.users = 0
+
+
+class WorkerPool(object):
+    """Worker processes that handle room messages for a bot
+
+    Use `message` as the client's room message callback instead of
+    `trappedbot.callbacks.Callbacks.message`.
+    If callbacks is set, the bot process's callbacks,
+    commands that workers run are recorded in its jobs until they finish,
+    and it handles the commands that have to run in the bot process.
+    """
+
+    def __init__(
+        self,
+        client: AsyncClient,
+        config: Configuration,
+        count: int,
+        callbacks: typing.Optional[Callbacks] = None,
+    ):
+        self.client = client
+        self.config = config
+        self.count = count
+        self.callbacks = callbacks
+        self.jobs = callbacks.jobs if callbacks else None
+        self._context = multiprocessing.get_context("spawn")
+        self._outbox = self._context.Queue()
+        self._inboxes: typing.List[multiprocessing.Queue] = []
+        self._processes: typing.List[multiprocessing.Process] = []
+        # The IDs of the events each worker is handling,
+        # with the name of the command and when it was dispatched, for commands
+        self._handling: typing.List[
+            typing.Dict[str, typing.Optional[typing.Tuple[str, float]]]
+        ] = []
+        # The last TASK_ERRORS counts from each worker
+        self._errors: typing.List[typing.Dict[typing.Tuple[str, ...], float]] = []
+        self._reader: typing.Optional[threading.Thread] = None
+        self._monitor: typing.Optional[asyncio.Future] = None
+        self._room_locks: typing.Dict[str, _RoomLock] = {}
+        self._calls = BackgroundTasks("calling the client for a worker")
+
+    def _spawn(
+        self, idx: int
+    ) -> typing.Tuple[multiprocessing.Queue, multiprocessing.Process]:
+        """Start worker process idx, and return its inbox and process"""
+        inbox = self._context.Queue()
+        process = self._context.Process(
+            target=_worker_main,
+            args=(
+                idx,
+                self.config.config_filepath,
+                self.config.user_id,
+                inbox,
+                self._outbox,
+            ),
+            name=f"trappedbot-worker-{idx}",
+            daemon=True,
+        )
+        process.start()
+        return inbox, process
+
+    def start(self):
+        for idx in range(self.count):
+            inbox, process = self._spawn(idx)
+            self._inboxes.append(inbox)
+            self._processes.append(process)
+            self._handling.append({})
+            self._errors.append({})
+        # Read the outbox on a daemon thread, rather than in the loop's executor,
+        # so that a blocked read never holds up shutting down the loop
+        self._reader = threading.Thread(
+            target=self._read_outbox,
+            args=(asyncio.get_event_loop(),),
+            name="trappedbot-worker-outbox",
+            daemon=True,
+        )
+        self._reader.start()
+        self._monitor = asyncio.ensure_future(self._watch())
+        LOGGER.info("Started %s worker processes", self.count)
+
+    def stop(self):
+        if self._monitor:
+            self._monitor.cancel()
+        # Wake the thread reading the outbox, so that it can finish
+        self._outbox.put(None)
+        for inbox in self._inboxes:
+            inbox.put(None)
+        for process in self._processes:
+            process.join(timeout=5)
+            if process.is_alive():
+                # Workers ignore SIGTERM
+                process.kill()
+        self._inboxes.clear()
+        self._processes.clear()
+
+    async def _watch(self):
+        """Replace workers that have died"""
+        while True:
+            await asyncio.sleep(WORKER_CHECK_INTERVAL)
+            for idx, process in enumerate(self._processes):
+                if process.is_alive():
+                    continue
+                handling = self._handling[idx]
+                LOGGER.error(
+                    "Worker %s exited with %s while handling %s messages, restarting",
+                    idx,
+                    process.exitcode,
+                    len(handling),
+                )
+                for event_id in list(handling):
+                    self._done(idx, event_id)
+                self._errors[idx] = {}
+                self._inboxes[idx], self._processes[idx] = self._spawn(idx)
+
+    def worker_for(self, room_id: str) -> int:
+        """The index of the worker that handles a room"""
+        return zlib.crc32(room_id.encode()) % self.count
+
+    async def message(self, room: MatrixRoom, event: RoomMessage):
+        EVENTS_RECEIVED.inc(type(event).__name__)
+        self.dispatch(room, event)
+
+    def dispatch(self, room: MatrixRoom, event: RoomMessage):
+        """Hand a room message to the worker for its room"""
+        if event.sender == self.client.user:
+            return
+        ratelimit = None
+        admitted = None
+        command, arguments = self._command(event)
+        if command:
+            ratelimit = self.config.ratelimits.check(
+                event.sender, room.room_id, command.name
+            )
+            if self.callbacks and command.task in _BOT_PROCESS_TASKS:
+                self.callbacks.handle(room, event, ratelimit)
+                return
+            if ratelimit.allowed:
+                self._admit(room.room_id, event, command, arguments)
+                admitted = (command.name, time.perf_counter())
+            else:
+                RATELIMIT_BACKOFFS.inc(ratelimit.scope)
+        idx = self.worker_for(room.room_id)
+        DRAIN.begin()
+        self._handling[idx][event.event_id] = admitted
+        self._inboxes[idx].put(
+            ("event", _room_snapshot(room, event.sender), event, ratelimit)
+        )
+
+    def _command(
+        self, event: RoomMessage
+    ) -> typing.Tuple[typing.Optional[Command], typing.List[str]]:
+        """Find the command a message runs and its arguments, if the sender may run it
+
+        Otherwise, return None and no arguments.
+        """
+        config = self.config
+        body = getattr(event, "body", "")
+        if not body.startswith(config.command_prefix):
+            return None, []
+        try:
+            cmdsplit = split_command(body[len(config.command_prefix) :])
+        except ValueError:
+            # The worker tells the user about it
+            return None, []
+        command = config.commands.get(cmdsplit[0]) if cmdsplit else None
+        if not command:
+            return None, []
+        sender = Mxid.fromstr(event.sender)
+        if command.authorize(sender, config.trusted_users) == Authorization.DENIED:
+            return None, []
+        return command, cmdsplit[1:]
+
+    def _admit(
+        self,
+        room_id: str,
+        event: RoomMessage,
+        command: Command,
+        arguments: typing.List[str],
+    ):
+        """Count a command that a worker is going to run, and record its job"""
+        COMMANDS_DISPATCHED.inc(command.name)
+        if self.jobs:
+            job = Job(
+                event.event_id,
+                command.name,
+                arguments,
+                event.sender,
+                room_id,
+                event.source,
+            )
+            self.jobs.start(self.jobs.add(job))
+
+    def _done(
+        self,
+        idx: int,
+        event_id: str,
+        errors: typing.Optional[typing.Dict[typing.Tuple[str, ...], float]] = None,
+    ):
+        """Record that a worker has finished handling a message"""
+        if errors is not None:
+            last = self._errors[idx]
+            for labels, value in errors.items():
+                if value > last.get(labels, 0):
+                    TASK_ERRORS.inc(*labels, amount=value - last.get(labels, 0))
+            self._errors[idx] = errors
+        if event_id not in self._handling[idx]:
+            return
+        admitted = self._handling[idx].pop(event_id)
+        DRAIN.end()
+        if admitted:
+            command, started = admitted
+            TASK_LATENCY.observe(time.perf_counter() - started, command)
+            if self.jobs:
+                self.jobs.finish(event_id)
+
+    def _read_outbox(self, loop: asyncio.AbstractEventLoop):
+        while (message := self._outbox.get()) :
+            if message[0] == "done":
+                loop.call_soon_threadsafe(self._done, *message[1:])
+            else:
+                loop.call_soon_threadsafe(self._start_call, *message[1:])
+
+    def _start_call(self, worker: int, callid: int, method: str, args, kwargs):
+        self._calls.start(self._call(worker, callid, method, args, kwargs))
+
+    async def _call(self, worker: int, callid: int, method: str, args, kwargs):
+        # Calls for a room start in the order they were received,
+        # and asyncio locks are fair, so they finish in that order too
+        room_id = args[0] if method == "room_send" else ""
+        if (entry := self._room_locks.get(room_id)) is None:
+            entry = self._room_locks[room_id] = _RoomLock(asyncio.Lock())
+        entry.users += 1
+        try:
+            async with entry.lock:
+                if method not in _CLIENT_METHODS:
+                    raise ValueError(f"Workers may not call client.{method}")
+                if method == "upload":
+                    args = (io.BytesIO(args[0]),) + tuple(args[1:])
+                result = await getattr(self.client, method)(*args, **kwargs)
+            reply = ("result", callid, _picklable(result), None)
+        except Exception as exc:
+            reply = ("result", callid, None, exc)
+        finally:
+            entry.users -= 1
+            if not entry.users:
+                del self._room_locks[room_id]
+        try:
+            pickle.dumps(reply)
+        except Exception as exc:
+            error = RuntimeError(f"Cannot return {method} result: {exc}")
+            reply = ("result", callid, None, error)
+        self._inboxes[worker].put(reply)
+
+
+class WorkerClient(object):
+    """A stand-in for `nio.AsyncClient` in a worker process
+
+    Forwards the client calls that tasks and chat functions make
+    to the bot process.
+    """
+
+    def __init__(self, user: str, worker: int, outbox: multiprocessing.Queue):
+        self.user = user
+        self.worker = worker
+        self._outbox = outbox
+        self._callids = itertools.count(1)
+        self._pending: typing.Dict[int, asyncio.Future] = {}
+
+    async def _call(self, method: str, *args, **kwargs):
+        callid = next(self._callids)
+        future = asyncio.get_event_loop().create_future()
+        self._pending[callid] = future
+        self._outbox.put(("call", self.worker, callid, method, args, kwargs))
+        return await future
+
+    def resolve(
+        self, callid: int, result: typing.Any, exc: typing.Optional[Exception]
+    ):
+        if (future := self._pending.pop(callid, None)) is None or future.done():
+            return
+        if exc is not None:
+            future.set_exception(exc)
+        else:
+            future.set_result(result)
+
+    async def room_send(
+        self,
+        room_id: str,
+        message_type: str,
+        content: typing.Dict,
+        tx_id: typing.Optional[str] = None,
+        ignore_unverified_devices: bool = False,
+    ):
+        return await self._call(
+            "room_send",
+            room_id,
+            message_type,
+            content,
+            tx_id=tx_id,
+            ignore_unverified_devices=ignore_unverified_devices,
+        )
+
+    async def upload(self, data_provider, content_type: str, filename=None, **kwargs):
+        data = data_provider.read()
+        if asyncio.iscoroutine(data):
+            data = await data
+        return await self._call(
+            "upload", data, content_type, filename=filename, **kwargs
+        )
+
+    async def close(self):
+        pass
+
+
+def _worker_main(
+    worker: int,
+    config_filepath: str,
+    user_id: str,
+    inbox: multiprocessing.Queue,
+    outbox: multiprocessing.Queue,
+):
+    """The main function of a worker process"""
+    # The bot process decides when workers stop, after draining them,
+    # but a signal sent to the whole process group would reach workers too
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    config = next(c for c in parse_configs(config_filepath) if c.user_id == user_id)
+    appconfig.set(config)
+
+    async def _run():
+        client = WorkerClient(user_id, worker, outbox)
+        callbacks = Callbacks(client, None)
+        loop = asyncio.get_event_loop()
+        # Keep references to running tasks, so they are not garbage collected
+        tasks: typing.Set[asyncio.Future] = set()
+
+        def _handled(event_id: str, _task: asyncio.Future):
+            # Pass on the error counts, for the bot process's metrics
+            errors = {labels: child.value for labels, child in TASK_ERRORS.children()}
+            outbox.put(("done", worker, event_id, errors))
+
+        while (message := await loop.run_in_executor(None, inbox.get)) is not None:
+            if message[0] == "event":
+                _, room, event, ratelimit = message
+                task = callbacks.handle(room, event, ratelimit)
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+                task.add_done_callback(functools.partial(_handled, event.event_id))
+            elif message[0] == "result":
+                client.resolve(*message[1:])
+
+    try:
+        asyncio.run(_run())
+    except KeyboardInterrupt:
+        pass